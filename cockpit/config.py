@@ -179,6 +179,26 @@ def _default_cockpit_config():
             # 'loadPosition' : '',
             # 'unloadPosition' : '',
         },
+        'saving' : {
+            'writer-threads' : '0',
+            ## Limit, in MiB, on the memory used by images waiting to
+            ## be saved.  Zero for no limit.
+            'queue-memory' : '0',
+            'queue-policy' : 'block',
+            'spill-file-size' : '4096',
+        },
+        'mosaic' : {
+            ## Limit, in MiB, on the video memory used by mosaic tile
+            ## textures.  Zero for no limit.
+            'texture-memory' : '1024',
+            ## Directory for the files holding mosaic tile images.
+            'store-dir' : os.path.join(_default_user_data_dir(), 'mosaic'),
+        },
+        'view' : {
+            ## Limit on the rate at which each camera view displays
+            ## new images.  Zero for no limit.
+            'max-fps' : '30',
+        },
     }
     return default
 
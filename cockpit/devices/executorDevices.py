@@ -103,10 +103,17 @@ class ExecutorDevice(device.Device):
         self.connection = None
         ## Set of all handlers we control.
         self.handlers = set()
+        ## Profiles derived from compiled actions, for devices that
+        # need to convert them, see getProfileKey.
+        self._profileCache = cockpit.handlers.executor.ProfileCache()
+        ## Key of the profile that the remote holds, or None if unknown.
+        self._uploadedProfileKey = None
 
     ## Connect to the DSP computer.
     @cockpit.util.threads.locked
     def initialize(self):
+        # A new connection may be to a remote that was restarted.
+        self._uploadedProfileKey = None
         self.connection = Pyro4.Proxy(self.uri)
         self.connection._pyroTimeout = 6
         self.connection.Abort()
@@ -125,6 +132,8 @@ class ExecutorDevice(device.Device):
     ## User clicked the abort button.
     def onAbort(self):
         self.connection.Abort()
+        # Don't rely on the remote still holding the last profile.
+        self._uploadedProfileKey = None
         # Various threads could be waiting for a 'DSP done' event, preventing
         # new DSP actions from starting after an abort.
         events.publish(events.EXECUTOR_DONE % self.name)
@@ -185,6 +194,18 @@ class ExecutorDevice(device.Device):
         self.connection.receiveClient(self.receiveUri)
 
 
+    ## Return the key under which to cache the profile for the given
+    # call to executeTable, or None if it can not be cached.  Tables
+    # compiled by ExecutorHandler.executeTable have a key that
+    # identifies their content; anything else the profile depends on
+    # must be passed as extra arguments.
+    def getProfileKey(self, table, startIndex, stopIndex, repDuration, *extra):
+        key = getattr(table, 'key', None)
+        if key is None:
+            return None
+        return (key, startIndex, stopIndex, repDuration) + extra
+
+
     ## Actually execute the events in an experiment ActionTable, starting at
     # startIndex and proceeding up to but not through stopIndex.
     def executeTable(self, table, startIndex, stopIndex, numReps, repDuration):
@@ -282,102 +303,97 @@ class LegacyDSP(ExecutorDevice):
     ## Actually execute the events in an experiment ActionTable, starting at
     # startIndex and proceeding up to but not through stopIndex.
     def executeTable(self, table, startIndex, stopIndex, numReps, repDuration):
-        # Take time and arguments (i.e. omit handler) from table to generate actions.
-        # For the UCSF m6x DSP device, we also need to:
+        # The profile depends on the analogue positions it is relative to,
+        # so only reuse it if those are the same.
+        key = self.getProfileKey(table, startIndex, stopIndex, repDuration,
+                                 tuple(self._lastAnalogs))
+        profile = None
+        if key is not None:
+            profile = self._profileCache.get(key)
+        if profile is None:
+            profile = self._makeProfile(*arrays_from_table(
+                table, startIndex, stopIndex, repDuration))
+            if key is not None:
+                self._profileCache.put(key, profile)
+        baselines, description, digitalsArr, analogsArr = profile
+
+        # Move to the baseline positions of the profile.
+        for line, (old, new) in enumerate(zip(self._lastAnalogs, baselines)):
+            if new != old:
+                self.setAnalog(line, new)
+        self._lastAnalogs = list(baselines)
+        self._lastDigital = description['InitDio']
+        self._lastProfile = (description, digitalsArr, analogsArr)
+
+        events.publish(events.UPDATE_STATUS_LIGHT, 'device waiting',
+                       'Waiting for DSP to finish')
+        try:
+            if key is None or key != self._uploadedProfileKey:
+                self._uploadedProfileKey = None
+                self.connection.profileSet(description, digitalsArr,
+                                           *analogsArr)
+                self.connection.DownloadProfile()
+                self._uploadedProfileKey = key
+            self.connection.InitProfile(numReps)
+            events.executeAndWaitFor(events.EXECUTOR_DONE % self.name,
+                                     self.connection.trigCollect)
+        except:
+            # We can't tell what state the remote was left in.
+            self._uploadedProfileKey = None
+            raise
+        events.publish(events.EXPERIMENT_EXECUTION)
+
+
+    ## Convert the times, digital and analogue states returned by
+    # arrays_from_table into a DSP profile.  Returns the baseline
+    # analogue positions that the profile is relative to, the profile
+    # description, and the digital and analogue profile arrays.
+    def _makeProfile(self, times, digital, analog):
+        # For the UCSF m6x DSP device, we need to:
         #  - make the analogue values offsets from the current position;
         #  - convert float in ms to integer clock ticks and ensure digital
         #    lines are not changed twice on the same tick;
         #  - separate analogue and digital events into different lists;
         #  - generate a structure that describes the profile.
 
-        actions = actions_from_table(table, startIndex, stopIndex, repDuration)
-
-        # Profiles
-        analogs = [ [], [], [], [] ] # A list of lists (one per channel) of tuples (ticks, (analog values))
-        digitals = [] # A list of tuples (ticks, digital state)
-        # Need to track time of last analog events to workaround a
-        # DSP bug later. Also used to detect when events exceed timing
-        # resolution
-        tLastA = None
-
-
         # The DSP executes an analogue movement profile, which is defined using
         # offsets relative to a baseline at the time the profile was initialized.
         # These offsets are encoded as unsigned integers, so at profile
         # intialization, each analogue channel must be at or below the lowest
         # value it needs to reach in the profile.
-        lowestAnalogs = list(np.amin([x[1][1] for x in actions], axis=0))
-        for line, lowest in enumerate(lowestAnalogs):
-            if lowest < self._lastAnalogs[line]:
-                self._lastAnalogs[line] = lowest
-                self.setAnalog(line, lowest)
-
-        for (t, (darg, aargs)) in actions:
-            # Convert t to ticks as int while rounding up. The rounding is
-            # necessary, otherwise e.g. 10.1 and 10.1999999... both result in 101.
-            ticks = int(float(t) * self.tickrate + 0.5)
-
-            # Digital actions - one at every time point.
-            if len(digitals) == 0:
-                digitals.append((ticks, darg))
-            elif ticks == digitals[-1][0]:
-                # Used to check for conflicts here, but that's not so trivial.
-                # We need to allow several bits to change at the same time point, but
-                # they may show up as multiple events in the actionTable. For now, just
-                # take the most recent state.
-                if darg != digitals[-1][1]:
-                    digitals[-1] = (ticks, darg)
-                else:
-                    pass
-            else:
-                digitals.append((ticks, darg))
-
-            # Analogue actions - only enter into profile on change.
-            # DSP uses offsets from value when the profile was loaded.
-            offsets = map(lambda base, new: new - base, self._lastAnalogs, aargs)
-            for offset, a in zip(offsets, analogs):
-                if ( (len(a) == 0 ) or (len(a) > 0 and offset != a[-1][1])):
-                    a.append((ticks, offset))
-                    tLastA = t
+        analog = analog[:, :len(self._lastAnalogs)]
+        baselines = [min(base, lowest) for base, lowest
+                     in zip(self._lastAnalogs, analog.min(axis=0).tolist())]
+
+        digitals, analogs, analogRows = tables_from_arrays(
+            times, digital, analog - baselines, self.tickrate)
 
         # Work around some DSP bugs:
         # * The action table needs at least two events to execute correctly.
         # * Last action must be digital --- if the last analog action is at the same
         #   time or after the last digital action, it will not be performed.
         # Both can be avoided by adding a digital action that does nothing.
-        if len(digitals) == 1 or tLastA >= digitals[-1][0]:
+        tLastA = times[analogRows.max()]
+        if len(digitals) == 1 or tLastA >= digitals[-1, 0]:
             # Just duplicate the last digital action, one tick later.
-            digitals.append( (digitals[-1][0]+1, digitals[-1][1]) )
-
-        # Update records of last positions.
-        self._lastDigital = digitals[-1][1]
-        self._lastAnalogs = list(map(lambda x, y: x - (y[-1:][1:] or 0), self._lastAnalogs, analogs))
-
-        events.publish(events.UPDATE_STATUS_LIGHT, 'device waiting',
-                       'Waiting for DSP to finish')
-        # Convert digitals to array of uints.
-        digitalsArr = np.array(digitals, dtype=np.uint32).reshape(-1,2)
-        # Convert analogs to array of uints.
-        analogsArr = [np.array(a, dtype=np.uint32).reshape(-1, 2) for a in analogs]
+            digitals = np.append(digitals, [[digitals[-1, 0] + 1,
+                                             digitals[-1, 1]]], axis=0)
 
+        # Convert to arrays of uints.
+        digitalsArr = digitals.astype(np.uint32)
+        analogsArr = [a.astype(np.uint32) for a in analogs]
 
         # Create a description dict. Will be byte-packed by server-side code.
-        maxticks = max(chain([d[0] for d in digitals],
-                             [a[0] for a in chain.from_iterable(analogs)]))
+        maxticks = max(chain([digitals[:, 0].max()],
+                             [a[:, 0].max() for a in analogs]))
         description = {}
-        description['count'] = maxticks
+        description['count'] = int(maxticks)
         description['clock'] = 1000. / float(self.tickrate)
-        description['InitDio'] = self._lastDigital
+        description['InitDio'] = int(digitals[-1, 1])
         description['nDigital'] = len(digitals)
         description['nAnalog'] = [len(a) for a in analogs]
 
-        self._lastProfile = (description, digitalsArr, analogsArr)
-
-        self.connection.profileSet(description, digitalsArr, *analogsArr)
-        self.connection.DownloadProfile()
-        self.connection.InitProfile(numReps)
-        events.executeAndWaitFor(events.EXECUTOR_DONE % self.name, self.connection.trigCollect)
-        events.publish(events.EXPERIMENT_EXECUTION)
+        return baselines, description, digitalsArr, analogsArr
 
 
 def actions_from_table(table, startIndex, stopIndex, repDuration):
@@ -395,3 +411,60 @@ def actions_from_table(table, startIndex, stopIndex, repDuration):
             ## Repeat the last event at t0 + repDuration
             actions.append((t0+repDuration,) + tuple(actions[-1][1:]))
     return actions
+
+
+## Take the times, digital and analogue states of the actions in a
+## table compiled by ExecutorHandler.executeTable, like
+## actions_from_table.  Returns times as float64, digital states as
+## uint32, and analogue states as a float64 array with one column per
+## line.
+def arrays_from_table(table, startIndex, stopIndex, repDuration):
+    if isinstance(table, cockpit.handlers.executor.CompiledActions):
+        times = table.times[startIndex:stopIndex]
+        digital = table.digital[startIndex:stopIndex]
+        analog = table.analog[startIndex:stopIndex]
+    else:
+        rows = table[startIndex:stopIndex]
+        times = np.array([float(row[0]) for row in rows], dtype=np.float64)
+        digital = np.array([row[1][0] for row in rows], dtype=np.uint32)
+        analog = np.array([row[1][1] for row in rows],
+                          dtype=np.float64).reshape(len(rows), -1)
+    t0 = times[0]
+    times = times - t0
+
+    ## If there are repeats, add an extra action to wait until
+    ## repDuration expired.
+    if repDuration is not None:
+        repDuration = float(repDuration)
+        if times[-1] < repDuration:
+            ## Repeat the last event at t0 + repDuration
+            times = np.append(times, t0 + repDuration)
+            digital = np.append(digital, digital[-1:])
+            analog = np.append(analog, analog[-1:], axis=0)
+    return times, digital, analog
+
+
+## Convert times in ms, with their digital and analogue states, into
+## tables of (ticks, value) at tickrate ticks per ms.  The digital
+## table has the last state at each tick, and there is one analogue
+## table per line with only the changes of level.  Values are
+## truncated to integers.  Also returns the indices of the actions
+## with an analogue change.
+def tables_from_arrays(times, digital, analog, tickrate):
+    # Convert t to ticks as int while rounding up. The rounding is
+    # necessary, otherwise e.g. 10.1 and 10.1999999... both result in 101.
+    ticks = (times * tickrate + 0.5).astype(np.int64)
+
+    # Digital actions - one at every time point.
+    isLast = np.ones(len(ticks), dtype=bool)
+    isLast[:-1] = ticks[1:] != ticks[:-1]
+    digitals = np.column_stack((ticks[isLast],
+                                digital[isLast].astype(np.int64)))
+
+    # Analogue actions - only enter into profile on change.
+    isChange = np.ones(analog.shape, dtype=bool)
+    isChange[1:] = analog[1:] != analog[:-1]
+    analogs = [np.column_stack((ticks[changed],
+                                levels[changed].astype(np.int64)))
+               for levels, changed in zip(analog.T, isChange.T)]
+    return digitals, analogs, np.flatnonzero(isChange.any(axis=1))
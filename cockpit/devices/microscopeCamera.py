@@ -22,7 +22,13 @@
 """MicroscopeCamera device.
 
   Supports cameras which implement the interface defined in
-  microscope.camera.Camera ."""
+  microscope.camera.Camera .
+
+  If the device server is on the same computer and supports it, the
+  images can be received through shared memory instead of being
+  copied through Pyro.  To do so, set the number of images to buffer
+  in shared memory with the ``sharedMemorySlots`` option.  See
+  cockpit.util.listener.SharedMemoryListener ."""
 
 import decimal
 import Pyro4
@@ -60,7 +66,20 @@ class MicroscopeCamera(MicroscopeBase, CameraDevice):
         # Parent class will connect to proxy
         super().initialize()
         # Lister to receive data
-        self.listener = cockpit.util.listener.Listener(self._proxy,
+        numSlots = int(self.config.get('sharedmemoryslots', 0))
+        if numSlots:
+            # Images go through shared memory if the device server is
+            # on this computer and supports it.  Make room for images
+            # of the whole sensor, with up to 16 bits per pixel.
+            try:
+                width, height = self._proxy.get_sensor_shape()
+            except AttributeError:
+                width, height = self.getImageSize(self.name)
+            self.listener = cockpit.util.listener.SharedMemoryListener(
+                self._proxy, lambda *args: self.receiveData(*args),
+                numSlots=numSlots, slotBytes=width * height * 2)
+        else:
+            self.listener = cockpit.util.listener.Listener(self._proxy,
                                                lambda *args: self.receiveData(*args))
         try:
             self.updateSettings()
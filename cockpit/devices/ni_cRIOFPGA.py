@@ -94,6 +94,8 @@ class NIcRIO(executorDevices.ExecutorDevice):
     def initialize(self):
         """Connect to ni's RT-ipAddress computer. Overrides ExecutorDevice's initialize.
         """
+        # A new connection may be to a cRIO that was restarted.
+        self._uploadedProfileKey = None
         self.connection = Connection(parent=self, ipAddress=self.ipAddress, port=self.port, localIp=MASTER_IP)
         self.connection.connect()
         self.connection.Abort()
@@ -155,62 +157,29 @@ class NIcRIO(executorDevices.ExecutorDevice):
         self.handlers = set(result)
         return result
 
-    def _adaptActions(self, actions):
-        """Adapt tha actions table to the cRIO. We have to:
+    def _adaptActions(self, times, digital, analog):
+        """Adapt the times, digital and analogue states returned by
+        executorDevices.arrays_from_table to the cRIO. We have to:
         - convert float in ms to integer clock ticks
         - separate analogue and digital events into different lists
         - generate a structure that describes the profile
         """
-        # Profiles
-        analogs = [[] for x in range(self.nrAnalogLines)]  # A list of lists (one per channel) of tuples (ticks, (analog values))
-        digitals = list()  # A list of tuples (ticks, digital state)
-        # # Need to track time of last analog events
-        # t_last_analog = None
-
-        for t, (digital_args, analog_args) in actions:
-            # Convert t to ticks as int while rounding up. The rounding is
-            # necessary, otherwise e.g. 10.1 and 10.1999999... both result in 101.
-            ticks = int(float(t) * self.tickrate + 0.5)
-
-            # Digital actions - one at every time point.
-            if len(digitals) == 0:
-                digitals.append((ticks, digital_args))
-            elif ticks == digitals[-1][0]:  # TODO: verify if we need this for the FPGA
-                # Used to check for conflicts here, but that's not so trivial.
-                # We need to allow several bits to change at the same time point, but
-                # they may show up as multiple events in the actionTable. For now, just
-                # take the most recent state.
-                if digital_args != digitals[-1][1]:
-                    digitals[-1] = (ticks, digital_args)
-                else:
-                    pass
-            else:
-                digitals.append((ticks, digital_args))
-
-            # Analogue actions - only enter into profile on change.
-            # NI-cRIO uses absolute values.
-            for analog, analog_arg in zip(analogs, analog_args):
-                if len(analog) == 0:  # analogs list is empty
-                    analog.append((ticks, analog_arg))
-                elif analog[-1][1] != analog_arg:
-                    analog.append((ticks, analog_arg))
-                else:
-                    pass
+        # NI-cRIO uses absolute values.
+        digitals, analogs, analogRows = executorDevices.tables_from_arrays(
+            times, digital, analog[:, :self.nrAnalogLines], self.tickrate)
 
         # Update records of last positions.
-        self._lastDigital = digitals[-1][1]
-        self._lastAnalogs = map(lambda x, y: x - (y[-1:][1:] or 0), self._lastAnalogs, analogs)
+        self._lastDigital = int(digitals[-1, 1])
 
-        # Convert digitals to array of uints.
-        digitalsArr = np.array(digitals, dtype=np.uint32).reshape(-1, 2)
-        # Convert analogs to array of uints.
-        analogsArr = [np.array(a, dtype=np.uint32).reshape(-1, 2) for a in analogs]
+        # Convert to arrays of uints.
+        digitalsArr = digitals.astype(np.uint32)
+        analogsArr = [a.astype(np.uint32) for a in analogs]
 
         # Create a description dict. Will be byte-packed by server-side code.
-        maxticks = max(chain([d[0] for d in digitals],
-                             [a[0] for a in chain.from_iterable(analogs)]))
+        maxticks = max(chain([digitals[:, 0].max()],
+                             [a[:, 0].max() for a in analogs]))
 
-        description = {'count': maxticks,
+        description = {'count': int(maxticks),
                        'clock': 1000. / float(self.tickrate),
                        'InitDio': self._lastDigital,
                        'nDigital': len(digitals),
@@ -220,11 +189,49 @@ class NIcRIO(executorDevices.ExecutorDevice):
 
         return [description, digitalsArr, [*analogsArr]]
 
+    def executeTable(self, table, startIndex, stopIndex, numReps, repDuration):
+        """Actually execute the events in an experiment ActionTable, starting at
+        startIndex and proceeding up to but not through stopIndex.
+
+        The tables are only uploaded if the cRIO does not hold them already,
+        which is the case when the same experiment is run again, e.g. on each
+        site of a multi-site experiment.
+        """
+        key = self.getProfileKey(table, startIndex, stopIndex, repDuration)
+        profile = None
+        if key is not None:
+            profile = self._profileCache.get(key)
+        if profile is None:
+            profile = self._adaptActions(*executorDevices.arrays_from_table(
+                table, startIndex, stopIndex, repDuration))
+            if key is not None:
+                self._profileCache.put(key, profile)
+        else:
+            self._lastDigital = profile[0]['InitDio']
+            self._lastProfile = (profile[0], profile[1], profile[2])
+
+        events.publish(events.UPDATE_STATUS_LIGHT, 'device waiting',
+                       'Waiting for cRIO to finish')
+        upload = key is None or key != self._uploadedProfileKey
+        self._uploadedProfileKey = None
+        try:
+            self.connection.PrepareActions(profile, numReps, upload=upload)
+            self._uploadedProfileKey = key
+            events.executeAndWaitFor(events.EXECUTOR_DONE % self.name,
+                                     self.connection.RunActions)
+        except:
+            # We can't tell what state the cRIO was left in.
+            self._uploadedProfileKey = None
+            raise
+        events.publish(events.EXPERIMENT_EXECUTION)
+
     @cockpit.util.threads.locked
     def runSequence(self, sequence):
         """Runs a sequence of times-digital pairs"""
         # Convert the times into ticks
         sequence = [(int(t * self.tickrate), d) for t, d in sequence]
+        # The sequence may overwrite the tables of the last profile.
+        self._uploadedProfileKey = None
         self.connection.runSequence(sequence)
 
     @cockpit.util.threads.locked
@@ -272,7 +279,9 @@ class Connection:
         # Starting with 4 are synchronous commands that can only operate when the
         # FPGA is idle.
         self.commandDict = {'sendDigitals': 100,
+                            'sendDigitalsBinary': 110,
                             'sendAnalogues': 200,
+                            'sendAnaloguesBinary': 210,
                             'abort': 301,
                             'reInit': 302,
                             'reInitHost': 303,
@@ -285,18 +294,22 @@ class Connection:
                             'writeDigitals': 410,
                             'writeAnalogue': 411,
                             'runSequence': 413,
+                            'getCapabilities': 414,
                             }
         self.errorCodes = {'0': None,
                            '1': 'Could not create socket',
                            '2': 'Could not create socket connection',
                            '3': 'Send error'}
         self.status = None
+        # Capabilities reported by the RT-ipAddress, see queryCapabilities
+        self.capabilities = set()
 
     def receiveClient(self, URI):
         pass
 
     def connect(self, timeout=40):
         self.connection = self.createSendSocket(self.ipAddress, self.port[0], timeout)
+        self.queryCapabilities()
         # server = depot.getHandlersOfType(depot.SERVER)[0]
         # Create a status instance to query the FPGA status and run it in a separate thread
         self.status = FPGAStatus(self, self.localIp, self.port[1])
@@ -328,6 +341,9 @@ class Connection:
 
         try:
             s.settimeout(timeout)
+            # Commands wait for a reply so don't let Nagle's algorithm
+            # hold back their last segment.
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             s.connect((host, port))
         except socket.error as msg:
             print('Failed to establish connection.\n', msg)
@@ -339,6 +355,23 @@ class Connection:
         """For debugging"""
         pass
 
+    def queryCapabilities(self):
+        """Asks the RT-ipAddress which optional features it supports.
+
+        The reply to the getCapabilities command has a 'capabilities' list
+        of strings. Older RT-ipAddress versions do not know the command and
+        reply with an error, in which case there are no capabilities.
+        Currently the only capability is 'binaryTables', see sendTables.
+
+        Returns the set of capabilities, which is also kept in self.capabilities
+        """
+        reply = self.runCommand(self.commandDict['getCapabilities'])
+        if reply and not reply.get('status'):
+            self.capabilities = set(reply.get('capabilities', []))
+        else:
+            self.capabilities = set()
+        return self.capabilities
+
     def runCommand(self, command, args=(), msgLength=20):
         """This method sends to the RT-ipAddress a Json command message in the following way
         - three numbers representing the command
@@ -353,6 +386,7 @@ class Connection:
 
         Return a Dictionary with the error description:
         Error Status, Error code and Error Description
+        or None if there was no valid reply
         """
         # Transform args into a list of strings of msgLength chars
         sendArgs = list()
@@ -366,22 +400,37 @@ class Connection:
             else:
                 sendArgs.append(str(arg).rjust(msgLength, '0'))
 
+        buf = str('').join(sendArgs).encode()
+        return self._exchange(command, msgLength, len(sendArgs), buf)
+
+    def runBinaryCommand(self, command, values):
+        """Like runCommand but sends the arguments as binary.
+
+        values is a numpy array that is sent as it is in memory, so it should
+        already have the type and byte order expected by the RT-ipAddress.
+        The message length is the size of each element in bytes.
+        """
+        values = np.ascontiguousarray(values)
+        return self._exchange(command, values.itemsize, values.size,
+                              memoryview(values).cast('B'))
+
+    def _exchange(self, command, msgLength, nMessages, buf):
+        """Sends a command cluster followed by its messages buffer and
+        returns the reply from the RT-ipAddress. See runCommand"""
         # Create a dictionary to be flattened and sent as json string
         messageCluster = {'Command': command,
                           'Message Length': msgLength,
-                          'Number of Messages': len(sendArgs)
+                          'Number of Messages': nMessages
                           }
 
         try:
             # Send the actual command
-            self.connection.send(json.dumps(messageCluster).encode())
-            self.connection.send(b'\r\n')
+            self.connection.sendall(json.dumps(messageCluster).encode() + b'\r\n')
         except socket.error as msg:
             print('Send messageCluster failed.\n', msg)
 
         try:
             # Send the actual messages buffer
-            buf = str('').join(sendArgs).encode()
             self.connection.sendall(buf)
         except socket.error as msg:
             print('Send buffer failed.\n', msg)
@@ -395,6 +444,7 @@ class Connection:
                 error = json.loads(datagram)
                 if error['status']:
                     print(f'There has been an FPGA error: {error}')
+                return error
             except:
                 print('We received a TCP error when confirming command.')
                 # errorLength.append(self.connection.recv(4096))
@@ -449,32 +499,30 @@ class Connection:
         Analogues lists must be ordered form 0 onward and without gaps. That is,
         (0), (0,1), (0,1,2) or (0,1,2,3). If a table is missing a dummy table must be introduced
         msgLength is an int indicating the length of every digital table element as a decimal string
-        """
-        # Convert the digitals numpy table into a list of messages for the TCP
-        digitalsList = list()
 
-        for t, value in digitalsTable:  # TODO: Change this into a more efficient code
-            digitalsValue = int(np.binary_repr(t, 32) + np.binary_repr(value, 32), 2)
-            digitalsList.append(digitalsValue)
+        If the RT-ipAddress has the 'binaryTables' capability, each table is
+        sent as a single buffer of little-endian uint64 instead of as decimal
+        strings, and msgLength is ignored.
+        """
+        binary = 'binaryTables' in self.capabilities
 
         # Send digitals after flushing the FPGA FIFOs
         self.runCommand(self.commandDict['flushFIFOs'])
-        self.runCommand(self.commandDict['sendDigitals'], digitalsList, msgLength)
+        digitals = packTable(digitalsTable)
+        if binary:
+            self.runBinaryCommand(self.commandDict['sendDigitalsBinary'], digitals)
+        else:
+            self.runCommand(self.commandDict['sendDigitals'], digitals.tolist(), msgLength)
 
         # Send Analogues
-        analogueChannel = 0
-        for analogueTable in analogueTables:
-
-            # Convert the analogues numpy table into a list of messages for the TCP
-            analogueList = list()
-
-            for t, value in analogueTable:  # TODO: optimize this
-                analogueValue = int(np.binary_repr(t, 32) + np.binary_repr(value, 32), 2)
-                analogueList.append(analogueValue)
-
-            command = int(self.commandDict['sendAnalogues']) + analogueChannel
-            self.runCommand(command, analogueList, msgLength)
-            analogueChannel = analogueChannel + 1
+        for analogueChannel, analogueTable in enumerate(analogueTables):
+            analogues = packTable(analogueTable)
+            if binary:
+                command = int(self.commandDict['sendAnaloguesBinary']) + analogueChannel
+                self.runBinaryCommand(command, analogues)
+            else:
+                command = int(self.commandDict['sendAnalogues']) + analogueChannel
+                self.runCommand(command, analogues.tolist(), msgLength)
 
     def writeIndexes(self, indexSet, digitalsStartIndex, digitalsStopIndex, analoguesStartIndexes, analoguesStopIndexes,
                      msgLength=20):
@@ -509,9 +557,16 @@ class Connection:
         # send indexes.
         self.runCommand(self.commandDict['sendStartStopIndexes'], sendList, msgLength)
 
-    def PrepareActions(self, actions, numReps):
+    def PrepareActions(self, actions, numReps, upload=True):
         """Sends a actions table to the cRIO and programs the execution of a number of repetitions.
-        It does not trigger the execution"""
+        It does not trigger the execution.
+
+        If upload is False, the cRIO already holds these tables from a
+        previous call, so only the number of repetitions is programmed."""
+        if not upload:
+            self.initProfile(numReps=numReps, repDuration=0)
+            return True
+
         # We upload the tables to the cRIO
         self.sendTables(digitalsTable=actions[1], analogueTables=actions[2])
 
@@ -649,6 +704,18 @@ class Connection:
         self.runCommand(self.commandDict['runSequence'], sendList, msgLength)
 
 
+def packTable(table):
+    """Packs a table of (ticks, value) pairs into little-endian uint64.
+
+    The ticks go in the 32 most significant bits and the value in the 32
+    least significant bits. Values are truncated to 32 bits.
+    """
+    table = np.asarray(table).reshape(-1, 2)
+    ticks = table[:, 0].astype(np.uint64)
+    values = table[:, 1].astype(np.int64).astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    return ((ticks << np.uint64(32)) | values).astype('<u8')
+
+
 class FPGAStatus(threading.Thread):
     def __init__(self, parent, host, port):
         threading.Thread.__init__(self)
@@ -22,6 +22,7 @@
 import collections
 import sys
 import threading
+import time
 import traceback
 import typing
 
@@ -36,6 +37,27 @@ instance used throughout the Cockpit program.  The module functions
 `publish`, `subscribe`, and `unsubscribe` are pass-through functions
 to this singleton.
 
+By default, subscribers are called in the thread that publishes the
+event, one after the other, so a slow subscriber holds up the
+publisher and the subscribers after it.  Subscribers that need not run
+straight away can instead be subscribed in one of these dispatch
+modes, each with its own worker thread:
+
+`QUEUED`
+    Events are queued, up to a limit, and the subscriber is called
+    with each of them in order.  Once the queue is full, the
+    overflow policy either blocks the publisher (`BLOCK`), drops the
+    new event (`DROP_NEWEST`) or drops the oldest queued event
+    (`DROP_OLDEST`).
+
+`LATEST`
+    Only the latest event is kept while the subscriber is busy.  An
+    optional key function of the event arguments keeps the latest
+    event of each key instead, for example of each stage axis.
+
+`getSubscriberStats` returns the number of events delivered to and
+dropped by each subscriber, and its latency.
+
 """
 
 ## Define common event strings here. This way, they're here for reference,
@@ -60,43 +82,255 @@ EXECUTOR_DONE = 'executor done %s' # must be sufficed with device/handler name
 VIDEO_MODE_TOGGLE = 'video mode toggle'
 
 
+## Dispatch modes of subscribers, see the module documentation.
+INLINE = 'inline'
+QUEUED = 'queued'
+LATEST = 'latest'
+
+## Overflow policies of QUEUED subscribers.
+BLOCK = 'block'
+DROP_NEWEST = 'drop newest'
+DROP_OLDEST = 'drop oldest'
+
+## Default limit on the number of events waiting for a subscriber.
+DEFAULT_MAX_QUEUE = 64
+
+
 _Subscriber = typing.Callable[..., None]
 
 
+class _Subscription:
+    """A subscriber to an event, called inline by the publisher.
+
+    Also keeps count of the events delivered to the subscriber, and of
+    their latency: the time from publication to the return of the
+    subscriber, which for inline subscribers is the time the subscriber
+    runs for.
+    """
+    mode = INLINE
+
+    def __init__(self, event: str, func: _Subscriber) -> None:
+        self.event = event
+        self.func = func
+        self._stats_lock = threading.Lock()
+        self._delivered = 0
+        self._dropped = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+        self._total_runtime = 0.0
+        self._max_runtime = 0.0
+
+    @property
+    def name(self) -> str:
+        return '%s.%s' % (getattr(self.func, '__module__', None),
+                          getattr(self.func, '__qualname__',
+                                  getattr(self.func, '__name__',
+                                          repr(self.func))))
+
+    def deliver(self, args, kwargs) -> None:
+        self._call(time.perf_counter(), args, kwargs)
+
+    def close(self) -> None:
+        pass
+
+    def pending(self) -> int:
+        return 0
+
+    def _call(self, published: float, args, kwargs) -> None:
+        start = time.perf_counter()
+        try:
+            self.func(*args, **kwargs)
+        except:
+            sys.stderr.write('Error in subscribed callable %s().  %s'
+                             % (self.name, traceback.format_exc()))
+        end = time.perf_counter()
+        with self._stats_lock:
+            self._delivered += 1
+            self._total_latency += end - published
+            self._max_latency = max(self._max_latency, end - published)
+            self._total_runtime += end - start
+            self._max_runtime = max(self._max_runtime, end - start)
+
+    def _drop(self) -> None:
+        with self._stats_lock:
+            self._dropped += 1
+
+    def get_stats(self) -> typing.Dict[str, typing.Any]:
+        with self._stats_lock:
+            delivered = self._delivered or 1
+            return {
+                'event': self.event,
+                'subscriber': self.name,
+                'mode': self.mode,
+                'delivered': self._delivered,
+                'dropped': self._dropped,
+                'pending': self.pending(),
+                'latency': (1000 * self._total_latency / delivered,
+                            1000 * self._max_latency),
+                'runtime': (1000 * self._total_runtime / delivered,
+                            1000 * self._max_runtime),
+            }
+
+
+class _WorkerSubscription(_Subscription):
+    """A subscriber called by its own worker thread, in QUEUED or
+    LATEST mode.
+    """
+    def __init__(self, event: str, func: _Subscriber, mode: str,
+                 max_queue: int, overflow: str,
+                 key: typing.Optional[typing.Callable[..., typing.Hashable]]
+                 ) -> None:
+        super().__init__(event, func)
+        self.mode = mode
+        self._max_queue = max_queue
+        self._overflow = overflow
+        self._key = key
+        self._condition = threading.Condition()
+        self._closed = False
+        ## Events waiting to be delivered, as (time published, args,
+        ## kwargs), in a deque for QUEUED and keyed by the key of
+        ## their arguments for LATEST.
+        if mode == LATEST:
+            self._queue = collections.OrderedDict()
+        else:
+            self._queue = collections.deque()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='events-%s' % self.name)
+        self._thread.start()
+
+    def deliver(self, args, kwargs) -> None:
+        item = (time.perf_counter(), args, kwargs)
+        key = None
+        if self.mode == LATEST and self._key is not None:
+            try:
+                key = self._key(*args, **kwargs)
+            except:
+                sys.stderr.write('Error in key of subscribed callable %s().'
+                                 '  %s' % (self.name, traceback.format_exc()))
+                self._drop()
+                return
+        with self._condition:
+            if self._closed:
+                return
+            if self.mode == LATEST:
+                if key in self._queue:
+                    del self._queue[key]
+                    self._drop()
+                elif len(self._queue) >= self._max_queue:
+                    self._queue.popitem(last=False)
+                    self._drop()
+                self._queue[key] = item
+            else:
+                while len(self._queue) >= self._max_queue:
+                    if self._overflow == DROP_NEWEST:
+                        self._drop()
+                        return
+                    elif self._overflow == DROP_OLDEST:
+                        self._queue.popleft()
+                        self._drop()
+                    else:
+                        self._condition.wait()
+                        if self._closed:
+                            return
+                self._queue.append(item)
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        """Stop the worker, discarding events not yet delivered."""
+        with self._condition:
+            self._closed = True
+            self._queue.clear()
+            self._condition.notify_all()
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._queue)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                if self.mode == LATEST:
+                    item = self._queue.popitem(last=False)[1]
+                else:
+                    item = self._queue.popleft()
+                # Wake publishers blocked on a full queue.
+                self._condition.notify_all()
+            self._call(*item)
+
+
 class Publisher:
     def __init__(self) -> None:
-        # type: typing.Dict[str, typing.List[_Subscriber]]
+        # type: typing.Dict[str, typing.List[_Subscription]]
         self._subscriptions = collections.defaultdict(list)
         self._lock = threading.Lock()
 
-    def subscribe(self, event: str, func: _Subscriber) -> None:
+    def subscribe(self, event: str, func: _Subscriber, mode: str = INLINE,
+                  maxQueue: int = DEFAULT_MAX_QUEUE, overflow: str = BLOCK,
+                  key: typing.Optional[typing.Callable[..., typing.Hashable]] = None
+                  ) -> None:
         """Subscribe callable to specified event.
 
         Args:
             event: event type/name (global constants in this module.)
             func: function to be called when the named event happens.
+            mode: how events are delivered to func: `INLINE`,
+                `QUEUED`, or `LATEST`.
+            maxQueue: limit on the number of events waiting for func,
+                in `QUEUED` and `LATEST` modes.
+            overflow: what to do with events once the queue is full in
+                `QUEUED` mode: `BLOCK`, `DROP_NEWEST` or `DROP_OLDEST`.
+            key: in `LATEST` mode, function of the event arguments
+                whose result identifies the events that replace each
+                other.  If None, all events replace each other.
         """
+        if mode == INLINE:
+            subscription = _Subscription(event, func)
+        elif mode in (QUEUED, LATEST):
+            if overflow not in (BLOCK, DROP_NEWEST, DROP_OLDEST):
+                raise ValueError('unknown overflow policy %r' % overflow)
+            if maxQueue < 1:
+                raise ValueError('maxQueue must be at least 1')
+            subscription = _WorkerSubscription(event, func, mode, maxQueue,
+                                               overflow, key)
+        else:
+            raise ValueError('unknown dispatch mode %r' % mode)
         with self._lock:
-            self._subscriptions[event].append(func)
+            self._subscriptions[event].append(subscription)
 
     def unsubscribe(self, event: str, func: _Subscriber) -> None:
         """Unsubscribe callable to specified event."""
         with self._lock:
-            try:
-                self._subscriptions[event].remove(func)
-            except ValueError:
-                pass # ignore func not in list error
+            subscriptions = self._subscriptions[event]
+            for i, subscription in enumerate(subscriptions):
+                if subscription.func == func:
+                    del subscriptions[i]
+                    subscription.close()
+                    break
 
     def publish(self, event: str, *args, **kwargs):
         """Call all functions subscribed to specific event with given arguments.
         """
-        for func in self._subscriptions[event]:
-            try:
-                func(*args, **kwargs)
-            except:
-                sys.stderr.write('Error in subscribed callable %s.%s().  %s'
-                                 % (func.__module__, func.__name__,
-                                    traceback.format_exc()))
+        for subscription in self._subscriptions[event]:
+            subscription.deliver(args, kwargs)
+
+    def getSubscriberStats(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Return the statistics of every subscriber.
+
+        Each is a dict of the 'event', the 'subscriber' name, its
+        dispatch 'mode', the number of events 'delivered' to it,
+        'dropped' by it and 'pending' for it, and the mean and maximum
+        'latency' from publication to the subscriber's return, and
+        'runtime' of the subscriber, in milliseconds.
+        """
+        with self._lock:
+            subscriptions = [subscription
+                             for subscriptions in self._subscriptions.values()
+                             for subscription in subscriptions]
+        return [subscription.get_stats() for subscription in subscriptions]
 
 
 class OneShotPublisher(Publisher):
@@ -104,9 +338,15 @@ class OneShotPublisher(Publisher):
 
     Like `Publisher`, except that the subscribers only care about the
     next event (i.e. they unsubscribe as soon as the event happens
-    once).
+    once).  Subscribers are always called inline.
 
     """
+    def subscribe(self, event: str, func: _Subscriber,
+                  mode: str = INLINE, **kwargs) -> None:
+        if mode != INLINE:
+            raise ValueError('one shot subscribers must be inline')
+        super().subscribe(event, func, mode, **kwargs)
+
     def publish(self, event: str, *args, **kwargs) -> None:
         try:
             super().publish(event, *args, **kwargs)
@@ -119,8 +359,8 @@ class OneShotPublisher(Publisher):
         with self._lock:
             for subscriptions in self._subscriptions.values():
                 for subscription in subscriptions:
-                    if hasattr(subscription, '__abort__'):
-                        subscription.__abort__()
+                    if hasattr(subscription.func, '__abort__'):
+                        subscription.func.__abort__()
             self._subscriptions.clear()
 
 
@@ -128,8 +368,9 @@ class OneShotPublisher(Publisher):
 _publisher = Publisher()
 _one_shot_publisher = OneShotPublisher()
 
-def subscribe(event: str, func: _Subscriber) -> None:
-    return _publisher.subscribe(event, func)
+def subscribe(event: str, func: _Subscriber, mode: str = INLINE,
+              **kwargs) -> None:
+    return _publisher.subscribe(event, func, mode, **kwargs)
 
 def unsubscribe(event: str, func: _Subscriber) -> None:
     return _publisher.unsubscribe(event, func)
@@ -141,6 +382,9 @@ def publish(event: str, *args, **kwargs) -> None:
 def oneShotSubscribe(event: str, func: _Subscriber):
     return _one_shot_publisher.subscribe(event, func)
 
+def getSubscriberStats() -> typing.List[typing.Dict[str, typing.Any]]:
+    return _publisher.getSubscriberStats()
+
 
 # Clear one-shot subscribers on abort.  Usually, these were subscribed
 # by executeAndWaitFor, which leaves the calling thread waiting for a
@@ -51,6 +51,10 @@
 
 
 import decimal
+import math
+import pickle
+
+import numpy
 
 ## This class represents the actions performed during an experiment.
 # Each action has a timestamp and the parameters for the action to be performed.
@@ -170,11 +174,40 @@ class ActionTable:
         return len(self.actions)
 
 
+    ## Return the actions from startIndex up to stopIndex as columns:
+    # an array of their times as float64, a list of handlers, an array
+    # with the index into that list of the handler of each action, and
+    # a list of parameters.
+    def getColumns(self, startIndex, stopIndex):
+        rows = self[startIndex:stopIndex]
+        handlers = []
+        handlerToCode = {}
+        codes = numpy.empty(len(rows), dtype=numpy.int32)
+        for i, (t, handler, parameter) in enumerate(rows):
+            code = handlerToCode.get(handler)
+            if code is None:
+                code = handlerToCode[handler] = len(handlers)
+                handlers.append(handler)
+            codes[i] = code
+        times = numpy.array([float(row[0]) for row in rows],
+                            dtype=numpy.float64)
+        return times, handlers, codes, [row[2] for row in rows]
+
+
+    ## Feed the actions from startIndex up to stopIndex to digest, a
+    # hashlib object.  Handlers are fed as describeHandler(handler), so
+    # that equal digests mean equal actions for whoever describes them.
+    def updateDigest(self, digest, startIndex, stopIndex, describeHandler):
+        rows = [(t, describeHandler(h), p)
+                for t, h, p in self[startIndex:stopIndex]]
+        _updateDigest(digest, rows)
+
+
     ## Generate pretty text for our table, optionally only for the specified
     # handler(s)
     def prettyString(self, handlers = []):
         result = ''
-        for event in self.actions:
+        for event in self:
             if event is None:
                 result += '<Deleted event>\n'
             else:
@@ -189,3 +222,328 @@ class ActionTable:
     def __repr__(self):
         return self.prettyString()
 
+
+
+## Number of integer ticks per millisecond used by ColumnarActionTable
+# to index action times (i.e. picosecond resolution).  Times which
+# differ by less than one tick are still ordered correctly by sort(),
+# but are otherwise treated as simultaneous, in the order they were
+# added.
+TICKS_PER_MS = 10**9
+
+
+## Convert an array of times in milliseconds to integer ticks.
+# Rounding down keeps tick order consistent with the order of the
+# exact times.
+def _toTicks(times):
+    ticks = numpy.asarray(times, dtype=numpy.float64) * TICKS_PER_MS
+    return numpy.floor(ticks).astype(numpy.int64)
+
+
+## Return a 1D object array of the values in a list.  Assigning a list
+# of Decimals to an object array is slow, as NumPy checks whether each
+# one is a sequence, so use fromiter where NumPy supports it (1.23 on).
+def _objectArray(values):
+    try:
+        return numpy.fromiter(values, dtype=object, count=len(values))
+    except ValueError:
+        result = numpy.empty(len(values), dtype=object)
+        result[:] = values
+        return result
+
+
+## An ActionTable that keeps its actions in NumPy columns instead of a
+# list of tuples.  It has the same API as ActionTable and can be used
+# as a drop-in replacement for it.
+#
+# Each action is stored as a row over four columns: its exact time (as
+# given to addAction), the same time as integer ticks, an integer code
+# identifying its handler, and its parameter.  New actions are first
+# appended to Python lists which are moved into the NumPy columns the
+# next time the whole table is operated on, so sorting and time shifts
+# are vectorised and happen once for the whole table.  The last action
+# of each handler is tracked as actions are added, so
+# getLastActionFor does not need to search the table.
+class ColumnarActionTable(ActionTable):
+    ## Code used in the handler column for rows that were set to None.
+    _DELETED = -1
+
+    def __init__(self):
+        super().__init__()
+        ## Exact times, as given to addAction.
+        self._times = numpy.empty(0, dtype=object)
+        ## Times in ticks, see TICKS_PER_MS.
+        self._ticks = numpy.empty(0, dtype=numpy.int64)
+        ## Index into self._handlers, or _DELETED.
+        self._codes = numpy.empty(0, dtype=numpy.int32)
+        ## Times and codes of actions not yet moved into the columns.
+        self._newTimes = []
+        self._newCodes = []
+        ## Action parameters, for all rows.
+        self._params = []
+        ## List of handlers in the table, indexed by their code.
+        self._handlers = []
+        ## Maps handlers to their code.
+        self._handlerToCode = {}
+        ## Maps handler codes to the (row, time) of their last action,
+        # or None if it needs to be rebuilt.
+        self._lastRows = {}
+
+
+    ## There is no list of tuples backing this table so generate one.
+    # This is provided for compatibility only, modifying the returned
+    # list does not modify the table.
+    @property
+    def actions(self):
+        return list(self)
+
+    @actions.setter
+    def actions(self, actions):
+        # Called by ActionTable.__init__, which sets it to an empty
+        # list.  Only accept that case.
+        if actions:
+            raise RuntimeError("ColumnarActionTable.actions is read-only")
+
+
+    def _getCode(self, handler):
+        code = self._handlerToCode.get(handler)
+        if code is None:
+            code = len(self._handlers)
+            self._handlers.append(handler)
+            self._handlerToCode[handler] = code
+        return code
+
+
+    ## Move newly added actions into the NumPy columns.
+    def _flush(self):
+        if not self._newTimes:
+            return
+        newTimes = _objectArray(self._newTimes)
+        self._times = numpy.concatenate((self._times, newTimes))
+        self._ticks = numpy.concatenate((self._ticks, _toTicks(newTimes)))
+        self._codes = numpy.concatenate(
+            (self._codes, numpy.array(self._newCodes, dtype=numpy.int32)))
+        self._newTimes = []
+        self._newCodes = []
+
+
+    ## Insert an element into the table.
+    def addAction(self, time, handler, parameter):
+        code = self._handlerToCode.get(handler)
+        if code is None:
+            code = self._getCode(handler)
+        if self._lastRows is not None:
+            self._lastRows[code] = (len(self._params), time)
+        self._newTimes.append(time)
+        self._newCodes.append(code)
+        self._params.append(parameter)
+        if self.firstActionTime is None or self.firstActionTime > time:
+            self.firstActionTime = time
+        if self.lastActionTime is None or self.lastActionTime < time:
+            self.lastActionTime = time
+        return time
+
+
+    ## Find the last row of each handler, after the table has been
+    # modified in a way that may have changed them.
+    def _buildLastRows(self):
+        self._flush()
+        self._lastRows = {}
+        order = numpy.argsort(self._codes, kind='stable')
+        order = order[self._codes[order] != self._DELETED]
+        if not len(order):
+            return
+        sortedCodes = self._codes[order]
+        isLast = numpy.append(sortedCodes[1:] != sortedCodes[:-1], True)
+        for row in order[isLast].tolist():
+            self._lastRows[int(self._codes[row])] = (row, self._times[row])
+
+
+    ## Retrieve the last time and action we performed with the specified
+    # handler.  As with ActionTable, this is the last one in the table,
+    # which is only the latest once the table has been sorted.
+    def getLastActionFor(self, handler):
+        code = self._handlerToCode.get(handler)
+        if code is None:
+            return None, None
+        if self._lastRows is None:
+            self._buildLastRows()
+        last = self._lastRows.get(code)
+        if last is None:
+            return None, None
+        return last[1], self._params[last[0]]
+
+
+    ## Keep only the given rows, in the given order.
+    def _take(self, rows):
+        self._times = self._times[rows]
+        self._ticks = self._ticks[rows]
+        self._codes = self._codes[rows]
+        self._params = [self._params[i] for i in rows]
+        self._lastRows = None
+
+
+    ## Sort all the actions in the table by time.  The sort is stable.
+    def sort(self):
+        self._flush()
+        if len(self._ticks) < 2:
+            return
+        order = numpy.argsort(self._ticks, kind='stable')
+        ## Rows in the same tick only need to be reordered by their
+        # exact time if those differ.  Exact times are ordered like
+        # their ticks, so the rows of all such ticks are sorted by
+        # exact time at once, and put back in the places of those ticks.
+        sortedTicks = self._ticks[order]
+        sortedTimes = self._times[order]
+        unordered = ((sortedTicks[1:] == sortedTicks[:-1])
+                     & (sortedTimes[1:] != sortedTimes[:-1]))
+        if unordered.any():
+            places = numpy.flatnonzero(
+                numpy.isin(sortedTicks, sortedTicks[1:][unordered]))
+            order[places] = sorted(order[places].tolist(),
+                                   key=self._times.__getitem__)
+        if numpy.any(order[1:] < order[:-1]):
+            self._take(order)
+
+
+    ## Clear invalid entries from the table.
+    def clearBadEntries(self):
+        self._flush()
+        keep = numpy.flatnonzero(self._codes != self._DELETED)
+        if len(keep) != len(self._codes):
+            self._take(keep)
+
+
+    ## Add delta to the time of the rows selected by mask.
+    def _shiftRows(self, mask, delta):
+        self._times[mask] += delta
+        deltaTicks = delta * TICKS_PER_MS
+        if deltaTicks == int(deltaTicks):
+            self._ticks[mask] += int(deltaTicks)
+        else:
+            self._ticks[mask] = _toTicks(self._times[mask])
+        self._lastRows = None
+
+
+    ## Go through the table and ensure all timepoints are positive.
+    # Unlike ActionTable, this does not require the table to have been
+    # sorted.
+    def enforcePositiveTimepoints(self):
+        self._flush()
+        valid = self._codes != self._DELETED
+        if not numpy.any(valid):
+            return
+        delta = -min(self._times[valid])
+        if delta < 0:
+            # First event is at a positive time, so we're good to go.
+            return
+        self._shiftRows(valid, delta)
+        self.firstActionTime += delta
+        self.lastActionTime += delta
+
+
+    ## Move all actions after the specified time back by the given offset,
+    # to make room for some new action.
+    def shiftActionsBack(self, markTime, delta):
+        self._flush()
+        markTick = _toTicks([markTime])[0]
+        valid = self._codes != self._DELETED
+        mask = valid & (self._ticks > markTick)
+        ## Rows in the same tick as markTime need an exact comparison.
+        for row in numpy.flatnonzero(valid & (self._ticks == markTick)):
+            mask[row] = self._times[row] >= markTime
+        if numpy.any(mask):
+            self._shiftRows(mask, delta)
+        if self.firstActionTime > markTime:
+            self.firstActionTime += delta
+        if self.lastActionTime > markTime:
+            self.lastActionTime += delta
+
+
+    ## Return the time of the first and last action we have.
+    # Use our cached values if allowed.
+    def getFirstAndLastActionTimes(self, canUseCache = True):
+        if canUseCache:
+            return self.firstActionTime, self.lastActionTime
+        self._flush()
+        times = self._times[self._codes != self._DELETED]
+        if not len(times):
+            return None, None
+        return min(times), max(times)
+
+
+    def _getRow(self, index):
+        code = self._codes[index]
+        if code == self._DELETED:
+            return None
+        return (self._times[index], self._handlers[code], self._params[index])
+
+
+    ## Access an element, or a slice of elements, in the table.
+    def __getitem__(self, index):
+        self._flush()
+        if isinstance(index, slice):
+            return [self._getRow(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("action table index out of range")
+        return self._getRow(index)
+
+
+    ## Modify an item in the table.  Setting it to None marks it for
+    # removal by clearBadEntries().
+    def __setitem__(self, index, val):
+        self._flush()
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("action table index out of range")
+        if val is None:
+            self._codes[index] = self._DELETED
+        else:
+            time, handler, parameter = val
+            self._times[index] = time
+            self._ticks[index] = _toTicks([time])[0]
+            self._codes[index] = self._getCode(handler)
+            self._params[index] = parameter
+        self._lastRows = None
+
+
+    def __iter__(self):
+        self._flush()
+        for i in range(len(self)):
+            yield self._getRow(i)
+
+
+    def getColumns(self, startIndex, stopIndex):
+        self._flush()
+        return (self._times[startIndex:stopIndex].astype(numpy.float64),
+                list(self._handlers), self._codes[startIndex:stopIndex],
+                self._params[startIndex:stopIndex])
+
+
+    ## Like ActionTable.updateDigest, but hashes the columns directly.
+    # Times are hashed as ticks, so actions less than one tick apart
+    # hash the same.
+    def updateDigest(self, digest, startIndex, stopIndex, describeHandler):
+        self._flush()
+        _updateDigest(digest, [describeHandler(h) for h in self._handlers])
+        digest.update(self._ticks[startIndex:stopIndex].tobytes())
+        digest.update(self._codes[startIndex:stopIndex].tobytes())
+        _updateDigest(digest, self._params[startIndex:stopIndex])
+
+
+    ## Get the length of the table.
+    def __len__(self):
+        return len(self._params)
+
+
+## Feed a list of Python objects to a hashlib object.
+def _updateDigest(digest, values):
+    try:
+        data = pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        # Not everything can be pickled, e.g. handlers.
+        data = repr(values).encode()
+    digest.update(data)
@@ -55,10 +55,12 @@ from cockpit import depot
 from cockpit import events
 import cockpit.util.datadoc
 import cockpit.util.logger
-import cockpit.util.threads
 
+import collections
+import concurrent.futures
 import numpy
-import queue
+import os
+import tempfile
 import threading
 import time
 
@@ -66,6 +68,28 @@ import time
 ## Unique ID for identifying saver instances
 uniqueID = 0
 
+## Layout of one plane's worth of metadata in the extended header.  See
+# DataSaver.writeImage for the meaning of each field.
+EXTENDED_HEADER_DTYPE = numpy.dtype([('ints', '<i4', (8,)),
+                                     ('floats', '<f4', (32,))])
+
+## When writing planes in parallel, the number of planes to collect
+# before writing their metadata into the extended header.
+EXTENDED_HEADER_BATCH_SIZE = 256
+
+## Flag set on the first integer of a plane's extended header
+# metadata if the image for that plane was dropped (see ImageQueue).
+PLANE_DROPPED = 1
+
+## What to do with new images when the images waiting to be saved use
+# all the memory allowed: block the thread publishing the image until
+# there is memory; copy it to a temporary file and read it back later;
+# or drop it, leaving a blank plane in the file.
+QUEUE_BLOCK = 'block'
+QUEUE_SPILL = 'spill'
+QUEUE_DROP = 'drop'
+QUEUE_POLICIES = (QUEUE_BLOCK, QUEUE_SPILL, QUEUE_DROP)
+
 
 ## This class simply records all data received during an experiment and saves
 # it to disk in MRC format.
@@ -86,9 +110,26 @@ class DataSaver:
     #        and there can be up to 10 of them.
     # \param cameraToExcitation Maps camera handlers to the excitation
     #        wavelength used to generate the images it will acquire.
+    # \param numWriterThreads Number of threads writing image planes
+    #        to disk.  If zero, images are written one at a time by the
+    #        thread reading the image queue.  Otherwise, the files are
+    #        preallocated and the planes written in parallel (see
+    #        writePlane).
+    # \param maxQueueBytes Maximum number of bytes used by images that
+    #        have been received but not yet saved, or None for no limit.
+    # \param queuePolicy What to do with images received when that
+    #        limit is reached.  One of QUEUE_POLICIES.
+    # \param spillBytes Size of the temporary file used for images
+    #        when queuePolicy is QUEUE_SPILL.
+    # \param planeIndexMap Function mapping the index of each image kept
+    #        from a camera in a single repeat, i.e., in order of
+    #        acquisition, to the Z index where it should be saved.  If
+    #        None, images are saved in order of acquisition.
     def __init__(self, cameras, numReps, cameraToImagesPerRep,
                  cameraToIgnoredImageIndices, runThread, savePath, pixelSizeZ,
-                 titles, cameraToExcitation):
+                 titles, cameraToExcitation, numWriterThreads=0,
+                 maxQueueBytes=None, queuePolicy=QUEUE_BLOCK,
+                 spillBytes=2**32, planeIndexMap=None):
         self.cameras = cameras
         self.numReps = numReps
         self.cameraToImagesPerRep = cameraToImagesPerRep
@@ -103,6 +144,8 @@ class DataSaver:
         ## limitation of the cockpit interface.
         self.cameraToExcitation = cameraToExcitation
 
+        self.planeIndexMap = planeIndexMap
+
         ## Maximum size, in megabytes, of each file generated.  If the
         # experiment data exceeds this, then a new file will be opened, and
         # each file will have a suffix appended to it (e.g.  ".001", ".002",
@@ -272,16 +315,30 @@ class DataSaver:
             with self.fileLocks[i]:
                 cockpit.util.datadoc.writeMrcHeader(self.headers[i], handle)
 
+        ## Number of threads writing planes, zero if writing serially.
+        self.numWriterThreads = numWriterThreads
+        ## Pool of threads writing planes, if writing in parallel.
+        self.writerPool = None
+        if self.numWriterThreads:
+            self.prepareParallelWriting()
+
         ## List of how many images we've received, on a per-camera basis.
         self.imagesReceived = [0] * len(self.cameras)
         ## List of how many images we've written, on a per-camera basis.
         self.imagesKept = [0] * len(self.cameras)
+        ## List of how many images have been given a plane, on a
+        # per-camera basis.  When writing in parallel, this is ahead of
+        # self.imagesKept by the planes still being written.
+        self.imagesPlaced = [0] * len(self.cameras)
         ## List of functions that receive image data and feed it into
         # self.imagesReceived.
         self.lambdas = []
         ## List of (min, max) tuples, on a per-camera basis, tracking
         # the dimmest and brightest pixels.
         self.minMaxVals = []
+        ## Lock on updating self.minMaxVals and the extended headers,
+        # when writing planes in parallel.
+        self.statsLock = threading.Lock()
 
         ## True if we should stop collecting data.
         self.shouldAbort = False
@@ -289,7 +346,10 @@ class DataSaver:
         self.amDone = False
         ## Queue of (camera index, image data, timestamp) tuples for images
         # that need to be saved
-        self.imageQueue = queue.Queue()
+        self.imageQueue = ImageQueue(maxQueueBytes, queuePolicy, spillBytes)
+        ## List of (file index, plane index) tuples for the planes whose
+        # image was dropped.
+        self.droppedPlanes = []
 
         # Use dye name if available, otherwise use camera name.
         names = [camera.dye or camera.name for camera in self.cameras]
@@ -297,10 +357,51 @@ class DataSaver:
         for camera in self.cameras:
             totals.append(self.cameraToImagesKeptPerRep[camera] * self.numReps)
         ## Thread that handles updating the UI.
-        self.statusThread = StatusUpdateThread(names, totals)
-
-        # Start the data-saving thread.
-        self.saveData()
+        if maxQueueBytes is None:
+            self.statusThread = StatusUpdateThread(names, totals)
+        else:
+            self.statusThread = StatusUpdateThread(names, totals, queuePolicy)
+
+        # Start the data-saving thread.  It is joined once we are done,
+        # so that no image is handed to the writers or written after
+        # the files are finished.
+        self.saveThread = threading.Thread(target=self.saveData,
+                                           name='saveData', daemon=True)
+        self.saveThread.start()
+
+
+    ## Preallocate the files and start the threads to write planes in
+    # parallel.  The extended headers are kept in memory, and written
+    # to disk in batches instead of with each plane.
+    def prepareParallelWriting(self):
+        ## Extended header for each file.
+        self.extendedHeaders = []
+        ## Range of planes, as [first, last], on each extended header
+        # that have changed since it was last written to disk, or
+        # None if there are no changes.
+        self.dirtyPlanes = []
+        ## Number of planes whose metadata has changed since each
+        # extended header was last written to disk.
+        self.numDirtyPlanes = []
+        for header, handle in zip(self.headers, self.filehandles):
+            numPlanes = int(header.next) // self.extendedBytes
+            extendedHeader = numpy.zeros(numPlanes, dtype=EXTENDED_HEADER_DTYPE)
+            extendedHeader['floats'][:, 12] = 1.0 # intensity scaling
+            self.extendedHeaders.append(extendedHeader)
+            self.dirtyPlanes.append(None)
+            self.numDirtyPlanes.append(0)
+            preallocateFile(handle, (1024 + int(header.next)
+                                     + numPlanes * self.planeBytes))
+        ## Per-thread buffer for padding images smaller than the planes.
+        self.writerBuffers = threading.local()
+        self.writerPool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.numWriterThreads,
+            thread_name_prefix="DataSaver-writer")
+        ## Limit on the number of images handed to the writer threads
+        # and not yet written.  Images still waiting on the image queue
+        # are accounted for by its memory limit, but not once they are
+        # handed over.
+        self.writerSlots = threading.Semaphore(2 * self.numWriterThreads)
 
 
     ## Subscribe to the new-camera-image events for the cameras we care about.
@@ -323,6 +424,7 @@ class DataSaver:
     def onAbort(self):
         self.shouldAbort = True
         self.statusThread.shouldStop = True
+        self.imageQueue.abort()
 
 
     ## Wait for the runThread to finish, then wait a bit longer in case some
@@ -352,6 +454,44 @@ class DataSaver:
         self.amDone = True
 
         self.cleanup()
+        self.imageQueue.close()
+        self.saveThread.join()
+
+        if self.writerPool is not None:
+            # Wait for the planes already handed out to be written,
+            # then write the metadata that has not been written yet.
+            self.writerPool.shutdown(wait=True)
+            for i in range(len(self.filehandles)):
+                self.flushExtendedHeader(i)
+        elif self.droppedPlanes or self.planeIndexMap is not None:
+            # Planes are only written when they arrive so, if the last
+            # planes in the file were dropped or never acquired, extend
+            # the files to their full size.
+            for header, handle in zip(self.headers, self.filehandles):
+                numPlanes = int(header.next) // self.extendedBytes
+                size = 1024 + int(header.next) + numPlanes * self.planeBytes
+                handle.seek(0, os.SEEK_END)
+                if handle.tell() < size:
+                    handle.truncate(size)
+
+        if self.droppedPlanes:
+            cockpit.util.logger.log.error(
+                "Dropped %d images because saving could not keep up."
+                " Missing (file index, plane index): %s",
+                len(self.droppedPlanes), sorted(self.droppedPlanes))
+        if self.imageQueue.maxBytes is not None:
+            # Record how the image queue was configured and what it
+            # had to do, in the first free title.  Which planes were
+            # dropped is recorded in the extended header.
+            summary = ("Image queue: %s policy, %d MB; %d spilled, %d dropped"
+                       % (self.imageQueue.policy,
+                          self.imageQueue.maxBytes // 2**20,
+                          self.imageQueue.numSpilled,
+                          len(self.droppedPlanes)))
+            for header in self.headers:
+                if header.NumTitles < 10:
+                    header.title[header.NumTitles] = summary
+                    header.NumTitles += 1
 
         # Determine min/max vals for each wavelength.
         for header in self.headers:
@@ -385,17 +525,21 @@ class DataSaver:
 
     ## Receive new data, and add it to the queue.
     def onImage(self, cameraIndex, imageData, timestamp):
-        self.imageQueue.put((cameraIndex, imageData, timestamp))
+        if self.imageQueue.put(cameraIndex, imageData, timestamp) == QUEUE_SPILL:
+            self.statusThread.imageSpilled(cameraIndex)
 
 
-    ## Continually poll our imageQueue and save data to the file.
-    @cockpit.util.threads.callInNewThread
+    ## Continually poll our imageQueue and save data to the file, until
+    # the queue is closed.
     def saveData(self):
         while not self.amDone:
             if self.shouldAbort:
                 # Do nothing.
                 return
-            cameraIndex, imageData, timestamp = self.imageQueue.get()
+            item = self.imageQueue.get()
+            if item is None:
+                return
+            cameraIndex, imageData, timestamp = item
             if self.firstTimestamp is None:
                 self.firstTimestamp = timestamp
             # Store the timestamp as a rebased 32-bit float; we can't use
@@ -403,7 +547,13 @@ class DataSaver:
             # rebase then the numbers are big enough that we lose decimal
             # precision.
             timestamp = timestamp - self.firstTimestamp
-            self.writeImage(cameraIndex, imageData, timestamp)
+            if self.writerPool is not None:
+                # The image's memory is released by writePlane.
+                self.writerSlots.acquire()
+                self.writeImage(cameraIndex, imageData, timestamp)
+            else:
+                self.writeImage(cameraIndex, imageData, timestamp)
+                self.imageQueue.release(imageData)
 
 
     ## Write a single image to the file.
@@ -415,18 +565,24 @@ class DataSaver:
              % self.cameraToImagesPerRep[camera])
             in self.cameraToIgnoredImageIndices[camera]):
             # This image is one that should be discarded.
+            if self.writerPool is not None:
+                self.writerSlots.release()
+                self.imageQueue.release(imageData)
             return
 
         # Calculate the time and Z indices for the new image. This will in turn
         # help us to calculate which file to write to and the offset of the
         # image in the file.
-        numImages = self.imagesKept[cameraIndex]
+        numImages = self.imagesPlaced[cameraIndex]
+        self.imagesPlaced[cameraIndex] += 1
         timepoint = numImages // self.maxImagesPerRep
         fileIndex = timepoint // self.maxRepsPerFile
         # Rebase the timepoint to be relative to the beginning of this specific
         # file.
         timepoint -= fileIndex * self.maxRepsPerFile
         zIndex = numImages % self.cameraToImagesKeptPerRep[camera]
+        if self.planeIndexMap is not None:
+            zIndex = self.planeIndexMap(zIndex)
 
         numCameras = len(self.cameras)
         planeIndex = (int(timepoint * self.maxImagesPerRep * numCameras)
@@ -439,6 +595,20 @@ class DataSaver:
         dataOffset = (1024 + int(self.headers[fileIndex].next)
                       + (planeIndex * self.planeBytes))
 
+        if imageData is None:
+            self.recordDroppedImage(fileIndex, planeIndex, cameraIndex,
+                                    timestamp)
+            return
+
+        if self.writerPool is not None:
+            # Hand the image over to the writer threads, which count it
+            # as kept once it is written.
+            future = self.writerPool.submit(self.writePlane, fileIndex,
+                                            planeIndex, cameraIndex,
+                                            imageData, timestamp)
+            future.add_done_callback(self.onPlaneWritten)
+            return
+
         height, width = imageData.shape
 
         # Pad with zeros. I wouldn't normally think this would be
@@ -519,21 +689,409 @@ class DataSaver:
         self.statusThread.newImage(cameraIndex)
 
 
+    ## Record that the image for a plane was dropped by the image
+    # queue.  The plane is left blank and flagged as dropped in the
+    # extended header.
+    def recordDroppedImage(self, fileIndex, planeIndex, cameraIndex,
+                           timestamp):
+        self.droppedPlanes.append((fileIndex, planeIndex))
+        if self.writerPool is not None:
+            with self.statsLock:
+                self.imagesKept[cameraIndex] += 1
+                self.lastImageTime = time.time()
+                metadata = self.extendedHeaders[fileIndex][planeIndex]
+                metadata['ints'][0] = PLANE_DROPPED
+                metadata['floats'][1] = timestamp
+                self.markDirty(fileIndex, planeIndex)
+            self.writerSlots.release()
+        else:
+            self.imagesKept[cameraIndex] += 1
+            self.lastImageTime = time.time()
+            metadataOffset = 1024 + (planeIndex * self.extendedBytes)
+            with self.fileLocks[fileIndex]:
+                handle = self.filehandles[fileIndex]
+                intMetadataBuffer = numpy.zeros_like(
+                    self.intMetadataBuffers[fileIndex])
+                intMetadataBuffer[0] = PLANE_DROPPED
+                floatMetadataBuffer = self.floatMetadataBuffers[fileIndex]
+                floatMetadataBuffer[1] = timestamp
+                floatMetadataBuffer[5:7] = 0 # no min and max intensity
+                handle.seek(metadataOffset)
+                handle.write(intMetadataBuffer)
+                handle.write(floatMetadataBuffer)
+        self.statusThread.imageDropped(cameraIndex)
+
+
+    ## Write a single image to its place in the preallocated file.  This
+    # is called from the writer threads, in no particular order.
+    def writePlane(self, fileIndex, planeIndex, cameraIndex, imageData,
+                   timestamp):
+        try:
+            self._writePlane(fileIndex, planeIndex, cameraIndex, imageData,
+                             timestamp)
+        finally:
+            self.imageQueue.release(imageData)
+            self.writerSlots.release()
+
+
+    def _writePlane(self, fileIndex, planeIndex, cameraIndex, imageData,
+                    timestamp):
+        camera = self.indexToCamera[cameraIndex]
+        imageMin = imageData.min()
+        imageMax = imageData.max()
+
+        height, width = imageData.shape
+        if ((height, width) == (self.maxHeight, self.maxWidth)
+            and imageData.dtype == numpy.uint16
+            and imageData.flags.c_contiguous):
+            planeData = imageData
+        else:
+            # Pad with zeros, on a buffer that is reused by this thread
+            # for all of its planes.
+            planeData = getattr(self.writerBuffers, 'plane', None)
+            if planeData is None:
+                planeData = numpy.empty((self.maxHeight, self.maxWidth),
+                                        dtype=numpy.uint16)
+                self.writerBuffers.plane = planeData
+            planeData[:height, :width] = imageData
+            planeData[:height, width:] = 0
+            planeData[height:, :] = 0
+
+        dataOffset = (1024 + int(self.headers[fileIndex].next)
+                      + (planeIndex * self.planeBytes))
+        writeAt(self.filehandles[fileIndex], self.fileLocks[fileIndex],
+                planeData, dataOffset)
+
+        with self.statsLock:
+            metadata = self.extendedHeaders[fileIndex][planeIndex]
+            metadata['floats'][1] = timestamp
+            metadata['floats'][5] = imageMin
+            metadata['floats'][6] = imageMax
+            metadata['floats'][10] = self.cameraToExcitation[camera]
+            metadata['floats'][11] = camera.wavelength
+            doFlush = self.markDirty(fileIndex, planeIndex)
+
+            curMin, curMax = self.minMaxVals[cameraIndex]
+            self.minMaxVals[cameraIndex] = (min(curMin, imageMin),
+                                            max(curMax, imageMax))
+            self.imagesKept[cameraIndex] += 1
+            self.lastImageTime = time.time()
+
+        if doFlush:
+            self.flushExtendedHeader(fileIndex)
+
+        if self.shouldAbort or self.amDone:
+            return
+        self.statusThread.newImage(cameraIndex)
+
+
+    ## Mark a plane's metadata as not yet written to disk.  Returns
+    # whether enough planes have changed that the extended header
+    # should be written.  Must be called with statsLock held.
+    def markDirty(self, fileIndex, planeIndex):
+        dirty = self.dirtyPlanes[fileIndex]
+        if dirty is None:
+            self.dirtyPlanes[fileIndex] = [planeIndex, planeIndex]
+        else:
+            dirty[0] = min(dirty[0], planeIndex)
+            dirty[1] = max(dirty[1], planeIndex)
+        self.numDirtyPlanes[fileIndex] += 1
+        return self.numDirtyPlanes[fileIndex] >= EXTENDED_HEADER_BATCH_SIZE
+
+
+    ## Report errors from the writer threads, which would otherwise be
+    # kept in the future and never seen.
+    def onPlaneWritten(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            cockpit.util.logger.log.error("Error writing image: %s",
+                                          future.exception())
+
+
+    ## Write the changed part of a file's extended header to disk.
+    def flushExtendedHeader(self, fileIndex):
+        # Hold the file lock while writing so that an older copy of
+        # the extended header never overwrites a newer one.
+        with self.fileLocks[fileIndex]:
+            with self.statsLock:
+                dirty = self.dirtyPlanes[fileIndex]
+                if dirty is None:
+                    return
+                first, last = dirty
+                data = self.extendedHeaders[fileIndex][first:last+1].tobytes()
+                self.dirtyPlanes[fileIndex] = None
+                self.numDirtyPlanes[fileIndex] = 0
+            writeAt(self.filehandles[fileIndex], None, data,
+                    1024 + first * self.extendedBytes)
+
+
     ## Return a list of the filenames we are writing to.
     def getFilenames(self):
         return self.filenames
 
 
 
+## Reserve disk space for a file of the given size.  Where the
+# platform or filesystem does not support it, the file is only
+# extended, which on most filesystems will make a sparse file.
+def preallocateFile(handle, size):
+    handle.flush()
+    try:
+        os.posix_fallocate(handle.fileno(), 0, size)
+    except (AttributeError, OSError):
+        handle.truncate(size)
+
+
+## Write data to a file at the given offset, without moving the file
+# position, so that multiple threads can write to the same file.  On
+# platforms without os.pwrite, this falls back to seek and write
+# while holding lock, if any.
+def writeAt(handle, lock, data, offset):
+    view = memoryview(data).cast('B')
+    if hasattr(os, 'pwrite'):
+        fd = handle.fileno()
+        while view:
+            nWritten = os.pwrite(fd, view, offset)
+            view = view[nWritten:]
+            offset += nWritten
+    elif lock is None:
+        handle.seek(offset)
+        handle.write(view)
+        handle.flush()
+    else:
+        with lock:
+            handle.seek(offset)
+            handle.write(view)
+            handle.flush()
+
+
+
+## Queue of images waiting to be saved, with a limit on how much
+# memory they can use.  Images are counted from the time they are put
+# on the queue until release is called for them, i.e., after they have
+# been written.  New images over the limit are handled according to
+# the queue policy.  Dropped images are still put on the queue, as
+# None, so that the following images are saved in the right plane.
+class ImageQueue:
+    ## \param maxBytes Maximum number of bytes used by the images in
+    #         flight, or None for no limit.
+    # \param policy What to do with new images over that limit.  One
+    #        of QUEUE_POLICIES.
+    # \param spillBytes Size of the temporary file for the spill policy.
+    def __init__(self, maxBytes=None, policy=QUEUE_BLOCK, spillBytes=2**32):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("unknown image queue policy '%s'" % policy)
+        self.maxBytes = maxBytes
+        self.policy = policy
+        ## [camera index, image data, timestamp, spilled dtype, ready]
+        # lists.  For spilled images, the image data is their shape and
+        # offset in the spill file, and ready is False until they are
+        # written there.
+        self.items = collections.deque()
+        ## Number of bytes of the images in flight.
+        self.numBytes = 0
+        ## Number of images spilled to disk so far.
+        self.numSpilled = 0
+        ## Number of images dropped so far.
+        self.numDropped = 0
+        ## Set when aborting, to stop blocking on put.
+        self.isAborted = False
+        ## Set when no more images will be taken, to stop blocking on get.
+        self.isClosed = False
+        ## Lock on all of the above, notified when they change.
+        self.condition = threading.Condition()
+        self.spillFile = None
+        if self.maxBytes is not None and self.policy == QUEUE_SPILL:
+            self.spillFile = SpillFile(spillBytes)
+
+
+    def hasRoomFor(self, numBytes):
+        # Always allow at least one image, even if it is larger than
+        # the limit on its own.
+        return (self.maxBytes is None or self.numBytes == 0
+                or self.numBytes + numBytes <= self.maxBytes)
+
+
+    ## Add an image to the queue.  Returns QUEUE_BLOCK if the image
+    # was queued, after blocking or not, QUEUE_SPILL if it was queued
+    # on disk, and QUEUE_DROP if it was dropped.
+    def put(self, cameraIndex, imageData, timestamp):
+        with self.condition:
+            result = QUEUE_BLOCK
+            offset = None
+            if self.hasRoomFor(imageData.nbytes):
+                pass
+            elif self.policy == QUEUE_DROP:
+                imageData = None
+                self.numDropped += 1
+                result = QUEUE_DROP
+            elif self.policy == QUEUE_SPILL:
+                offset = self.spillFile.reserve(imageData.nbytes)
+            if offset is not None:
+                # Keep our place in the queue, but write the image
+                # without holding the lock, since spilling happens when
+                # the disk is already slow.
+                item = [cameraIndex, (imageData.shape, offset), timestamp,
+                        imageData.dtype, False]
+                self.items.append(item)
+                self.numSpilled += 1
+            elif result != QUEUE_DROP:
+                # Either blocking, or the spill file is full too.
+                while (not self.hasRoomFor(imageData.nbytes)
+                       and not self.isAborted):
+                    self.condition.wait()
+            if offset is None:
+                if imageData is not None:
+                    self.numBytes += imageData.nbytes
+                self.items.append([cameraIndex, imageData, timestamp, None,
+                                   True])
+                self.condition.notify_all()
+                return result
+        self.spillFile.writeAt(offset, imageData)
+        with self.condition:
+            item[4] = True
+            self.condition.notify_all()
+        return QUEUE_SPILL
+
+
+    ## Get the next image, as a (camera index, image data, timestamp)
+    # tuple, blocking until there is one.  The image data is None if
+    # the image was dropped.  Returns None once the queue is closed.
+    def get(self):
+        with self.condition:
+            while ((not self.items or not self.items[0][4])
+                   and not self.isClosed):
+                self.condition.wait()
+            if self.isClosed:
+                return None
+            cameraIndex, imageData, timestamp, dtype, ready = (
+                self.items.popleft())
+            if dtype is None:
+                return (cameraIndex, imageData, timestamp)
+        # Spilled to disk, so imageData is only its shape and offset.
+        # Read it without holding the lock, then free its space.
+        shape, offset = imageData
+        imageData = self.spillFile.readAt(offset, shape, dtype)
+        with self.condition:
+            self.spillFile.free()
+            self.numBytes += imageData.nbytes
+        return (cameraIndex, imageData, timestamp)
+
+
+    ## Release the memory of an image taken from the queue.
+    def release(self, imageData):
+        if imageData is None:
+            return
+        with self.condition:
+            self.numBytes -= imageData.nbytes
+            self.condition.notify_all()
+
+
+    def empty(self):
+        with self.condition:
+            return not self.items
+
+
+    ## Stop blocking the threads putting images on the queue.
+    def abort(self):
+        with self.condition:
+            self.isAborted = True
+            self.condition.notify_all()
+
+
+    ## Stop blocking the threads putting and getting images.  Images
+    # still on the queue are not saved.
+    def close(self):
+        with self.condition:
+            self.isAborted = True
+            self.isClosed = True
+            self.condition.notify_all()
+
+
+
+## Temporary file used as a ring buffer, for images that do not fit in
+# memory.  Space is reserved and freed in the same order, by the caller
+# holding a lock, but images are written and read without it.
+class SpillFile:
+    def __init__(self, numBytes):
+        self.handle = tempfile.TemporaryFile(prefix='cockpit-spill-')
+        ## Lock on the file position, on platforms without os.pwrite.
+        self.lock = threading.Lock()
+        ## Size of the ring.
+        self.numBytes = numBytes
+        ## Offset for the next image.
+        self.head = 0
+        ## Number of bytes in use, including any gap left at the end of
+        # the file when wrapping around.
+        self.numUsed = 0
+        ## Bytes used by each image, in order.
+        self.images = collections.deque()
+
+
+    ## Reserve space for an image of numBytes.  Returns its offset, or
+    # None if there is no room.
+    def reserve(self, numBytes):
+        offset = self.head
+        gap = 0
+        if offset + numBytes > self.numBytes:
+            # Not enough room before the end, wrap around.
+            gap = self.numBytes - offset
+            offset = 0
+        if self.numUsed + gap + numBytes > self.numBytes:
+            return None
+        self.head = offset + numBytes
+        self.numUsed += gap + numBytes
+        self.images.append(gap + numBytes)
+        return offset
+
+
+    ## Write an image to the space reserved for it.
+    def writeAt(self, offset, imageData):
+        writeAt(self.handle, self.lock, numpy.ascontiguousarray(imageData),
+                offset)
+
+
+    ## Read an image from the file.
+    def readAt(self, offset, shape, dtype):
+        imageData = numpy.empty(shape, dtype=dtype)
+        view = memoryview(imageData).cast('B')
+        if hasattr(os, 'preadv'):
+            fd = self.handle.fileno()
+            while view:
+                nRead = os.preadv(fd, [view], offset)
+                if not nRead:
+                    raise EOFError("spill file is truncated")
+                view = view[nRead:]
+                offset += nRead
+        else:
+            with self.lock:
+                self.handle.seek(offset)
+                self.handle.readinto(view)
+        return imageData
+
+
+    ## Free the space of the oldest image.
+    def free(self):
+        self.numUsed -= self.images.popleft()
+        if not self.images:
+            self.head = 0
+
+
+
 ## This thread handles telling the saving status light to update twice per
 # second.
 class StatusUpdateThread(threading.Thread):
-    def __init__(self, cameraNames, totals):
+    ## \param queuePolicy Policy of the image queue, or None if the
+    #         queue has no memory limit.
+    def __init__(self, cameraNames, totals, queuePolicy=None):
         super().__init__()
         ## List of names of the cameras.
         self.cameraNames = cameraNames
         ## List of images received per camera.
         self.imagesReceived = [0 for name in self.cameraNames]
+        ## Lists of images spilled to disk and dropped per camera.
+        self.imagesSpilled = [0 for name in self.cameraNames]
+        self.imagesDropped = [0 for name in self.cameraNames]
+        self.queuePolicy = queuePolicy
         ## Lock on updating the above.
         self.imageCountLock = threading.Lock()
         ## List of total images expected per camera.
@@ -544,15 +1102,15 @@ class StatusUpdateThread(threading.Thread):
 
 
     def run(self):
-        prevCounts = list(self.imagesReceived)
+        prevCounts = self.getCounts()
         self.updateText()
         while not self.shouldStop:
-            if prevCounts != self.imagesReceived:
+            if prevCounts != self.getCounts():
                 # Have received new images since the last update;
                 # update the display.
                 with self.imageCountLock:
                     self.updateText()
-                    prevCounts = list(self.imagesReceived)
+                    prevCounts = self.getCounts()
             else:
                 # No images; wait a bit.
                 time.sleep(.1)
@@ -566,7 +1124,14 @@ class StatusUpdateThread(threading.Thread):
         for i, name in enumerate(self.cameraNames):
             curCount = self.imagesReceived[i]
             maxCount = self.totals[i]
-            statusText.append('%s: %d/%d' % (name, curCount, maxCount))
+            text = '%s: %d/%d' % (name, curCount, maxCount)
+            if self.imagesSpilled[i]:
+                text += ' (%d spilled)' % self.imagesSpilled[i]
+            if self.imagesDropped[i]:
+                text += ' (%d DROPPED)' % self.imagesDropped[i]
+            statusText.append(text)
+        if self.queuePolicy is not None:
+            statusText.append('queue: %s' % self.queuePolicy)
 
         events.publish(events.UPDATE_STATUS_LIGHT, 'image count',
                        ' | '.join(statusText))
@@ -576,3 +1141,18 @@ class StatusUpdateThread(threading.Thread):
     def newImage(self, index):
         with self.imageCountLock:
             self.imagesReceived[index] += 1
+
+
+    def imageSpilled(self, index):
+        with self.imageCountLock:
+            self.imagesSpilled[index] += 1
+
+
+    def imageDropped(self, index):
+        with self.imageCountLock:
+            self.imagesDropped[index] += 1
+
+
+    def getCounts(self):
+        return (list(self.imagesReceived), list(self.imagesSpilled),
+                list(self.imagesDropped))
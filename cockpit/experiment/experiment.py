@@ -257,12 +257,21 @@ class Experiment:
                     cameraToExcitation[camera] = max(cameraToExcitation[camera],
                                                      max_wavelength)
 
+            savingConfig = wx.GetApp().Config['saving']
+            numWriterThreads = savingConfig.getint('writer-threads')
+            maxQueueBytes = savingConfig.getint('queue-memory') * 2**20
+            spillBytes = savingConfig.getint('spill-file-size') * 2**20
             saver = dataSaver.DataSaver(self.cameras, self.numReps,
                                         self.cameraToImageCount,
                                         self.cameraToIgnoredImageIndices,
                                         self._run_thread, self.savePath,
                                         self.sliceHeight, self.generateTitles(),
-                                        cameraToExcitation)
+                                        cameraToExcitation,
+                                        numWriterThreads=numWriterThreads,
+                                        maxQueueBytes=(maxQueueBytes or None),
+                                        queuePolicy=savingConfig.get('queue-policy'),
+                                        spillBytes=spillBytes,
+                                        planeIndexMap=self.getPlaneIndexMap())
             saver.startCollecting()
             saveThread = threading.Thread(target=saver.executeAndSave,
                                           name="Experiment-execute-save")
@@ -379,7 +388,7 @@ class Experiment:
                         fn = lambda: h.moveAbsolute(action)
 
                     if fn is None:
-                        raise RuntimeError("Found a line that no executor could handle: %s" % str(self.table.actions[curIndex]))
+                        raise RuntimeError("Found a line that no executor could handle: %s" % str(self.table[curIndex]))
                     # Wait until this action is due.
                     if curIndex > 0:
                         timeToNext = delay + startTime + float(self.table[curIndex][0]) / 1000. - time.time()
@@ -436,6 +445,12 @@ class Experiment:
         # with future experiments.
         gc.collect()
 
+    ## Return a function mapping the index of each image acquired by a
+    # camera, in a single repeat, to the Z index where it is saved.  See
+    # DataSaver.  By default images are saved in order of acquisition.
+    def getPlaneIndexMap(self):
+        return None
+
     ## Generate the "titles" that provide extra miscellaneous information
     # about the experiment. These are part of the MRC file format spec:
     # http://msg.ucsf.edu/IVE/IVE4_HTML/IM_ref2.html
@@ -56,16 +56,11 @@ from cockpit.experiment import actionTable
 from cockpit import depot
 from cockpit.experiment import experiment
 from cockpit.gui import guiUtils
-import cockpit.util.Mrc
-import cockpit.util.datadoc
 import cockpit.util.userConfig
 
 import decimal
 import math
 import numpy
-import os
-import tempfile
-import shutil
 import wx
 
 ## Provided so the UI knows what to call this experiment.
@@ -108,53 +103,31 @@ def postpad_data(data, shape):
                      constant_values=[numpy.nan])
 
 
-def reorder_z_dim(data, order_packed, z_lengths, z_order, z_wanted):
-    """Reorder the Z dimension of a numpy array.
+def z_index_map(z_order, z_lengths, z_wanted):
+    """Return array mapping Z indices from one order to another.
 
-    To fix the order of the Z dimension, we reshape the numpy array
-    into the real 7 dimensions array that it is, tranpose it as
-    necessary, and then reshape it back into the fake 5 dimensions.
+    Priism and Softworx are only capable to handle five dimensions so
+    angle and phase get mixed in the Z dimension.  This maps the index
+    of each plane in that mixed Z dimension, when acquired in Z_ORDER,
+    to its index in Z_WANTED order.
 
     Args:
-        data - numpy.array
-        order_packed - tuple of 1 character
-        z_lengths - tuple of 3 elements with the length of each of the
-            dimensions packed in z, same order as z_order
         z_order - a 3 element tuple of 1 character, the order of the z
             dimension.
+        z_lengths - tuple of 3 elements with the length of each of the
+            dimensions packed in z, same order as z_order
         z_wanted - a 3 element tuple of 1 character, with the wanted
             order of the z dimension.
     """
-    assert data.ndim == len(order_packed), \
-        "DATA ndims different from lenght of ORDER_PACKED"
     assert sorted(z_order) == ['a', 'p', 'z'], \
         "Z_ORDER does not have only 'a, z, p'"
     assert sorted(z_order) == sorted(z_wanted), \
         "Z_ORDER not same elements as Z_WANTED"
-
-    z_idx = order_packed.index("z")
-    order_in = order_packed[0:z_idx] + z_order + order_packed[z_idx+1:]
-    order_out = order_packed[0:z_idx] + z_wanted + order_packed[z_idx+1:]
-
-    packed_shape = data.shape
-    unpacked_shape = packed_shape[0:z_idx] + z_lengths + packed_shape[z_idx+1:]
-
-    ## If we are dealing with truncated files we may need to add blank
-    ## planes into the data.  See cockpit bug #289.
-    if numpy.prod(z_lengths) != packed_shape[z_idx]:
-        packed_shape = list(packed_shape)
-        packed_shape[z_idx] = numpy.prod(z_lengths)
-        packed_shape = tuple(packed_shape)
-        data = postpad_data(data, packed_shape)
-
-    ## The new order for the array axes
-    dim_map = dict(zip(order_in, range(len(order_in))))
-    axes_order = [dim_map[i] for i in order_out]
-
-    data = data.reshape(unpacked_shape)
-    data = numpy.transpose(data, axes_order)
-    data = data.reshape(packed_shape)
-    return data
+    dim_lengths = dict(zip(z_order, z_lengths))
+    wanted_shape = [dim_lengths[d] for d in z_wanted]
+    wanted_index = numpy.arange(numpy.prod(wanted_shape)).reshape(wanted_shape)
+    axes_order = [z_wanted.index(d) for d in z_order]
+    return numpy.transpose(wanted_index, axes_order).ravel()
 
 
 ## This class handles SI experiments.
@@ -224,7 +197,7 @@ class SIExperiment(experiment.Experiment):
     # Z-stacks for three different angles, and take five images at each
     # Z-slice, one for each phase.
     def generateActions(self):
-        table = actionTable.ActionTable()
+        table = actionTable.ColumnarActionTable()
         curTime = 0
         prevAngle, prevZ, prevPhase = None, None, None
 
@@ -396,106 +369,27 @@ class SIExperiment(experiment.Experiment):
         curTime += delay
         return super().expose(curTime, cameras, newPairs, table)
 
-    def reorder_img_file(self):
-        """Reorder the Z dimension in the file.
+    def getPlaneIndexMap(self):
+        """Save images in angle-z-phase order.
 
-        Priism and Softworx are only capable to handle five dimensions
-        so angle and phase get mixed in the Z dimension.  In addition,
-        their reconstruction programs are only capable to handle them
-        in angle-z-phase order.
+        Priism and Softworx reconstruction programs are only capable
+        to handle angle and phase mixed in the Z dimension in
+        angle-z-phase order, so images are saved directly into that
+        order instead of the order they were acquired.
         """
         z_order = collection_order_tuple(self.collectionOrder)
         z_wanted = ('a', 'z', 'p')
         if z_order == z_wanted:
             # Already in order; don't do anything.
-            return
-
-
-        doc = cockpit.util.datadoc.DataDoc(self.savePath)
-        order_in = tuple(doc.image.Mrc.axisOrderStr())
-
+            return None
         length_getters = {
             "a" : self.numAngles,
             "z" : self.numZSlices,
             "p" : self.numPhases,
         }
-        ## If data is truncated, the number of Z planes in the header
-        ## may differ from the number of Z planes in the data.  So
-        ## these are checked separetely.  See cockpit bug #289.
-        header_z_lengths = tuple([length_getters[d] for d in z_order])
-        nz_in_header = numpy.prod(header_z_lengths)
-        nz_in_data = doc.image.shape[doc.image.Mrc.axisOrderStr().index("z")]
-        if nz_in_data == nz_in_header:
-            z_lengths = header_z_lengths
-        else:
-            z_lengths = cockpit.util.Mrc.adjusted_data_shape(nz_in_data,
-                                                             header_z_lengths)
-
-        ## Read the extended header again separately.  It our case,
-        ## this is a struct made of int32 and float32, one per plane.
-        ## Its order also needs to be corrected.  We just fake a dtype
-        ## with the right number of bytes per plane for the extended
-        ## header.  We fake the struct by using multiple u1 per
-        ## element.
-        ext_header_stride = 4 * (doc.imageHeader.NumIntegers
-                                 + doc.imageHeader.NumFloats)
-        ext_header_dtype = ",".join(['u1']*ext_header_stride)
-        with open(self.savePath, "rb") as fh:
-            fh.seek(1024) # skip base header
-            ext_header = numpy.fromfile(fh, count=doc.getNPlanes(),
-                                        dtype=ext_header_dtype)
-        assert doc.imageHeader.next == ext_header.nbytes, \
-            "next value from datadoc differs from computed length"
-        assert order_in[-2:] == ('y', 'x'), \
-            "ORDER_IN two last dimensions are not Y and X"
-
-        ## The file may be truncated if the experiment was aborted.
-        ## In that case, the number of planes in file may be different
-        ## from what is in the header so we get the shape header and
-        ## not the shape from the data in the datadoc instance.  See
-        ## cockpit bug #289.
-        header_shape = [int(n) for n in cockpit.util.Mrc.shapeFromHdr(doc.imageHeader)]
-        ext_header = ext_header.reshape(header_shape[:-2])
-
-        ## Finally, reorder the things.
-        img_data = reorder_z_dim(doc.image, order_in, z_lengths,
-                                 z_order, z_wanted)
-        ext_header = reorder_z_dim(ext_header, order_in[:-2], header_z_lengths,
-                                   z_order, z_wanted)
-
-        ## Build a new header from old doc data
-
-        ## Save to a new file, reusing the original base header since
-        ## we don't actually changed anything there.
-        tmp_fh = tempfile.NamedTemporaryFile(delete=False)
-        cockpit.util.datadoc.writeMrcHeader(doc.imageHeader, tmp_fh)
-        ## Make sure the data is actually ordered for writing,
-        ## otherwise at this point the arrays might be making use of
-        ## views.
-        ext_header = numpy.ascontiguousarray(ext_header)
-        img_data = numpy.ascontiguousarray(img_data)
-        tmp_fh.write(ext_header)
-        tmp_fh.write(img_data)
-        tmp_fh.close()
-
-        ## We are going to swap the files now, so destroy the old
-        ## datadoc which memmaps the old file or we won't be able to
-        ## overwrite.
-        del doc
-        del img_data
-
-        ## Windows needs to have the file removed first.
-        if os.name == "nt":
-            os.remove(self.savePath)
-        shutil.move(tmp_fh.name, self.savePath)
-        return
-
-
-    def cleanup(self, runThread = None, saveThread = None):
-        super().cleanup(runThread, saveThread)
-        if self.savePath:
-            self.reorder_img_file()
-        return
+        z_lengths = tuple([length_getters[d] for d in z_order])
+        index_map = z_index_map(z_order, z_lengths, z_wanted)
+        return lambda index: int(index_map[index])
 
 
 ## A consistent name to use to refer to the class itself.
@@ -65,7 +65,7 @@ class ZStackExperiment(experiment.Experiment):
     ## Create the ActionTable needed to run the experiment. We simply move to 
     # each Z-slice in turn, take an image, then move to the next.
     def generateActions(self):
-        table = actionTable.ActionTable()
+        table = actionTable.ColumnarActionTable()
         curTime = 0
         prevAltitude = None
         numZSlices = int(math.ceil(self.zHeight / self.sliceHeight))
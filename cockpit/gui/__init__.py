@@ -19,6 +19,8 @@
 ## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import threading
+import time
 import traceback
 
 import pkg_resources
@@ -98,6 +100,93 @@ class EvtEmitter(wx.EvtHandler):
         return super().Destroy()
 
 
+## Repaint rate used when the display refresh rate is not known.
+DEFAULT_FRAME_RATE = 60
+
+
+class FrameScheduler:
+    """Coalesces requests to repaint windows and caps their repaint rate.
+
+    Instead of calling ``wx.CallAfter(window.Refresh)`` whenever
+    something changes, such as on every :const:`cockpit.events.STAGE_POSITION`
+    event, windows should call :meth:`Invalidate`, which is safe from
+    any thread.  However many times a window is invalidated, it is
+    refreshed once in its next frame, and frames of a window are at
+    least :attr:`interval` seconds apart.  Windows invalidated long
+    enough after their last frame are refreshed straight away.
+
+    Use the shared scheduler through :func:`ScheduleRefresh`.
+
+    Args:
+        interval (float): minimum time between frames of each window,
+            in seconds.  If None, use the refresh rate of the display,
+            once there is a :class:`wx.App`.
+    """
+    def __init__(self, interval=None):
+        self.interval = interval
+        self._lock = threading.Lock()
+        ## Windows invalidated since their last frame.
+        self._pending = set()
+        ## Maps windows to the time of their last frame.
+        self._last_frame = {}
+        ## Whether a call to _OnFrame is due.
+        self._is_scheduled = False
+        self.clock = time.monotonic
+
+    def Invalidate(self, window):
+        """Schedule a refresh of window, unless one is already scheduled."""
+        with self._lock:
+            self._pending.add(window)
+            if self._is_scheduled:
+                return
+            self._is_scheduled = True
+        wx.CallAfter(self._OnFrame)
+
+    def _GetInterval(self):
+        if self.interval is None:
+            rate = wx.Display().GetCurrentMode().refresh
+            if not isinstance(rate, (int, float)) or rate <= 0:
+                rate = DEFAULT_FRAME_RATE
+            self.interval = 1 / rate
+        return self.interval
+
+    def _OnFrame(self):
+        ## Refresh the windows that are due, and schedule another call
+        ## for the rest.  Only called in the main thread.
+        interval = self._GetInterval()
+        now = self.clock()
+        with self._lock:
+            due = [window for window in self._pending
+                   if now - self._last_frame.get(window, -interval) >= interval]
+            self._pending.difference_update(due)
+            if self._pending:
+                delay = min(self._last_frame[window] + interval - now
+                            for window in self._pending)
+            else:
+                delay = None
+                self._is_scheduled = False
+        for window in due:
+            if window:
+                self._last_frame[window] = now
+                window.Refresh()
+            else:
+                ## The window has been destroyed.
+                self._last_frame.pop(window, None)
+        if delay is not None:
+            wx.CallLater(max(1, int(delay * 1000)), self._OnFrame)
+
+
+_FRAME_SCHEDULER = FrameScheduler()
+
+
+def ScheduleRefresh(window):
+    """Refresh window in its next frame, see :class:`FrameScheduler`.
+
+    Safe to call from any thread.
+    """
+    _FRAME_SCHEDULER.Invalidate(window)
+
+
 def ExceptionBox(caption="", parent=None):
     """Show python exception in a modal dialog.
 
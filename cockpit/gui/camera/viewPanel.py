@@ -213,6 +213,11 @@ class ViewPanel(wx.Panel):
     def getPixelData(self):
         return self.canvas.imageData
 
+
+    ## Return the statistics of the images our canvas has displayed.
+    def getRenderStats(self):
+        return self.canvas.getRenderStats()
+
     ## Debugging: convert to string.
     def __repr__(self):
         descString = ", disabled"
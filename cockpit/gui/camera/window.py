@@ -167,3 +167,12 @@ def getImageForCamera(camera):
     for view in window.views:
         if view.curCamera is camera:
             return view.getPixelData()
+
+
+## Retrieve the display statistics of the specified camera's view, see
+# cockpit.gui.imageViewer.renderStats.RenderStats.getSummary.
+def getRenderStatsForCamera(camera):
+    for view in window.views:
+        if view.curCamera is camera:
+            return view.getRenderStats()
+    raise RuntimeError("Tried to get render statistics for non-active camera [%s]" % camera.name)
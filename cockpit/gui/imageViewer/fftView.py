@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+## This module computes the Fourier transforms shown by the FFT mode of
+# view canvases.  It does not use wx or OpenGL.
+
+import threading
+
+import numpy
+import scipy.fft
+
+
+## Added to magnitudes before taking their log, so that zeros are finite.
+LOG_EPSILON = 1e-16
+
+
+## Computes the log magnitude of the Fourier transform of images, shifted
+# so that zero frequency is in the center, as
+# numpy.log(numpy.abs(numpy.fft.fftshift(numpy.fft.fft2(image)))).
+#
+# As images are real, only half of the transform is computed, in single
+# precision, and the other half is mirrored from it.  The working
+# buffers are kept between images of the same shape, and the result for
+# the last image is cached.  compute() is meant to be called from one
+# worker thread.
+class FFTView:
+    ## \param maxSize Images larger than this along either axis are
+    #        cropped to their central maxSize pixels first; None for no
+    #        cropping.
+    # \param downsample Take every n-th pixel of images along each axis
+    #        before cropping them.
+    def __init__(self, maxSize = None, downsample = 1):
+        self.maxSize = maxSize
+        self.downsample = downsample
+        self.lock = threading.Lock()
+        ## Shape of the images the buffers are for.
+        self.shape = None
+        ## Single precision copy of the image.
+        self.input = None
+        ## Log magnitude of half the transform.
+        self.half = None
+        ## Rows of self.half for each row of the shifted result, for the
+        # right half and, mirrored, for the left half of the result.
+        self.rightRows = None
+        self.leftRows = None
+        ## Last image computed, and its result.
+        self.lastImage = None
+        self.lastResult = None
+
+
+    ## Change maxSize and downsample, which invalidates the cache.
+    def setRegion(self, maxSize = None, downsample = 1):
+        with self.lock:
+            self.maxSize = maxSize
+            self.downsample = downsample
+            self.lastImage = self.lastResult = None
+
+
+    ## Return the part of image that is transformed.
+    def getRegion(self, image):
+        region = image[::self.downsample, ::self.downsample]
+        if self.maxSize:
+            starts = [max(0, (n - self.maxSize) // 2) for n in region.shape]
+            region = region[starts[0]:starts[0] + self.maxSize,
+                            starts[1]:starts[1] + self.maxSize]
+        return region
+
+
+    ## Return the result for image if it is the last image computed, else
+    # None.
+    def getCached(self, image):
+        with self.lock:
+            if image is self.lastImage:
+                return self.lastResult
+        return None
+
+
+    def allocate(self, shape):
+        if shape == self.shape:
+            return
+        ny, nx = shape
+        self.shape = shape
+        self.input = numpy.empty(shape, dtype = numpy.float32)
+        self.half = numpy.empty((ny, nx // 2 + 1), dtype = numpy.float32)
+        rows = numpy.arange(ny)
+        self.rightRows = (rows - ny // 2) % ny
+        self.leftRows = (ny // 2 - rows) % ny
+
+
+    ## Return the shifted log magnitude of the transform of image, as a
+    # new float32 array, which is not changed by later calls.
+    def compute(self, image):
+        result = self.getCached(image)
+        if result is not None:
+            return result
+        with self.lock:
+            maxSize, downsample = self.maxSize, self.downsample
+        region = self.getRegion(image)
+        self.allocate(region.shape)
+        numpy.copyto(self.input, region, casting = 'unsafe')
+        transform = scipy.fft.rfft2(self.input, overwrite_x = True,
+                                    workers = -1)
+        numpy.abs(transform, out = self.half)
+        self.half += LOG_EPSILON
+        numpy.log(self.half, out = self.half)
+        # The transform of a real image is conjugate symmetric, so the
+        # left half of the result is the right half rotated by 180
+        # degrees.
+        ny, nx = region.shape
+        result = numpy.empty(region.shape, dtype = numpy.float32)
+        numpy.take(self.half[:, :nx - nx // 2], self.rightRows, axis = 0,
+                   out = result[:, nx // 2:], mode = 'clip')
+        numpy.take(self.half[:, nx // 2:0:-1], self.leftRows, axis = 0,
+                   out = result[:, :nx // 2], mode = 'clip')
+        with self.lock:
+            # Don't cache results for an out of date region.
+            if (maxSize, downsample) == (self.maxSize, self.downsample):
+                self.lastImage = image
+                self.lastResult = result
+        return result
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+## This module computes the histograms shown under camera images.  It
+# does not use wx or OpenGL.
+
+import numpy
+
+
+## Number of bins of the histogram.
+NUM_BINS = 64
+
+## Number of shifted histograms that are averaged, to avoid binning
+# artefacts.
+NUM_SHIFTS = 4
+
+## Largest number of pixels to make a histogram of.  Larger images,
+# other than unsigned 8 and 16 bit ones, are subsampled.
+MAX_PIXELS = 2**20
+
+
+## Return a view of the 2D image data with at most maxPixels pixels, made
+# by taking every n-th row and column.
+def subsample(data, maxPixels = MAX_PIXELS):
+    if data.size <= maxPixels:
+        return data
+    stride = int(numpy.ceil(numpy.sqrt(data.size / maxPixels)))
+    return data[::stride, ::stride]
+
+
+## Return the (bins, counts) of the shifted average histogram of data.
+# This is the sum of numShifts histograms of numBins bins spanning the
+# data, each shifted by a further 1 / numShifts of a bin, with bins
+# closed on the right like numpy.digitize(..., right = True).
+#
+# All of the shifted histograms are made from one histogram with
+# numShifts times as many bins, which takes a single pass over the data.
+# Unsigned 8 and 16 bit data are counted by value with numpy.bincount,
+# which also gives their minimum and maximum, and are never subsampled.
+# \param maxPixels Other images with more pixels than this are
+#        subsampled first, see subsample().  The bins still span the
+#        minimum and maximum of all of the data.
+def shiftedHistogram(data, numBins = NUM_BINS, numShifts = NUM_SHIFTS,
+                     maxPixels = MAX_PIXELS):
+    data = numpy.asarray(data)
+    if data.dtype.kind == 'u' and data.dtype.itemsize <= 2:
+        sample = data.ravel()
+        valueCounts = numpy.bincount(sample)
+        values = numpy.flatnonzero(valueCounts)
+        weights = valueCounts[values]
+        minVal, maxVal = values[0], values[-1]
+    else:
+        sample = subsample(data, maxPixels).ravel()
+        values = sample
+        weights = None
+        minVal, maxVal = data.min(), data.max()
+    bins = numpy.linspace(minVal, maxVal, numBins)
+    counts = numpy.zeros(numBins)
+    if minVal == maxVal:
+        # Every value is on the first edge of every shifted histogram.
+        counts[0] = numShifts * sample.size
+        return bins, counts
+    # Index of each value in the finer histogram.
+    numFine = (numBins - 1) * numShifts + 1
+    fineWidth = (bins[1] - bins[0]) / numShifts
+    fine = numpy.ceil(numpy.subtract(values, minVal, dtype = numpy.float64)
+                      / fineWidth).astype(numpy.intp)
+    numpy.clip(fine, 0, numFine - 1, out = fine)
+    fineCounts = numpy.bincount(fine, weights = weights, minlength = numFine)
+    fineIndices = numpy.arange(numFine)
+    for i in range(numShifts):
+        # Bin of the histogram shifted by i fine bins that each fine bin
+        # is in, rounding up.
+        indices = -((i - fineIndices) // numShifts)
+        counts += numpy.bincount(indices, weights = fineCounts,
+                                 minlength = numBins)[:numBins]
+    return bins, counts
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+## This module keeps statistics on the images displayed by a view canvas.
+# It does not use wx or OpenGL.
+
+import collections
+import threading
+import time
+
+
+## Number of recent frames that the display rate and latencies are
+# computed over.
+WINDOW_SIZE = 100
+
+
+## Counts the images received, displayed and dropped by a canvas, and
+# times the upload of their data and the painting of the canvas.  Images
+# are received in one thread and painted in another, so all methods are
+# thread-safe.
+class RenderStats:
+    def __init__(self, windowSize = WINDOW_SIZE):
+        self.windowSize = windowSize
+        ## Function returning the current time, in seconds.
+        self.clock = time.perf_counter
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self.lock:
+            self.numReceived = 0
+            self.numDisplayed = 0
+            self.numDropped = 0
+            ## Times at which recent images were displayed.
+            self.displayTimes = collections.deque(maxlen = self.windowSize)
+            ## Seconds taken by recent uploads and paints.
+            self.uploadTimes = collections.deque(maxlen = self.windowSize)
+            self.paintTimes = collections.deque(maxlen = self.windowSize)
+
+
+    def addReceived(self):
+        with self.lock:
+            self.numReceived += 1
+
+
+    ## Record that count images were discarded without being displayed.
+    def addDropped(self, count = 1):
+        with self.lock:
+            self.numDropped += count
+
+
+    ## Record a paint of the canvas that took paintSeconds.  If it
+    # displayed a new image, uploadSeconds is the time taken to upload the
+    # image's data, which is part of paintSeconds; otherwise it is None.
+    def addPaint(self, paintSeconds, uploadSeconds = None):
+        with self.lock:
+            self.paintTimes.append(paintSeconds)
+            if uploadSeconds is not None:
+                self.numDisplayed += 1
+                self.uploadTimes.append(uploadSeconds)
+                self.displayTimes.append(self.clock())
+
+
+    ## Return a dict of the statistics: the number of images 'received',
+    # 'displayed' and 'dropped', the recent display rate in 'fps', and the
+    # mean and maximum recent 'upload' and 'paint' times, in
+    # milliseconds, as (mean, max) tuples.
+    def getSummary(self):
+        with self.lock:
+            times = list(self.displayTimes)
+            fps = 0
+            if len(times) > 1 and times[-1] > times[0]:
+                fps = (len(times) - 1) / (times[-1] - times[0])
+            return {
+                'received': self.numReceived,
+                'displayed': self.numDisplayed,
+                'dropped': self.numDropped,
+                'fps': fps,
+                'upload': getMeanAndMax(self.uploadTimes, 1000),
+                'paint': getMeanAndMax(self.paintTimes, 1000),
+            }
+
+
+    ## Return the statistics as one line of text.
+    def format(self):
+        summary = self.getSummary()
+        return ('%(received)d in, %(displayed)d shown, %(dropped)d dropped'
+                ', %(fps).1f fps' % summary
+                + ', upload %.1f/%.1f ms' % summary['upload']
+                + ', paint %.1f/%.1f ms' % summary['paint'])
+
+
+## Return the (mean, max) of values multiplied by scale, or (0, 0) if
+# there are none.
+def getMeanAndMax(values, scale = 1):
+    if not values:
+        return (0, 0)
+    return (scale * sum(values) / len(values), scale * max(values))
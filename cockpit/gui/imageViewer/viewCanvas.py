@@ -56,6 +56,9 @@ from cockpit import events
 import cockpit.gui
 import cockpit.gui.guiUtils
 import cockpit.gui.dialogs.getNumberDialog
+import cockpit.gui.imageViewer.fftView
+import cockpit.gui.imageViewer.histogram
+import cockpit.gui.imageViewer.renderStats
 import cockpit.util.datadoc
 import cockpit.util.threads
 
@@ -63,11 +66,15 @@ from wx.glcanvas import GLCanvas
 from collections.abc import Iterable
 
 from cockpit.util import ftgl
+from cockpit.gui.mosaic.tile import (PixelUploader, dtypeToGlTypeMap,
+                                     dtypeToInternalFormatMap,
+                                     getMaxTexelValue)
 import numpy
 from OpenGL.GL import *
 import numpy as np
 import queue
 import threading
+import time
 import traceback
 import wx
 import wx.glcanvas
@@ -123,10 +130,12 @@ class BaseGL():
 class Image(BaseGL):
     """ An class for rendering grayscale images from image data.
 
-    GL textures are generated once. GL stores textures as floats with a range of
-    0 to 1. We use the data.min and data.max of the incoming data to fill this
-    range to prevent loss of detail due to quantisation when rendering low dynamic
-    range images.
+    GL textures are generated once, and reallocated only when the shape
+    or type of the data changes.  8 and 16 bit unsigned data are
+    uploaded as they are, through a pixel buffer object, to GL_R8 and
+    GL_R16 textures, and other data as floats.  The fragment shader maps
+    the texels to the grayscale range, so there is no per-pixel work on
+    the CPU.
     """
     # Vertex shader glsl source
     _VS = """
@@ -145,13 +154,13 @@ class Image(BaseGL):
     _FS = """
     #version 120
     uniform sampler2D tex;
-    uniform float scale;
+    uniform float gain;
     uniform float offset;
     uniform bool show_clip;
 
     void main()
     {
-        vec4 lum = clamp(offset + texture2D(tex, gl_TexCoord[0].st) / scale, 0., 1.);
+        vec4 lum = clamp(offset + gain * texture2D(tex, gl_TexCoord[0].st), 0., 1.);
         if (show_clip) {
             gl_FragColor = vec4(0., 0., lum.r == 0, 1.) + vec4(1., lum.r < 1., 1., 1.) * lum.r;
         } else {
@@ -164,6 +173,12 @@ class Image(BaseGL):
         self._maxTexEdge = 0
         # Textures used to display this image.
         self._textures = []
+        # (width, height, internal format) of the textures.
+        self._textureKey = None
+        # Type of the data in the textures.
+        self._textureDtype = np.dtype(np.float32)
+        # Uploads data to the textures.
+        self._uploader = PixelUploader()
         # New data flag
         self._update = False
         # Geometry as number of textures along each axis.
@@ -172,20 +187,19 @@ class Image(BaseGL):
         self.clipHighlight = False
         # Data
         self._data = None
-        # Minimum and maximum data value - used for setting greyscale range.
-        self.dptp = 1
-        self.dmin = 0
         # Grayscale clipping points
         self.vmax = 1
         self.vmin = 0
 
     @property
-    def scale(self):
-        return (self.vmax - self.vmin) / (self.dptp)
+    def gain(self):
+        # Integer textures are normalised to [0, 1] by GL.
+        return (getMaxTexelValue(self._textureDtype)
+                / ((self.vmax - self.vmin) or 1))
 
     @property
     def offset(self):
-        return - (self.vmin - self.dmin) / ((self.dptp * self.scale) or 1)
+        return - self.vmin / ((self.vmax - self.vmin) or 1)
 
     def __del__(self):
         """Clean up textures."""
@@ -224,7 +238,16 @@ class Image(BaseGL):
             return
         self._maxTexEdge = glGetInteger(GL_MAX_TEXTURE_SIZE)
         data = self._data
-        glPixelStorei(GL_UNPACK_SWAP_BYTES, False)
+        if data.dtype.type not in dtypeToInternalFormatMap:
+            data = data.astype(np.float32)
+        internalFormat = dtypeToInternalFormatMap.get(data.dtype.type,
+                                                      GL_R32F)
+        glType = dtypeToGlTypeMap[data.dtype.type]
+        # Pass the bytes as they are, and let GL swap them if need be.
+        glPixelStorei(GL_UNPACK_SWAP_BYTES, not data.dtype.isnative)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, data.itemsize)
+        data = data.view(data.dtype.newbyteorder('='))
+        self._textureDtype = data.dtype
         # Ensure the right number of textures available.
         nx = int(np.ceil(data.shape[1] / self._maxTexEdge))
         ny = int(np.ceil(data.shape[0] / self._maxTexEdge))
@@ -236,41 +259,51 @@ class Image(BaseGL):
                 self._textures.extend(textures)
             else:
                 self._textures.append(textures)
+            self._textureKey = None
         elif ntex < len(self._textures):
-            glDeleteTextures(len(self._textures) - ntex)
+            glDeleteTextures(self._textures[ntex:])
+            del self._textures[ntex:]
         if ntex == 1:
             # Data will fit into a single texture.
-            # Do we need to round these up to a power of 2?
             ty, tx = data.shape
         else:
             # Need to use multiple textures to store data.
             tx = ty = self._maxTexEdge
-        self.dptp = data.ptp()
-        self.dmin = data.min()
-        if self.dptp < 1e-6:
-            self.dptp = 1
+        # Textures are only reallocated when their size or format change;
+        # otherwise new data are written over the old.
+        key = (tx, ty, internalFormat)
+        shouldAllocate = key != self._textureKey
+        self._textureKey = key
         for i, tex in enumerate(self._textures):
             xoff = tx * (i % nx)
             yoff = ty * (i // nx)
-            subdata = (data[yoff:min(data.shape[0], yoff+ty),
-                           xoff:min(data.shape[1], xoff+tx)].astype(np.float32) - self.dmin) / self.dptp
+            # This only copies when the data are split between textures.
+            subdata = np.ascontiguousarray(
+                data[yoff:min(data.shape[0], yoff+ty),
+                     xoff:min(data.shape[1], xoff+tx)])
             glBindTexture(GL_TEXTURE_2D, tex)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE);
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE);
-            glTexImage2D(GL_TEXTURE_2D, 0, GL_RED, tx, ty, 0,
-                         GL_RED, GL_FLOAT, None)
-            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, subdata.shape[1], subdata.shape[0],
-                            GL_RED, GL_FLOAT, subdata)
+            if shouldAllocate:
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE);
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE);
+                glTexImage2D(GL_TEXTURE_2D, 0, internalFormat, tx, ty, 0,
+                             GL_RED, glType, None)
+            self._uploader.upload(subdata, glType)
         self._update = False
 
     def draw(self, pan=(0,0), zoom=1):
-        """Render the textures. Caller must set context prior to call."""
+        """Render the textures. Caller must set context prior to call.
+
+        Returns the seconds taken to upload new data, or None if there
+        were no new data."""
+        uploadSeconds = None
         if self._data is None:
-            return
+            return uploadSeconds
         elif self._update:
+            start = time.perf_counter()
             self._createTextures()
+            uploadSeconds = time.perf_counter() - start
         shader = self.getShader()
         glUseProgram(shader)
         # Vertical and horizontal modifiers for non-square images.
@@ -293,7 +326,7 @@ class Image(BaseGL):
         # Update shader parameters
         glUniform2f(glGetUniformLocation(shader, "pan"), pan[0], pan[1])
         glUniform1i(glGetUniformLocation(shader, "tex"), 0)
-        glUniform1f(glGetUniformLocation(shader, "scale"), self.scale)
+        glUniform1f(glGetUniformLocation(shader, "gain"), self.gain)
         glUniform1f(glGetUniformLocation(shader, "offset"), self.offset)
         glUniform1f(glGetUniformLocation(shader, "zoom"), zoom)
         glUniform1i(glGetUniformLocation(shader, "show_clip"), self.clipHighlight)
@@ -329,6 +362,7 @@ class Image(BaseGL):
         glDisable(GL_TEXTURE_2D)
         glDisableClientState(GL_TEXTURE_COORD_ARRAY)
         glUseProgram(0)
+        return uploadSeconds
 
 
 class Histogram(BaseGL):
@@ -339,6 +373,10 @@ class Histogram(BaseGL):
         self.ubound = None
         self.lthresh = None
         self.uthresh = None
+        # Buffer holding the vertices of the bars, and the (bins, counts,
+        # lbound, ubound) they were made from.
+        self._vertexBuffer = None
+        self._vertexKey = None
 
 
     def data2gl(self, val):
@@ -348,48 +386,57 @@ class Histogram(BaseGL):
         return self.lbound + ((self.ubound - self.lbound) or 1) * (x + 1) / 2
 
     def setData(self, data):
-        # Calculate histogram.
         # Use shifted average histogram to avoid binning artefacts.
-        # generate set of m histograms
-        #   each has class width h
-        #   start points 0, h/m, 2h/m, ..., (m-1)h/m
-        # 1 < m < 64
-        # sum to average
+        bins, counts = cockpit.gui.imageViewer.histogram.shiftedHistogram(data)
         if self.lbound is None:
-            self.lbound = data.min()
+            self.lbound = bins[0]
         if self.ubound is None:
-            self.ubound = data.max()
+            self.ubound = bins[-1]
         if self.lthresh is None:
             self.lthresh = self.lbound
         if self.uthresh is None:
             self.uthresh = self.ubound
-        nbins = 64
-        m = 4
-        self.bins = np.linspace(data.min(), data.max(), nbins)
-        self.counts = np.zeros(nbins)
-        h = self.bins[1] - self.bins[0]
-        for i in range(m):
-            these = np.bincount(np.digitize(data.flat, self.bins + i*h/m, right=True), minlength=nbins)
-            self.counts += these[0:nbins]
+        self.bins, self.counts = bins, counts
+
+    def _bindVertexBuffer(self, bins, counts):
+        """Bind the buffer of bar vertices, updating it if the histogram
+        or its bounds have changed since the last draw."""
+        if self._vertexBuffer is None:
+            self._vertexBuffer = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self._vertexBuffer)
+        # setData makes new arrays, so checking identity is enough.
+        if self._vertexKey is not None:
+            oldBins, oldCounts, oldBounds = self._vertexKey
+            if (bins is oldBins and counts is oldCounts
+                    and oldBounds == (self.lbound, self.ubound)):
+                return
+        self._vertexKey = (bins, counts, (self.lbound, self.ubound))
+        binw = bins[1] - bins[0]
+        x0 = self.data2gl(bins)
+        x1 = self.data2gl(bins + binw)
+        h = -1 + 2 * counts / (counts.max() or 1)
+        v = np.empty((len(bins), 4, 2), dtype=np.float32)
+        v[:, 0] = np.stack([x0, -np.ones_like(x0)], axis=-1)
+        v[:, 1] = np.stack([x0, h], axis=-1)
+        v[:, 2] = np.stack([x1, h], axis=-1)
+        v[:, 3] = np.stack([x1, -np.ones_like(x1)], axis=-1)
+        glBufferData(GL_ARRAY_BUFFER, v.nbytes, v, GL_DYNAMIC_DRAW)
 
     def draw(self):
-        if self.counts is None:
+        # Take a reference, as setData may replace them in another thread.
+        bins, counts = self.bins, self.counts
+        if counts is None:
             return
-        binw = self.bins[1] - self.bins[0]
-        self.lbound = min(self.bins.min()-binw, self.lthresh-binw)
-        self.ubound = max(self.bins.max()+binw, self.uthresh+binw)
-        w = self.ubound - self.lbound
+        binw = bins[1] - bins[0]
+        self.lbound = min(bins.min()-binw, self.lthresh-binw)
+        self.ubound = max(bins.max()+binw, self.uthresh+binw)
         glUseProgram(self.getShader())
-        v = []
-        for (x, y) in zip(self.bins, self.counts):
-            x0 = self.data2gl(x)
-            x1 = self.data2gl(x + binw)
-            h = -1 + 2 * y / (self.counts.max() or 1)
-            v.extend( [(x0, -1), (x0, h), (x1, h), (x1, -1)] )
         glEnableClientState(GL_VERTEX_ARRAY)
-        glVertexPointerf(v)
+        self._bindVertexBuffer(bins, counts)
+        glVertexPointer(2, GL_FLOAT, 0, None)
         glColor(.8, .8, .8, 1)
-        glDrawArrays(GL_QUADS, 0, len(v))
+        glDrawArrays(GL_QUADS, 0, 4 * len(bins))
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
         glColor(1, 0, 0, 1)
         xl = self.data2gl(self.lthresh)
         xu = self.data2gl(self.uthresh)
@@ -408,12 +455,24 @@ class Histogram(BaseGL):
 # and tiling them together.
 class ViewCanvas(wx.glcanvas.GLCanvas):
     ## Instantiate.
-    def __init__(self, parent, *args, **kwargs):
+    # \param maxFPS Limit on the rate at which new images are displayed;
+    #        images that arrive faster are dropped.  Zero for no limit, and
+    #        None for the 'max-fps' of the 'view' config section.
+    def __init__(self, parent, *args, maxFPS = None, **kwargs):
         super().__init__(parent, *args, **kwargs)
 
         self.image = Image()
         self.histogram = Histogram()
 
+        if maxFPS is None:
+            maxFPS = wx.GetApp().Config['view'].getfloat('max-fps')
+        ## Limit on the rate at which new images are displayed.
+        self.maxFPS = maxFPS
+        ## Counts and timings of the images we receive and display.
+        self.stats = cockpit.gui.imageViewer.renderStats.RenderStats()
+        ## Should we draw the statistics over the image?
+        self.showStats = False
+
         ## Menu - keep reference to store state of toggle buttons.
         # Must be created after self.image.
         self._menu = wx.Menu()
@@ -444,8 +503,13 @@ class ViewCanvas(wx.glcanvas.GLCanvas):
         self.imageData = None
         ## Event that signals that we've finished drawing the current image.
         self.drawEvent = threading.Event()
-        # This spawns a new thread.
+        ## Queue of images to compute the FFT of, in FFT mode.
+        self.fftQueue = queue.Queue()
+        ## Computes, and caches, the FFT of images.
+        self.fftView = cockpit.gui.imageViewer.fftView.FFTView()
+        # These spawn new threads.
         self.processImages()
+        self.processFFTs()
         ## Percentile scaling of min/max based on our histogram.
         self.blackPoint, self.whitePoint = 0.0, 1.0
 
@@ -534,6 +598,7 @@ class ViewCanvas(wx.glcanvas.GLCanvas):
                 self.imageQueue.get_nowait()
             except queue.Empty:
                 break
+            self.stats.addDropped()
         self.imageData = None
         self.imageShape = None
         if shouldDestroy:
@@ -546,20 +611,29 @@ class ViewCanvas(wx.glcanvas.GLCanvas):
     ## Receive a new image. This will trigger processImages(), below, to
     # actually display the image.
     def setImage(self, newImage):
+        self.stats.addReceived()
         self.imageQueue.put_nowait(newImage)
 
 
     ## Consume images out of self.imageQueue and either display them or
     # discard them. Because images can arrive very rapidly at times, we
     # want to ensure that we don't jam up -- if several images arrive while
-    # we process one image, then the extras get discarded.
+    # we process one image, then the extras get discarded.  Images are
+    # displayed at most maxFPS times a second.
     @cockpit.util.threads.callInNewThread
     def processImages(self):
+        lastTime = None
         while self.shouldDraw:
-            # Grab all images out of the queue; we'll use the most recent one.
             newImage = self.imageQueue.get()
+            if self.maxFPS and lastTime is not None:
+                delay = lastTime + 1 / self.maxFPS - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            lastTime = time.perf_counter()
+            # Grab all images out of the queue; we'll use the most recent one.
             while not self.imageQueue.empty():
                 newImage = self.imageQueue.get_nowait()
+                self.stats.addDropped()
             # We want to autoscale to the image if it's our first one.
             isFirstImage = self.imageData is None
             self.imageData = newImage
@@ -569,7 +643,7 @@ class ViewCanvas(wx.glcanvas.GLCanvas):
             self.imageShape = newImage.shape
             self.histogram.setData(newImage)
             if self.showFFT:
-                self.image.setData(np.log(np.abs(np.fft.fftshift(np.fft.fft2(self.imageData))) + 1e-16))
+                self.fftQueue.put_nowait(newImage)
             else:
                 self.image.setData(newImage)
             if shouldResetView:
@@ -582,6 +656,24 @@ class ViewCanvas(wx.glcanvas.GLCanvas):
             self.drawEvent.clear()
 
 
+    ## Compute the FFTs of images out of self.fftQueue, and display them if
+    # we are still in FFT mode and their image is still the current one.
+    # Images that arrive while we compute one are skipped, except the
+    # most recent.
+    @cockpit.util.threads.callInNewThread
+    def processFFTs(self):
+        while self.shouldDraw:
+            image = self.fftQueue.get()
+            while not self.fftQueue.empty():
+                image = self.fftQueue.get_nowait()
+            if not self.showFFT or image is not self.imageData:
+                continue
+            result = self.fftView.compute(image)
+            if self.showFFT and image is self.imageData:
+                self.image.setData(result)
+                wx.CallAfter(self.Refresh)
+
+
     ## Return the blackpoint and whitepoint (i.e. the pixel values which
     # are displayed as black and white, respectively).
     def getScaling(self):
@@ -618,10 +710,12 @@ class ViewCanvas(wx.glcanvas.GLCanvas):
 
         try:
             self.painting = True
+            paintStart = time.perf_counter()
             self.SetCurrent(self.context)
             glClear(GL_COLOR_BUFFER_BIT)
             glViewport(0, HISTOGRAM_HEIGHT, self.w, self.h - HISTOGRAM_HEIGHT)
-            self.image.draw(pan=(self.panX, self.panY), zoom=self.zoom)
+            uploadSeconds = self.image.draw(pan=(self.panX, self.panY),
+                                            zoom=self.zoom)
             if self.showCrosshair:
                 self.drawCrosshair()
 
@@ -638,16 +732,22 @@ class ViewCanvas(wx.glcanvas.GLCanvas):
             glTranslatef(0, HISTOGRAM_HEIGHT/2+2, 0)
             try:
                 self.font.render('%d [%-10d %10d] %d' %
-                                 (self.image.dmin, self.histogram.lthresh,
-                                  self.histogram.uthresh, self.image.dmin+self.image.dptp))
+                                 (self.histogram.bins[0], self.histogram.lthresh,
+                                  self.histogram.uthresh, self.histogram.bins[-1]))
             except:
                 pass
+            if self.showStats:
+                glLoadIdentity()
+                glOrtho(0, self.w, 0, self.h, 1., -1.)
+                glTranslatef(2, self.h - 20, 0)
+                self.font.render(self.stats.format())
             glPopMatrix()
 
             #self.drawHistogram()
 
             #glFlush()
             self.SwapBuffers()
+            self.stats.addPaint(time.perf_counter() - paintStart, uploadSeconds)
             self.drawEvent.set()
         except Exception as e:
             print ("Error drawing view canvas:",e)
@@ -732,6 +832,10 @@ class ViewCanvas(wx.glcanvas.GLCanvas):
                 ('', None),
                 ('Toggle alignment crosshair', self.toggleCrosshair),
                 ("Toggle FFT mode", self.toggleFFT),
+                ('Set FFT size', self.onSetFFTSize),
+                ('', None),
+                ('Toggle render statistics', self.toggleStats),
+                ('Set display frame rate', self.onSetMaxFPS),
                 ('', None),
                 ('Save image', self.saveData)
                 ]
@@ -753,13 +857,59 @@ class ViewCanvas(wx.glcanvas.GLCanvas):
         self.showCrosshair = not(self.showCrosshair)
 
 
+    def toggleStats(self, event=None):
+        self.showStats = not(self.showStats)
+        self.Refresh()
+
+
+    ## Let the user set the limit on the display rate.
+    def onSetMaxFPS(self, event = None):
+        value = cockpit.gui.dialogs.getNumberDialog.getNumberFromUser(
+            parent = self, title = "Set display frame rate",
+            prompt = "Maximum frames per second (0 for no limit)",
+            default = self.maxFPS)
+        self.maxFPS = max(0, float(value))
+
+
+    ## Return the statistics of the images received and displayed, see
+    # RenderStats.getSummary.
+    def getRenderStats(self):
+        return self.stats.getSummary()
+
+
     def toggleFFT(self, event=None):
         if self.showFFT:
             self.showFFT = False
             self.image.setData(self.imageData)
         else:
             self.showFFT = True
-            self.image.setData(np.log(np.abs(np.fft.fftshift(np.fft.fft2(self.imageData))) + 1e-16))
+            self.showFFTOfCurrentImage()
+
+
+    ## Display the FFT of the current image: straight away if it has
+    # been computed already, or else once it has been computed.
+    def showFFTOfCurrentImage(self):
+        if self.imageData is None:
+            return
+        result = self.fftView.getCached(self.imageData)
+        if result is not None:
+            self.image.setData(result)
+            self.Refresh()
+        else:
+            self.fftQueue.put_nowait(self.imageData)
+
+
+    ## Let the user limit the size of the FFT, to keep up with large
+    # images.
+    def onSetFFTSize(self, event = None):
+        value = cockpit.gui.dialogs.getNumberDialog.getNumberFromUser(
+            parent = self, title = "Set FFT size",
+            prompt = "Largest FFT size in pixels (0 for the whole image)",
+            default = self.fftView.maxSize or 0)
+        self.fftView.setRegion(int(float(value)) or None,
+                               self.fftView.downsample)
+        if self.showFFT:
+            self.showFFTOfCurrentImage()
 
 
     ## Convert window co-ordinates to gl co-ordinates.
@@ -55,8 +55,6 @@ from cockpit.util import ftgl
 import numpy
 import os
 from OpenGL.GL import *
-import threading
-import time
 import wx
 
 from cockpit import events
@@ -77,13 +75,15 @@ MIN_DELTA_TO_DISPLAY = .01
 ARROW_LINE_THICKNESS = 3.5
 ## Bluntness of the arrowhead (pi/2 == totally blunt)
 ARROWHEAD_ANGLE = numpy.pi / 6.0
+## Time in milliseconds for which a movement arrow shows the stage motion
+# before it is cleared.
+MOTION_ARROW_TIME = 250
 
 
 ## This class handles some common code for the MacroStageXY and MacroStageZ
 # classes.
 class MacroStageBase(wx.glcanvas.GLCanvas):
-    ## Create the MacroStage. Mostly, attach a timer to the main window so
-    # that we can use it to trigger updates.
+    ## Create the MacroStage.
     def __init__(self, parent, size, id = -1, *args, **kwargs):
         super().__init__(parent, id, size = size, *args, **kwargs)
 
@@ -115,28 +115,24 @@ class MacroStageBase(wx.glcanvas.GLCanvas):
         self.prevStagePosition = numpy.zeros(3)
         ## As above, but for the current position.
         self.curStagePosition = numpy.zeros(3)
-        ## Event used to indicate when drawing is done, so we can update
-        # the above.
-        self.drawEvent = threading.Event()
+        ## Whether we are waiting to clear the movement arrow.
+        self.isClearingMotion = False
 
         ##objective offset info to get correct position and limits
         self.objective = depot.getHandlersOfType(depot.OBJECTIVE)[0]
         self.listObj = list(self.objective.nameToOffset.keys())
         self.listOffsets = list(self.objective.nameToOffset.values())
         self.offset = self.objective.getOffset()
- 
-        ## Boolean to just force a redraw.
-        self.shouldForceRedraw = False
-
-        ## Thread that ensures we don't spam redisplaying ourselves.
-        self.redrawTimerThread = threading.Thread(target=self.refreshWaiter, name="macrostage-refresh")
-        self.redrawTimerThread.start()
 
         self.Bind(wx.EVT_PAINT, self.onPaint)
         self.Bind(wx.EVT_SIZE, lambda event: event)
         self.Bind(wx.EVT_ERASE_BACKGROUND, lambda event: event) # Do nothing, to avoid flashing
-        events.subscribe(events.STAGE_POSITION, self.onMotion)
+        # Only the latest position of each axis matters.  This is
+        # handled in a thread of its own, which stops when we unsubscribe.
+        events.subscribe(events.STAGE_POSITION, self.onMotion, events.LATEST,
+                         key = lambda axis, position: axis)
         events.subscribe("stage step index", self.onStepIndexChange)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.onDestroy)
 
     ## Set up some set-once things for OpenGL.
     def initGL(self):
@@ -144,42 +140,47 @@ class MacroStageBase(wx.glcanvas.GLCanvas):
         glClearColor(1.0, 1.0, 1.0, 0.0)
 
 
-    ## Update our marker of where the stage currently is. This will indirectly
-    # cause us to redisplay ourselves in a bit, thanks to self.refreshWaiter.
+    ## Update our marker of where the stage currently is, and redisplay
+    # ourselves in our next frame.  Since the stage may move rapidly,
+    # cockpit.gui.ScheduleRefresh makes sure that we don't spam OpenGL
+    # calls.
     def onMotion(self, axis, position):
         self.curStagePosition[axis] = position
+        cockpit.gui.ScheduleRefresh(self)
+
+
+    ## Stop the thread that delivers stage positions to us.
+    def onDestroy(self, event):
+        events.unsubscribe(events.STAGE_POSITION, self.onMotion)
+        events.unsubscribe("stage step index", self.onStepIndexChange)
+        event.Skip()
 
 
     ## Step index has changed, so the highlighting on our step displays
     # is different.
     # \todo Redrawing *everything* at this stage seems a trifle excessive.
     def onStepIndexChange(self, index):
-        self.shouldForceRedraw = True
-
-
-    ## Wait until a minimum amount of time has passed since our last redraw
-    # before we redraw again. Since we redraw when the stage moves and
-    # these events may happen rapidly, this prevents us from spamming
-    # OpenGL calls.
-    def refreshWaiter(self):
-        while True:
-            if not self:
-                # Our window has been deleted; we're done here.
-                return
-            if (numpy.any(self.curStagePosition != self.prevStagePosition)
-                or self.shouldForceRedraw):
-                self.drawEvent.clear()
-                wx.CallAfter(self.Refresh)
-                self.drawEvent.wait()
-                self.prevStagePosition[:] = self.curStagePosition
-                # Draw again after a delay, so that motion arrows get
-                # cleared.
-                time.sleep(.25)
-                self.drawEvent.clear()
-                wx.CallAfter(self.Refresh)
-                self.drawEvent.wait()
-                self.shouldForceRedraw = False
-            time.sleep(.1)
+        cockpit.gui.ScheduleRefresh(self)
+
+
+    ## Called by our children once they have drawn themselves.  If they drew
+    # a movement arrow, draw again after a delay, so that it gets cleared.
+    def onDrawn(self):
+        if (numpy.any(self.curStagePosition != self.prevStagePosition)
+                and not self.isClearingMotion):
+            self.isClearingMotion = True
+            wx.CallLater(MOTION_ARROW_TIME, self.clearMotion)
+
+
+    ## Take the current stage position as the start of the next movement
+    # arrow, and redisplay ourselves without the current one.
+    def clearMotion(self):
+        self.isClearingMotion = False
+        if not self:
+            # Our window has been deleted.
+            return
+        self.prevStagePosition[:] = self.curStagePosition
+        cockpit.gui.ScheduleRefresh(self)
 
 
     ## Rescale the input value to be in the range 
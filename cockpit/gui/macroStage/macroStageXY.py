@@ -138,7 +138,7 @@ class MacroStageXY(macroStageBase.MacroStageBase):
     def onSafetyChange(self, axis, value, isMax):
         # We only care about the X and Y axes.
         if axis in [0, 1]:
-            wx.CallAfter(self.Refresh)
+            cockpit.gui.ScheduleRefresh(self)
 
 
     ## Draw the canvas. We draw the following:
@@ -333,9 +333,7 @@ class MacroStageXY(macroStageBase.MacroStageBase):
 
             glFlush()
             self.SwapBuffers()
-            # Set the event, so our refreshWaiter() can update
-            # our stage position info.
-            self.drawEvent.set()
+            self.onDrawn()
         except Exception as e:
             cockpit.util.logger.log.error("Exception drawing XY macro stage: %s", e)
             cockpit.util.logger.log.error(traceback.format_exc())
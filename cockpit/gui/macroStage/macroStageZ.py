@@ -56,6 +56,7 @@ import traceback
 import wx
 
 from cockpit import events
+import cockpit.gui
 import cockpit.interfaces.stageMover
 import cockpit.util.logger
 import cockpit.util.userConfig
@@ -224,7 +225,7 @@ class MacroStageZ(macroStageBase.MacroStageBase):
     def onStepSizeChange(self, axis: int, newSize: float) -> None:
         if axis == 2 and self.stepSize != newSize:
             self.stepSize = newSize
-            self.shouldForceRedraw = True
+            cockpit.gui.ScheduleRefresh(self)
 
     ## Generate the larger of the two histograms.
     def makeBigHistogram(self, altitude):
@@ -247,7 +248,7 @@ class MacroStageZ(macroStageBase.MacroStageBase):
             self.histograms.append(histogram)
         else:
             self.histograms[0] = histogram
-        wx.CallAfter(self.Refresh)
+        cockpit.gui.ScheduleRefresh(self)
 
 
     ## Overrides the parent function, since we may need to also generate a 
@@ -419,9 +420,7 @@ class MacroStageZ(macroStageBase.MacroStageBase):
 
             glFlush()
             self.SwapBuffers()
-            # Set the event, so our refreshWaiter() can update
-            # our stage position info.
-            self.drawEvent.set()
+            self.onDrawn()
         except Exception as e:
             cockpit.util.logger.log.error("Error drawing Z macro stage: %s", e)
             traceback.print_exc()
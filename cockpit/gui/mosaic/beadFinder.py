@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+## This module finds isolated beads in mosaic tiles.  It does not use wx
+# or OpenGL, so that findBeads can run in worker threads.
+
+import numpy
+import scipy.ndimage
+
+
+## Length in pixels of the square regions that a bead must be alone in.
+REGION_SIZE = 300
+
+## Number of standard deviations above the median that pixels of a bead
+# must be -- admittedly this is somewhat arbitrary.
+THRESHOLD_STDS = 15
+
+## Beads whose area is less than this fraction of the area of a circle
+# containing all their pixels are not circular enough.
+MIN_CIRCULARITY = .6
+
+
+## Find isolated, circular beads in the center tile of a composite of 3x3
+# tiles, as made by MosaicCanvas.getCompositeTileData.  A bead is
+# isolated if, for one of the regions of regionSize that overlap the
+# center tile in steps of a quarter of regionSize, it is the only
+# bead in the region and its centroid is in the middle half of the
+# region.
+#
+# The composite is labelled once, and each bead is then measured from its
+# own bounding box.
+# \return A list of (x, y, size, intensity) tuples, where (x, y) is the
+#         centroid of the bead in pixels of the center tile, size is its
+#         number of pixels and intensity the mean of those pixels.
+def findBeads(data, regionSize = REGION_SIZE):
+    data = numpy.asarray(data)
+    ny, nx = data.shape
+    # Threshold the data so that background becomes 0 and signal
+    # becomes 1.
+    mask = data > numpy.median(data) + numpy.std(data) * THRESHOLD_STDS
+    labels, numComponents = scipy.ndimage.label(mask)
+    if not numComponents:
+        return []
+    indices = numpy.arange(1, numComponents + 1)
+    sizes = numpy.bincount(labels.ravel(), minlength = numComponents + 1)
+    centroids = scipy.ndimage.center_of_mass(mask, labels, indices)
+    intensities = scipy.ndimage.mean(data, labels, indices)
+    slices = scipy.ndimage.find_objects(labels)
+
+    # Corners of the regions, over the center portion of the composite.
+    # Regions that don't fit (on the off-chance that regionSize is a
+    # significant portion of the tile size) are skipped.
+    step = max(1, regionSize // 4)
+    rowStarts = numpy.arange(ny // 3, 2 * ny // 3, step)
+    rowStarts = rowStarts[rowStarts + regionSize <= ny]
+    colStarts = numpy.arange(nx // 3, 2 * nx // 3, step)
+    colStarts = colStarts[colStarts + regionSize <= nx]
+
+    result = []
+    for label, (y, x), intensity, objSlice in zip(indices, centroids,
+                                                   intensities, slices):
+        # Regions that have the centroid in their middle half.  The bead
+        # must not be near the edge of the region, where it might be close
+        # to a bead in a different region.
+        rows = rowStarts[(rowStarts >= y - regionSize * .75)
+                         & (rowStarts <= y - regionSize * .25)]
+        cols = colStarts[(colStarts >= x - regionSize * .75)
+                         & (colStarts <= x - regionSize * .25)]
+        if not rows.size or not cols.size:
+            continue
+        if not any(isAlone(labels, label, j, k, regionSize)
+                   for j in rows for k in cols):
+            continue
+        # Ensure that the bead is circular, by comparing the area of the
+        # bead to the area of a circle containing all of the bead's
+        # pixels.
+        yVals, xVals = numpy.nonzero(labels[objSlice] == label)
+        maxDistSquared = ((xVals + objSlice[1].start - x) ** 2
+                          + (yVals + objSlice[0].start - y) ** 2).max()
+        if sizes[label] < MIN_CIRCULARITY * numpy.pi * maxDistSquared:
+            continue
+        result.append((x - nx / 3, y - ny / 3, int(sizes[label]),
+                       float(intensity)))
+    return result
+
+
+## Return True if label is the only component in the region of labels
+# with corner (row, col).
+def isAlone(labels, label, row, col, regionSize):
+    region = labels[row:row + regionSize, col:col + regionSize]
+    return not numpy.any((region != 0) & (region != label))
@@ -52,25 +52,258 @@
 ## POSSIBILITY OF SUCH DAMAGE.
 
 
+import collections
+import math
 import numpy
+import os
 from OpenGL.GL import *
 import traceback
 import wx.glcanvas
 
 from cockpit import depot
 from cockpit import events
-from cockpit.gui.mosaic.tile import Tile, MegaTile
-import cockpit.util.datadoc
+import cockpit.gui
+from cockpit.gui.mosaic.tile import Tile, MegaTile, textureBudget
+from cockpit.gui.mosaic.tileStore import (TileStore, STORE_EXTENSION,
+                                          INDEX_EXTENSION)
+import cockpit.util.Mrc
 import cockpit.util.logger
 import cockpit.util.threads
 import itertools
 import queue
+import threading
 import time
 import numpy as np
 
 ## Zoom level at which we switch from rendering megatiles to rendering tiles.
 ZOOM_SWITCHOVER = 1
+## Maximum number of batches of images waiting to be added to the mosaic.
 BUFFER_LENGTH = 32
+## Number of tiles handed to the canvas at a time when loading a mosaic.
+LOAD_BATCH_SIZE = 64
+## Limit on the memory used by cached region images, in bytes.
+REGION_CACHE_BYTES = 256 * 2**20
+
+
+## Uniform grid index over tile boxes, so that finding the tiles in a
+# region does not need to look at every tile.  Each tile is listed in
+# every cell its box overlaps.  Tiles are kept in the order they were
+# added, which is also the order in which they are returned, since it
+# is the order in which overlapping tiles are drawn.
+class TileGrid:
+    ## Source of serial numbers of grids.
+    serials = itertools.count()
+
+    ## \param cellSize Edge length of the grid cells, in microns.  If
+    #         None, use the largest dimension of the first tile added.
+    def __init__(self, cellSize = None):
+        self.fixedCellSize = cellSize
+        self.cellSize = cellSize
+        ## Maps (column, row) cells to the set of tiles overlapping them.
+        self.cells = collections.defaultdict(set)
+        ## Maps tiles to (insertion order, list of cells) tuples, in
+        # insertion order.
+        self.tileToEntry = {}
+        self.counter = itertools.count()
+        ## Identifies this grid and its contents: it changes whenever
+        # tiles are added or removed.
+        self.serial = next(TileGrid.serials)
+        self.version = 0
+
+
+    def __len__(self):
+        return len(self.tileToEntry)
+
+
+    def __iter__(self):
+        return iter(list(self.tileToEntry))
+
+
+    def __contains__(self, tile):
+        return tile in self.tileToEntry
+
+
+    ## Return (column range, row range) of the cells covering box.
+    def getCellRanges(self, box):
+        (x1, y1), (x2, y2) = box
+        size = self.cellSize
+        return (range(math.floor(min(x1, x2) / size),
+                      math.floor(max(x1, x2) / size) + 1),
+                range(math.floor(min(y1, y2) / size),
+                      math.floor(max(y1, y2) / size) + 1))
+
+
+    def add(self, tile):
+        if tile in self.tileToEntry:
+            return
+        if self.cellSize is None:
+            self.cellSize = max(tile.size) or 1
+        columns, rows = self.getCellRanges(tile.box)
+        cells = [(i, j) for i in columns for j in rows]
+        for cell in cells:
+            self.cells[cell].add(tile)
+        self.tileToEntry[tile] = (next(self.counter), cells)
+        self.version += 1
+
+
+    def extend(self, tiles):
+        for tile in tiles:
+            self.add(tile)
+
+
+    def remove(self, tile):
+        order, cells = self.tileToEntry.pop(tile)
+        self.version += 1
+        for cell in cells:
+            cellTiles = self.cells[cell]
+            cellTiles.discard(tile)
+            if not cellTiles:
+                del self.cells[cell]
+        if not self.tileToEntry:
+            self.cellSize = self.fixedCellSize
+
+
+    ## Return the tiles that intersect the (corner, corner) box, in the
+    # order they were added.
+    def getIntersecting(self, box):
+        if not self.tileToEntry:
+            return []
+        columns, rows = self.getCellRanges(box)
+        candidates = set()
+        if len(columns) * len(rows) > len(self.cells):
+            # Box covers more cells than are in use, e.g. when zoomed out.
+            for (i, j), cellTiles in self.cells.items():
+                if i in columns and j in rows:
+                    candidates.update(cellTiles)
+        else:
+            for i in columns:
+                for j in rows:
+                    cellTiles = self.cells.get((i, j))
+                    if cellTiles:
+                        candidates.update(cellTiles)
+        (x1, y1), (x2, y2) = box
+        box = ((min(x1, x2), min(y1, y2)), (max(x1, x2), max(y1, y2)))
+        result = [tile for tile in candidates if tile.intersectsBox(box)]
+        result.sort(key = lambda tile: self.tileToEntry[tile][0])
+        return result
+
+
+## Return the (rows, columns) shape of the image of the (corner, corner)
+# box with square pixels of pixelSize microns.
+def getRegionShape(box, pixelSize):
+    (x1, y1), (x2, y2) = box
+    return (max(1, int(round(abs(y2 - y1) / pixelSize))),
+            max(1, int(round(abs(x2 - x1) / pixelSize))))
+
+
+## Return indices as a slice if they are evenly spaced, so that indexing
+# with them gives a view instead of a copy.
+def _toSlice(indices):
+    if len(indices) == 1:
+        return slice(indices[0], indices[0] + 1)
+    step = indices[1] - indices[0]
+    if step > 0 and numpy.all(numpy.diff(indices) == step):
+        return slice(indices[0], indices[-1] + 1, step)
+    return indices
+
+
+## Return the image of the (corner, corner) box of the tiles in a
+# TileGrid, sampled with square pixels of pixelSize microns.  The image
+# is laid out like tile images, as they are drawn: columns go along X,
+# and rows go down from the top (largest Y) of the box.  Tiles are
+# sampled at the nearest pixel, and where they overlap the last tile
+# added wins, again as when they are drawn.  Pixels that no tile covers
+# are set to background.
+# \param dtype Type of a new image; defaults to that of the first tile.
+# \param out Array of the right shape to write the image to, instead of
+#        allocating a new one.
+def extractRegion(tiles, box, pixelSize, background = 0, dtype = None,
+                  out = None):
+    (x1, y1), (x2, y2) = box
+    minX, maxX = min(x1, x2), max(x1, x2)
+    minY, maxY = min(y1, y2), max(y1, y2)
+    shape = getRegionShape(box, pixelSize)
+    overlapping = tiles.getIntersecting(((minX, minY), (maxX, maxY)))
+    if out is None:
+        if dtype is None:
+            dtype = (overlapping[0].textureData.dtype if overlapping
+                     else numpy.float32)
+        out = numpy.empty(shape, dtype = dtype)
+    elif out.shape != shape:
+        raise ValueError("Region needs an array of shape %s, not %s"
+                         % (shape, out.shape))
+    out.fill(background)
+    # Centers of the pixels of the image; Y decreases down the rows.
+    xs = minX + (numpy.arange(shape[1]) + .5) * pixelSize
+    negYs = (numpy.arange(shape[0]) + .5) * pixelSize - maxY
+    for tile in overlapping:
+        data = tile.textureData
+        tileX, tileY = tile.pos[:2]
+        width, height = tile.size
+        colStart, colEnd = numpy.searchsorted(xs, [tileX, tileX + width])
+        rowStart, rowEnd = numpy.searchsorted(negYs,
+                                              [-tileY - height, -tileY],
+                                              side = 'right')
+        if colStart >= colEnd or rowStart >= rowEnd:
+            continue
+        cols = ((xs[colStart:colEnd] - tileX)
+                * (data.shape[1] / width)).astype(int)
+        rows = ((negYs[rowStart:rowEnd] + tileY + height)
+                * (data.shape[0] / height)).astype(int)
+        cols = _toSlice(numpy.clip(cols, 0, data.shape[1] - 1))
+        rows = _toSlice(numpy.clip(rows, 0, data.shape[0] - 1))
+        out[rowStart:rowEnd, colStart:colEnd] = data[rows][:, cols]
+    return out
+
+
+## Least recently used cache of region images, up to a limit on their
+# total size.
+class RegionCache:
+    ## \param maxBytes Limit on the memory used by the cached images.
+    def __init__(self, maxBytes = REGION_CACHE_BYTES):
+        self.maxBytes = maxBytes
+        ## Maps keys to images, least recently used first.
+        self.images = collections.OrderedDict()
+        ## Total bytes used by the images.
+        self.numBytes = 0
+        ## Number of lookups that were found, and not found, in the cache.
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+    ## Return the image for key, or None if it is not in the cache.
+    def get(self, key):
+        with self.lock:
+            image = self.images.get(key)
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.images.move_to_end(key)
+            return image
+
+
+    ## Cache an image.  It is made read-only, since it is shared by
+    # everyone who asks for it.
+    def put(self, key, image):
+        image.flags.writeable = False
+        with self.lock:
+            old = self.images.pop(key, None)
+            if old is not None:
+                self.numBytes -= old.nbytes
+            self.images[key] = image
+            self.numBytes += image.nbytes
+            while self.numBytes > self.maxBytes and len(self.images) > 1:
+                key, old = self.images.popitem(last = False)
+                self.numBytes -= old.nbytes
+
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.numBytes = 0
+
 
 ## This class handles drawing the mosaic. Mosaics consist of collections of 
 # images from the cameras.
@@ -78,13 +311,18 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
     ## Tiles and context are shared amongst all instances, since all
     # offer views of the same data.
     # The first instance creates the context.
-    ## List of MegaTiles. These will be created in self.initGL.
-    megaTiles = []
-    ## List of Tiles. These are created as we receive new images from
+    ## Cache of recent images from getRegionData.
+    regionCache = RegionCache()
+    ## TileGrid of MegaTiles. These will be created in self.initGL.
+    megaTiles = TileGrid()
+    ## TileGrid of Tiles. These are created as we receive new images from
     # our parent.
-    tiles = []
-    ## Set of tiles that need to be rerendered in the next onPaint call.
-    tilesToRefresh = set()
+    tiles = TileGrid()
+    ## TileStore that the image data of new tiles is appended to.  It is
+    # created with the first tile, and deleted on a clean exit.
+    store = None
+    ## Lock for creating the store.
+    storeLock = threading.Lock()
     ## WX rendering context
     context = None
 
@@ -113,12 +351,15 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
             MosaicCanvas.context = wx.glcanvas.GLContext(self)
             # Hook up onIdle - only one instance needs to process new tiles.
             self.Bind(wx.EVT_IDLE, self.onIdle)
+            # The mosaic window is only hidden when closed, so it is
+            # destroyed on exit.
+            self.Bind(wx.EVT_WINDOW_DESTROY, self.onDestroy)
 
         ## Error that occurred when rendering. If this happens, we prevent
         # further rendering to avoid error spew.
         self.renderError = None
 
-        ## A buffer of images waiting to be added to the mosaic.
+        ## A buffer of batches of images waiting to be added to the mosaic.
         self.pendingImages = queue.Queue(BUFFER_LENGTH)
 
         self.Bind(wx.EVT_PAINT, self.onPaint)
@@ -134,6 +375,9 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
     def initGL(self):
         glClearColor(1, 1, 1, 0)
 
+        textureMemory = wx.GetApp().Config['mosaic'].getint('texture-memory')
+        textureBudget.maxBytes = (textureMemory * 2**20) or None
+
         # Non-zero objective offsets require expansion of area covered
         # by megatiles.
         objs = depot.getHandlersOfType(depot.OBJECTIVE)
@@ -175,7 +419,7 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
         yMax += max(0, yOffLim[1]) + 2*MegaTile.micronSize
         for x in np.arange(xMin, xMax, MegaTile.micronSize):
             for y in np.arange(yMin, yMax, MegaTile.micronSize):
-                self.megaTiles.append(MegaTile((-x, y)))
+                self.megaTiles.add(MegaTile((-x, y)))
         self.haveInitedGL = True
 
 
@@ -189,7 +433,7 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
             tiles = self.megaTiles
         for tile in tiles:
             tile.recreateTexture()
-            tile.prerenderTiles(self.tiles)
+            tile.prerenderTiles(self.tiles.getIntersecting(tile.box))
 
 
     ## Delete all tiles and textures, including the megatiles.
@@ -201,72 +445,60 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
     ## Get all tiles that intersect the specified box, pulling from the provided
     # list, or from all tiles if no list is provided.
     def getTilesIntersecting(self, start, end, allowedTiles = None):
-        if allowedTiles is None:
-            allowedTiles = self.tiles
-        x1 = min(start[0], end[0])
-        x2 = max(start[0], end[0])
-        y1 = min(start[1], end[1])
-        y2 = max(start[1], end[1])
-        start = (x1, y1)
-        end = (x2, y2)
-        tiles = []
-        for tile in allowedTiles:
-            if tile.intersectsBox((start, end)):
-                tiles.append(tile)
+        if isinstance(allowedTiles, TileGrid):
+            return allowedTiles.getIntersecting((start, end))
+        tiles = self.tiles.getIntersecting((start, end))
+        if allowedTiles is not None:
+            if not isinstance(allowedTiles, (set, frozenset)):
+                allowedTiles = set(allowedTiles)
+            tiles = [tile for tile in tiles if tile in allowedTiles]
         return tiles
 
 
-    ## Generate a composite array of tile data surrounding the provided 
-    # tile, pulling only from the provided list of allowed tiles (or all
-    # tiles, if no list is provided).
-    def getCompositeTileData(self, tile, allowedTiles = None):
+    ## Return the image of the (start, end) box of the mosaic, with
+    # square pixels of pixelSize microns, as made by extractRegion.
+    # \param allowedTiles Tiles to use instead of all tiles.  If it is a
+    #        TileGrid, this is safe to use outside the main thread.
+    # \param useCache If True, look the image up in, and add it to, the
+    #        regionCache.  Cached images are read-only.  Images are cached
+    #        by the TileGrid they are made from, so allowedTiles must be
+    #        None or a TileGrid.
+    def getRegionData(self, start, end, pixelSize, allowedTiles = None,
+                      background = 0, useCache = False):
+        if (useCache and allowedTiles is not None
+                and not isinstance(allowedTiles, TileGrid)):
+            raise ValueError("Only regions of TileGrids can be cached")
         if allowedTiles is None:
-            allowedTiles = self.tiles
-        tileShape = tile.textureData.shape
-        # Start with a neutral background based on the tile's mean value.
-        result = numpy.ones((tileShape[0] * 3, tileShape[1] * 3), 
-                dtype = tile.textureData.dtype) * tile.textureData.mean()
-
-        # Get the bounding box 3x bigger than the tile with the tile at the 
-        # center.
+            tiles = self.tiles
+        elif isinstance(allowedTiles, TileGrid):
+            tiles = allowedTiles
+        else:
+            tiles = TileGrid()
+            tiles.extend(allowedTiles)
+        key = (tiles.serial, tiles.version, tuple(start), tuple(end),
+               pixelSize, background)
+        if useCache:
+            image = self.regionCache.get(key)
+            if image is not None:
+                return image
+        image = extractRegion(tiles, (start, end), pixelSize, background)
+        if useCache:
+            self.regionCache.put(key, image)
+        return image
+
+
+    ## Generate a composite array of tile data surrounding the provided
+    # tile, 3 times its size with the tile at the center, pulling only
+    # from the provided allowed tiles (or all tiles, if none are
+    # provided).  Pixels not covered by any tile are the tile's mean.
+    def getCompositeTileData(self, tile, allowedTiles = None):
         width, height = tile.size
-        tileX, tileY, tileZ = tile.pos
+        tileX, tileY = tile.pos[:2]
         start = (tileX - width, tileY - height)
         end = (tileX + width * 2, tileY + height * 2)
-        pixelSize = tile.getPixelSize()
-        for altTile in self.getTilesIntersecting(start, end, allowedTiles):
-            if altTile.getPixelSize() != pixelSize:
-                # Don't try to deal with tiles with differing pixel sizes.
-                continue
-            # Figure out the portion of altTile that intersects our region.
-            xMin = max(start[0], altTile.pos[0])
-            xMax = min(end[0], altTile.pos[0] + altTile.size[0])
-            yMin = max(start[1], altTile.pos[1])
-            yMax = min(end[1], altTile.pos[1] + altTile.size[1])
-            xPixels = (xMax - xMin) // pixelSize[0]
-            yPixels = (yMax - yMin) // pixelSize[1]
-            # Get the offset into altTile, and thus the relevant pixel data.
-            altX = (xMin - altTile.pos[0]) / pixelSize[0]
-            altY = (yMin - altTile.pos[1]) / pixelSize[1]
-            subRegion = altTile.textureData[altX:altX + xPixels, altY:altY + yPixels]
-            if 0 in subRegion.shape:
-                # The intersection is tangential; unlikely but can happen. 
-                # Skip this tile as it doesn't provide useful intersection.
-                continue
-            # Get the offset into result.
-            rX = max(0, (altTile.pos[0] - start[0]) / pixelSize[0])
-            rY = max(0, (altTile.pos[1] - start[1]) / pixelSize[1])
-            # HACK: for some reason that I don't understand, the above gives
-            # me swapped-and-offset X and Y axes. I need to swap them back
-            # while accounting for the difference in aspect ratio.
-            tX = rY * (float(tileShape[0]) / tileShape[1])
-            tY = rX * (float(tileShape[1]) / tileShape[0])
-            rX, rY = tX, tY
-            target = result[rX:rX + xPixels, rY:rY + yPixels]
-            target[:] = subRegion
-
-        return result
-
+        return self.getRegionData(start, end,
+                                  width / tile.textureData.shape[1],
+                                  allowedTiles, tile.textureData.mean())
 
 
     ## Delete all tiles that intersect the specified box.
@@ -280,17 +512,17 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
     def deleteTilesList(self, tilesToDelete):
         for tile in tilesToDelete:
             tile.wipe()
-            del self.tiles[self.tiles.index(tile)]
+            self.tiles.remove(tile)
+            if tile.store is not None and not tile.store.readOnly:
+                tile.store.markDeleted(tile.storeIndex)
         self.SetCurrent(self.context)
 
         # Rerender all megatiles that are now invalid.
-        dirtied = []
-        for megaTile in self.megaTiles:
-            for tile in tilesToDelete:
-                if megaTile.intersectsBox(tile.box):
-                    dirtied.append(megaTile)
-                    break
-        self.rerenderMegatiles(dirtied)
+        dirtied = {}
+        for tile in tilesToDelete:
+            for megaTile in self.megaTiles.getIntersecting(tile.box):
+                dirtied[megaTile] = None
+        self.rerenderMegatiles(list(dirtied))
         self.Refresh()
         events.publish(events.MOSAIC_UPDATE)
 
@@ -303,15 +535,23 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
         newTiles = []
         self.SetCurrent(self.context)
         while not self.pendingImages.empty() and (time.time()-t < 0.05):
-            data, pos, size, scalings, layer = self.pendingImages.get()
-            newTiles.append(Tile(data, pos, size, scalings, layer))
+            for (data, pos, size, scalings, layer,
+                 store, index) in self.pendingImages.get():
+                newTiles.append(Tile(store.getData(index), pos, size,
+                                     scalings, layer, store=store,
+                                     storeIndex=index))
         self.tiles.extend(newTiles)
-        for megaTile in self.megaTiles:
-            megaTile.prerenderTiles(newTiles)
-
-        self.tilesToRefresh.update(newTiles)
-
-        self.Refresh()
+        # Prerender by megatile, so that each megatile's framebuffer is
+        # bound once for all new tiles.  New tiles have no textures yet,
+        # so don't need refreshing.
+        megaTileToNewTiles = collections.defaultdict(list)
+        for tile in newTiles:
+            for megaTile in self.megaTiles.getIntersecting(tile.box):
+                megaTileToNewTiles[megaTile].append(tile)
+        for megaTile, tiles in megaTileToNewTiles.items():
+            megaTile.prerenderTiles(tiles)
+
+        cockpit.gui.ScheduleRefresh(self)
         events.publish(events.MOSAIC_UPDATE)
         if not self.pendingImages.empty():
             event.RequestMore()
@@ -320,21 +560,105 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
     ## Add a new image to the mosaic.
     #@cockpit.util.threads.callInMainThread
     def addImage(self, data, pos, size, scalings=(None, None), layer=0):
-        self.pendingImages.put((data, pos, size, scalings, layer))
+        self.addBatch([(data, pos, size, scalings, layer, None, None)])
+
+
+    ## Add a batch of images to the mosaic.  Each entry is a (data, pos,
+    # size, scalings, layer, store, index) tuple, where data is None and
+    # store and index are the TileStore and index of the image if it is
+    # already in one.  Blocks while the buffer is full, unless
+    # shouldStop is set.  Return False if shouldStop was set first.
+    # Images are appended to the store here, so that disk writes happen
+    # in the calling thread instead of the main thread; if the batch is
+    # not added, they are marked as deleted again.
+    def addBatch(self, batch, shouldStop = None):
+        if shouldStop is not None and shouldStop.is_set():
+            return False
+        batch = list(batch)
+        appended = []
+        for i, (data, pos, size, scalings, layer,
+                store, index) in enumerate(batch):
+            if store is None:
+                store = self.getStore()
+                index = store.append(data, pos, size, scalings, layer)
+                batch[i] = (None, pos, size, scalings, layer, store, index)
+                appended.append((store, index))
+        while True:
+            if shouldStop is not None and shouldStop.is_set():
+                for store, index in appended:
+                    store.markDeleted(index)
+                return False
+            try:
+                self.pendingImages.put(batch, timeout = .1)
+                return True
+            except queue.Full:
+                pass
+
+
+    ## Return the TileStore for new tiles, creating it in the mosaic
+    # store-dir if needed.
+    def getStore(self):
+        with self.storeLock:
+            if MosaicCanvas.store is None:
+                storeDir = wx.GetApp().Config['mosaic'].getpath('store-dir')
+                os.makedirs(storeDir, exist_ok=True)
+                path = os.path.join(storeDir,
+                                    time.strftime('mosaic-%Y%m%d-%H%M%S')
+                                    + STORE_EXTENSION)
+                MosaicCanvas.store = TileStore(path)
+        return MosaicCanvas.store
+
+
+    ## Close the store for new tiles and delete its files.  Saved mosaics
+    # have stores of their own, so nothing refers to it once cockpit exits.
+    # It is only left behind, to recover the mosaic from, if cockpit
+    # exits unexpectedly.
+    @classmethod
+    def removeStore(cls):
+        with cls.storeLock:
+            store, cls.store = cls.store, None
+        if store is None:
+            return
+        store.close()
+        for path in (store.path, store.indexPath):
+            try:
+                os.remove(path)
+            except OSError as e:
+                cockpit.util.logger.log.warning("Failed to remove the tile store file %s: %s" % (path, e))
+
 
+    def onDestroy(self, event):
+        if event.GetEventObject() is self:
+            self.removeStore()
+        event.Skip()
 
-    ## Rescale the tiles.
+
+    ## Return a TileStore for the tiles at path, which is read only unless
+    # it is the store for new tiles.
+    def openStore(self, path):
+        if (MosaicCanvas.store is not None
+            and os.path.abspath(path) == os.path.abspath(self.store.path)):
+            return MosaicCanvas.store
+        return TileStore(path, readOnly = True)
+
+
+    ## Rescale the tiles.  Contrast is applied when rendering, so this
+    # only needs to prerender again those megatiles whose tiles had
+    # different scalings, or all of them when rescaling tiles individually.
     # \param minMax A (blackpoint, whitepoint) tuple, or None to rescale
     # each tile individually.
     @cockpit.util.threads.callInMainThread
     def rescale(self, minMax = None):
         if minMax is None:
             # Tiles will treat this as "use our own data".
-            minMax = (None, None)
-        for tile in self.tiles:
-            tile.scaleHistogram(*minMax)
-        self.tilesToRefresh.update(self.tiles)
-        self.rerenderMegatiles()
+            for tile in self.tiles:
+                tile.scaleHistogram()
+            self.rerenderMegatiles()
+        else:
+            for tile in self.tiles:
+                tile.scaleHistogram(*minMax)
+            self.rerenderMegatiles([megaTile for megaTile in self.megaTiles
+                                    if not megaTile.rescale(*minMax)])
         self.Refresh()
 
 
@@ -359,10 +683,6 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
             glOrtho(-.375, width - .375, -.375, height - .375, 1, -1)
             glMatrixMode(GL_MODELVIEW)
 
-            for tile in self.tilesToRefresh:
-                tile.refresh()
-            self.tilesToRefresh = set()
-
             glMatrixMode(GL_MODELVIEW)
             glLoadIdentity()
             glTranslated(self.dx, self.dy, 0)
@@ -374,11 +694,11 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
             glEnable(GL_TEXTURE_2D)
             viewBox = self.getViewBox()
             if self.scale < ZOOM_SWITCHOVER:
-                for megaTile in self.megaTiles:
+                for megaTile in self.megaTiles.getIntersecting(viewBox):
                     megaTile.render(viewBox)
             else:
-                for tile in self.tiles:
-                    tile.render(viewBox)
+                for tile in self.tiles.getIntersecting(viewBox):
+                    tile.render(viewBox, self.scale)
             glDisable(GL_TEXTURE_2D)
 
             if self.overlayCallback is not None:
@@ -443,111 +763,162 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
         return (bottomLeft, topRight)
 
 
-    ## Given a path to a file, save the mosaic to that file and an adjacent
-    # file. The first is a text file that describes the layout of the tiles;
-    # the second is an MRC file that holds the actual image data.
+    ## Given a path to a file, save the mosaic to that file.  This is a text
+    # file that describes the layout of the tiles, and refers to a
+    # TileStore next to it, named after it, that holds the image data of
+    # only the saved tiles.  The files are only written if the user does
+    # not cancel.
     def saveTiles(self, savePath):
+        tiles = list(self.tiles)
         statusDialog = wx.ProgressDialog(parent = self.GetParent(),
                 title = "Saving...",
                 message = "Saving mosaic image data...", 
-                maximum = len(self.tiles))
-        handle = open(savePath, 'w')
-        mrcPath = savePath + '.mrc'
-        if '.txt' in savePath:
-            mrcPath = savePath.replace('.txt', '.mrc')
-        handle.write("%s\n" % mrcPath)
-        width = 0
-        height = 0
-        for tile in self.tiles:
-            width = max(width, tile.textureData.shape[0])
-            height = max(height, tile.textureData.shape[1])
-            # We do this by a series of extensions since some of these lists
-            # may be Numpy arrays, which don't do array extension when you
-            # "add" them.
-            values = []
-            values.extend(tile.pos)
-            values.extend(tile.size)
-            values.extend(tile.textureData.shape)
-            values.extend(tile.histogramScale)
-            values.append(tile.layer)
-            values = map(str, values)
-            handle.write(','.join(values) + '\n')
-        handle.close()
-
-        # Now we have the max image extent in X and Y, we can pile everything
-        # into a single array for saving as an MRC file. Images smaller than
-        # the max will be padded with zeros.
-        imageData = numpy.zeros((1, 1, len(self.tiles), width, height),
-                dtype = numpy.uint16)
-        for i, tile in enumerate(self.tiles):
-            imageData[0, 0, i, :tile.textureData.shape[0], :tile.textureData.shape[1]] = tile.textureData
-        header = cockpit.util.datadoc.makeHeaderFor(imageData)
-
-        handle = open(mrcPath, 'wb')
-        cockpit.util.datadoc.writeMrcHeader(header, handle)
-        for i, image in enumerate(imageData[:,:]):
-            handle.write(image)
-            statusDialog.Update(i)
-        handle.close()
-        statusDialog.Destroy()
-
-
-    ## Load a text file describing a set of tiles, as well as the tile image
-    # data. This is made a bit trickier by the fact that we want to display
-    # a progress dialog that updates as new images are added, but addImage()
-    # must run in the main thread while we run in a different one ...
-    # although maybe not since MAP added a queue and a thread to process
-    # new tiles.
-    @cockpit.util.threads.callInNewThread
-    def loadTiles(self, filePath):
-        with open(filePath, 'r') as handle:
-            mrcPath = handle.readline().strip()
-            tileStats = []
-            for line in handle:
-                # X position, Y position, Z position, 
-                # X micron size, Y micron size,
-                # X pixel size, Y pixel size, blackpoint, whitepoint, layer.
-                # We'll have to convert the pixel sizes and layer to
-                # ints later.
-                tileStats.append(list(map(float, line.strip().split(','))))
+                maximum = max(1, len(tiles)),
+                style = wx.PD_APP_MODAL | wx.PD_AUTO_HIDE | wx.PD_CAN_ABORT)
         try:
-            doc = cockpit.util.datadoc.DataDoc(mrcPath)
-        except Exception as e:
-            wx.MessageDialog(self.GetParent(), 
-                    message = "I was unable to load the MRC file at\n%s\nholding the tile data. The error message was:\n\n%s\n\nPlease verify that the file path is correct and the file is valid." % (mrcPath, e),
-                    style = wx.ICON_INFORMATION | wx.OK).ShowModal()
-            return
-        # NOTE: this dialog is not safe to Update, since the update calls must
-        # be referred to the main thread (via wx.CallAfter) and may arrive
-        # in an unpredictable order. Due to the unpredictable order, the call
-        # to Destroy (which must also happen in the main thread via CallAfter)
-        # may arrive before all of the Update calls are processed, resulting
-        # in a segfault.
+            self.writeTiles(tiles, savePath,
+                            lambda i: statusDialog.Update(i)[0])
+        finally:
+            statusDialog.Destroy()
+
+
+    ## Do the work of saveTiles.  reportProgress is called with the number
+    # of tiles written so far, and returns False to cancel.  Return
+    # whether the mosaic was saved.
+    def writeTiles(self, tiles, savePath, reportProgress):
+        storePath = savePath + STORE_EXTENSION
+        partPath = savePath + '.part'
+        storePartPath = storePath + '.part'
+        store = TileStore(storePartPath)
+        shouldContinue = True
+        try:
+            with open(partPath, 'w') as handle:
+                # The store is found relative to the saved file, so that
+                # the two can be moved together.
+                handle.write("%s\n" % os.path.basename(storePath))
+                for i, tile in enumerate(tiles):
+                    index = store.append(tile.textureData, tile.pos,
+                                         tile.size, tile.histogramScale,
+                                         tile.layer)
+                    # We do this by a series of extensions since some of
+                    # these lists may be Numpy arrays, which don't do array
+                    # extension when you "add" them.
+                    values = []
+                    values.extend(tile.pos)
+                    values.extend(tile.size)
+                    values.extend(tile.textureData.shape)
+                    values.extend(tile.histogramScale)
+                    values.append(tile.layer)
+                    values.append(index)
+                    values = map(str, values)
+                    handle.write(','.join(values) + '\n')
+                    shouldContinue = reportProgress(i)
+                    if not shouldContinue:
+                        break
+            if shouldContinue:
+                store.flush()
+                store.close()
+                os.replace(storePartPath + INDEX_EXTENSION,
+                           storePath + INDEX_EXTENSION)
+                os.replace(storePartPath, storePath)
+                os.replace(partPath, savePath)
+        finally:
+            store.close()
+            for path in (partPath, storePartPath,
+                         storePartPath + INDEX_EXTENSION):
+                if os.path.exists(path):
+                    os.remove(path)
+        return shouldContinue
+
+
+    ## Load a mosaic saved to a text file describing a set of tiles, which
+    # also refers to the tile image data.  Tile image data are in a
+    # TileStore or, for mosaics saved by older versions, in an MRC file.
+    # filePath may also be the data file of a TileStore, e.g. one left
+    # behind by a crash, in which case all of its tiles are loaded.
+    # Tiles are read and handed to the canvas in batches by a background
+    # thread, and the user can cancel loading from a progress dialog.
+    def loadTiles(self, filePath):
         statusDialog = wx.ProgressDialog(parent = self.GetParent(),
                 title = "Loading...",
-                message = "Loading mosaic image data...")
+                message = "Loading mosaic image data...",
+                style = wx.PD_AUTO_HIDE | wx.PD_CAN_ABORT)
         statusDialog.Show()
-        if doc.imageArray.shape[2] > len(tileStats):
-            # More images in the file than we have stats for.
-            cockpit.util.logger.log.warning("Loading mosaic with %d images; only have positioning information for %d." % (doc.imageArray.shape[2], len(tileStats)))
-        maxImages = min(doc.imageArray.shape[2], len(tileStats))
-        for i in range(maxImages):
-            image = doc.imageArray[0, 0, i]
-            stats = tileStats[i]
-            try:
-                data = image[:int(stats[5]), :int(stats[6])]
-                self.addImage(data, stats[:3], stats[3:5], stats[7:9], 
-                            int(stats[9]))
-            except Exception as e:
-                wx.MessageDialog(self.GetParent(),
-                        "Failed to load line %d of file %s: %s.\n\nPlease see the logs for more details." % (i, filePath, e),
-                        style = wx.ICON_INFORMATION | wx.OK).ShowModal()
-                cockpit.util.logger.log.error(traceback.format_exc())
-                statusDialog.Destroy()
+        shouldStop = threading.Event()
+        # The dialog is only touched in the main thread, with calls from
+        # the loading thread made via wx.CallAfter so that they stay in
+        # order.
+        def onProgress(count, total):
+            if shouldStop.is_set():
+                return
+            statusDialog.SetRange(max(1, total))
+            shouldContinue, skip = statusDialog.Update(min(count, total))
+            if not shouldContinue:
+                shouldStop.set()
+        def onDone():
+            shouldStop.set()
+            statusDialog.Destroy()
+        self.loadTilesInThread(filePath, shouldStop,
+                               lambda *args: wx.CallAfter(onProgress, *args),
+                               lambda: wx.CallAfter(onDone))
+
+
+    ## Show an error message from a background thread.
+    def showLoadError(self, message):
+        wx.CallAfter(lambda: wx.MessageDialog(self.GetParent(), message,
+                style = wx.ICON_INFORMATION | wx.OK).ShowModal())
+
+
+    ## Do the work of loadTiles.  reportProgress is called with the number
+    # of tiles handed to the canvas so far and the total, and reportDone
+    # once finished.  Stop early if shouldStop is set.
+    @cockpit.util.threads.callInNewThread
+    def loadTilesInThread(self, filePath, shouldStop, reportProgress,
+                          reportDone):
+        try:
+            if filePath.endswith(STORE_EXTENSION):
+                entries = self.getStoredTileEntries(filePath, None)
+            else:
+                with open(filePath, 'r') as handle:
+                    mrcPath = handle.readline().strip()
+                    tileStats = []
+                    for line in handle:
+                        # X position, Y position, Z position, 
+                        # X micron size, Y micron size,
+                        # X pixel size, Y pixel size, blackpoint, whitepoint,
+                        # layer, and the index in the tile store, if any.
+                        # We'll have to convert the pixel sizes, layer and
+                        # index to ints later.
+                        tileStats.append(list(map(float,
+                                                  line.strip().split(','))))
+                if mrcPath.endswith(STORE_EXTENSION):
+                    # Older versions wrote the absolute path of the store.
+                    storePath = os.path.join(os.path.dirname(filePath),
+                                             mrcPath)
+                    entries = self.getStoredTileEntries(storePath, tileStats)
+                else:
+                    entries = self.getMrcTileEntries(mrcPath, tileStats)
+            if entries is None:
                 return
-        # Wait until we've loaded all tiles or we go a full second without
-        # any new tiles arriving.
-        numExpectedTiles = len(self.tiles) + len(tileStats)
+            numExpectedTiles = len(self.tiles) + len(entries)
+            for start in range(0, len(entries), LOAD_BATCH_SIZE):
+                batch = entries[start:start + LOAD_BATCH_SIZE]
+                if not self.addBatch(batch, shouldStop):
+                    numExpectedTiles -= len(entries) - start
+                    break
+                reportProgress(start + len(batch), len(entries))
+            self.waitForTiles(numExpectedTiles)
+        except Exception as e:
+            self.showLoadError("Failed to load the mosaic in %s: %s.\n\nPlease see the logs for more details." % (filePath, e))
+            cockpit.util.logger.log.error(traceback.format_exc())
+        finally:
+            reportDone()
+            events.publish(events.MOSAIC_UPDATE)
+
+
+    ## Wait until we have numExpectedTiles tiles or we go a full second
+    # without any new tiles arriving.
+    def waitForTiles(self, numExpectedTiles):
         lastUpdatedTime = time.time()
         curCount = len(self.tiles)
         while len(self.tiles) != numExpectedTiles:
@@ -558,5 +929,50 @@ class MosaicCanvas(wx.glcanvas.GLCanvas):
             if time.time() - lastUpdatedTime > 1:
                 break
             time.sleep(.1)
-        wx.CallAfter(statusDialog.Destroy)
-        events.publish(events.MOSAIC_UPDATE)
+
+
+    ## Return the addBatch entries for tiles in the TileStore at
+    # storePath, or None if it can't be opened.  tileStats is the list of
+    # tile stats from a saved mosaic, each with the index of the tile in
+    # the store last, or None to load all tiles that were not deleted
+    # with the scalings they were added with.
+    def getStoredTileEntries(self, storePath, tileStats):
+        try:
+            store = self.openStore(storePath)
+        except Exception as e:
+            self.showLoadError("I was unable to open the tile store at\n%s\nholding the tile data. The error message was:\n\n%s\n\nPlease verify that the file path is correct and the file is valid." % (storePath, e))
+            return None
+        if tileStats is None:
+            tiles = [(index,) + store.getTileInfo(index)
+                     for index in store.getLiveIndices()]
+        else:
+            tiles = [(int(stats[10]), stats[:3], stats[3:5], stats[7:9],
+                      int(stats[9])) for stats in tileStats]
+        entries = []
+        for index, pos, size, scalings, layer in tiles:
+            if not 0 <= index < len(store):
+                cockpit.util.logger.log.warning("Tile %d is not in the tile store %s; skipping it." % (index, storePath))
+                continue
+            entries.append((None, pos, size, scalings, layer, store, index))
+        return entries
+
+
+    ## Return the addBatch entries for tiles in an MRC file written by
+    # older versions, or None if it can't be opened.  The file is memory
+    # mapped, and images are only read as they are added to the mosaic.
+    def getMrcTileEntries(self, mrcPath, tileStats):
+        try:
+            data = cockpit.util.Mrc.bindFile(mrcPath)
+        except Exception as e:
+            self.showLoadError("I was unable to load the MRC file at\n%s\nholding the tile data. The error message was:\n\n%s\n\nPlease verify that the file path is correct and the file is valid." % (mrcPath, e))
+            return None
+        images = data.reshape((-1,) + data.shape[-2:])
+        if len(images) > len(tileStats):
+            # More images in the file than we have stats for.
+            cockpit.util.logger.log.warning("Loading mosaic with %d images; only have positioning information for %d." % (len(images), len(tileStats)))
+        entries = []
+        for image, stats in zip(images, tileStats):
+            entries.append((image[:int(stats[5]), :int(stats[6])],
+                            stats[:3], stats[3:5], stats[7:9], int(stats[9]),
+                            None, None))
+        return entries
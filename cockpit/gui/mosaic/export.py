@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+## This module exports a region of the mosaic as a single stitched image.
+# The image is made and written in strips of rows, so that only one
+# strip is ever in memory, whatever the size of the image.
+
+import os
+import struct
+
+import numpy
+
+import cockpit.util.Mrc
+from cockpit.gui.mosaic.canvas import extractRegion, getRegionShape
+
+
+## Limit on the memory used by each strip of an exported image, in bytes.
+EXPORT_STRIP_BYTES = 64 * 2**20
+
+## Types that exported images can have.  Tiles of other types are
+# exported as float32.
+EXPORT_DTYPES = (numpy.uint8, numpy.uint16, numpy.int16, numpy.int32,
+                 numpy.float32)
+
+
+## Writes an image to an MRC file, a strip of rows at a time.
+class MrcWriter:
+    def __init__(self, path, shape, dtype, pixelSize):
+        self.mrc = cockpit.util.Mrc.Mrc2(path, 'w')
+        self.mrc.setHdrForShapeType(shape, dtype)
+        self.mrc.hdr.d = (pixelSize, pixelSize, 1)
+        self.mrc.writeHeader()
+        self.mrc.seekSec(0)
+        ## Minimum, maximum and sum of the pixels written so far.
+        self.minVal = None
+        self.maxVal = None
+        self.total = 0
+        self.numPixels = 0
+
+
+    def writeRows(self, rows):
+        self.mrc.writeStack(rows)
+        minVal, maxVal = rows.min(), rows.max()
+        if self.minVal is None or minVal < self.minVal:
+            self.minVal = minVal
+        if self.maxVal is None or maxVal > self.maxVal:
+            self.maxVal = maxVal
+        self.total += rows.sum(dtype = numpy.float64)
+        self.numPixels += rows.size
+
+
+    ## Finish writing the header, now that we know the image statistics.
+    def close(self):
+        if self.numPixels:
+            self.mrc.hdr.mmm1 = (self.minVal, self.maxVal,
+                                 self.total / self.numPixels)
+        self.mrc.writeHeader()
+        self.mrc.close()
+
+
+    def abort(self):
+        self.mrc.close()
+
+
+## Writes an image to a BigTIFF file, a strip of rows at a time.  Each
+# strip is one TIFF strip, so all but the last must have the same number
+# of rows.  The image file directory is written at the end, once the
+# strip offsets are known.
+class BigTiffWriter:
+    ## TIFF tag types.
+    SHORT = 3
+    LONG = 4
+    ASCII = 2
+    LONG8 = 16
+    ## Maps numpy kinds to the TIFF SampleFormat.
+    kindToSampleFormat = {'u': 1, 'i': 2, 'f': 3}
+
+    def __init__(self, path, shape, dtype, pixelSize):
+        self.shape = shape
+        self.dtype = numpy.dtype(dtype).newbyteorder('<')
+        self.pixelSize = pixelSize
+        self.file = open(path, 'wb')
+        # Header; the offset of the image file directory is filled in by
+        # close.
+        self.file.write(struct.pack('<2sHHHQ', b'II', 43, 8, 0, 0))
+        ## Offset and byte count of each strip written so far.
+        self.stripOffsets = []
+        self.stripByteCounts = []
+        ## Number of rows in the first strip.
+        self.rowsPerStrip = None
+
+
+    def writeRows(self, rows):
+        if self.rowsPerStrip is None:
+            self.rowsPerStrip = len(rows)
+        elif len(self.stripOffsets) and (self.stripByteCounts[-1]
+                != self.rowsPerStrip * self.shape[1] * self.dtype.itemsize):
+            raise ValueError("Only the last strip may be short")
+        self.stripOffsets.append(self.file.tell())
+        data = numpy.ascontiguousarray(rows, dtype = self.dtype)
+        self.file.write(data.reshape(-1).view(numpy.uint8))
+        self.stripByteCounts.append(data.nbytes)
+
+
+    ## Write the image file directory and point the header at it.
+    def close(self):
+        description = ('Mosaic export, pixel size %g um'
+                       % self.pixelSize).encode() + b'\0'
+        entries = [
+            (256, self.LONG, [self.shape[1]]),
+            (257, self.LONG, [self.shape[0]]),
+            (258, self.SHORT, [self.dtype.itemsize * 8]),
+            (259, self.SHORT, [1]),
+            (262, self.SHORT, [1]),
+            (270, self.ASCII, description),
+            (273, self.LONG8, self.stripOffsets),
+            (277, self.SHORT, [1]),
+            (278, self.LONG, [self.rowsPerStrip or self.shape[0]]),
+            (279, self.LONG8, self.stripByteCounts),
+            (284, self.SHORT, [1]),
+            (339, self.SHORT, [self.kindToSampleFormat[self.dtype.kind]]),
+        ]
+        # Values that do not fit in an entry go after the directory.
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() % 2:
+            self.file.write(b'\0')
+        ifdOffset = self.file.tell()
+        extraOffset = ifdOffset + 8 + 20 * len(entries) + 8
+        ifd = [struct.pack('<Q', len(entries))]
+        extra = []
+        for tag, tagType, values in entries:
+            if tagType == self.ASCII:
+                value = bytes(values)
+            else:
+                value = struct.pack('<%d%s' % (len(values),
+                        {self.SHORT: 'H', self.LONG: 'I',
+                         self.LONG8: 'Q'}[tagType]), *values)
+            if len(value) <= 8:
+                field = value.ljust(8, b'\0')
+            else:
+                field = struct.pack('<Q', extraOffset)
+                extra.append(value)
+                extraOffset += len(value)
+            ifd.append(struct.pack('<HHQ', tag, tagType, len(values)) + field)
+        ifd.append(struct.pack('<Q', 0))
+        self.file.write(b''.join(ifd + extra))
+        self.file.seek(8)
+        self.file.write(struct.pack('<Q', ifdOffset))
+        self.file.close()
+
+
+    def abort(self):
+        self.file.close()
+
+
+## Maps file extensions to the writers for them.
+extensionToWriter = {
+    '.mrc': MrcWriter,
+    '.dv': MrcWriter,
+    '.tif': BigTiffWriter,
+    '.tiff': BigTiffWriter,
+}
+
+
+## Return the type to export tiles of type dtype as.
+def getExportDtype(dtype):
+    dtype = numpy.dtype(dtype)
+    if dtype.type in EXPORT_DTYPES:
+        return dtype.newbyteorder('=')
+    return numpy.dtype(numpy.float32)
+
+
+## Export the (corner, corner) box of the tiles in a TileGrid to path, as
+# a single image with square pixels of pixelSize microns, as made by
+# extractRegion.  The file is written under a temporary name, which is
+# only renamed to path once it is complete.
+# \param shouldStop Event that stops the export early if set.
+# \param reportProgress Function called with the number of rows written
+#        so far and the total.
+# \return True if the image was exported, False if it was stopped.
+def exportRegion(tiles, box, pixelSize, path, background = 0,
+                 shouldStop = None, reportProgress = None):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in extensionToWriter:
+        raise ValueError("Can't export to %s files; use one of %s"
+                         % (ext, ', '.join(sorted(extensionToWriter))))
+    (x1, y1), (x2, y2) = box
+    minX, maxY = min(x1, x2), max(y1, y2)
+    shape = getRegionShape(box, pixelSize)
+    overlapping = tiles.getIntersecting(box)
+    dtype = getExportDtype(overlapping[0].textureData.dtype if overlapping
+                           else numpy.float32)
+    stripRows = max(1, min(shape[0],
+            EXPORT_STRIP_BYTES // (shape[1] * dtype.itemsize)))
+    buffer = numpy.empty((stripRows, shape[1]), dtype = dtype)
+
+    partPath = path + '.part'
+    writer = extensionToWriter[ext](partPath, shape, dtype, pixelSize)
+    try:
+        for start in range(0, shape[0], stripRows):
+            if shouldStop is not None and shouldStop.is_set():
+                writer.abort()
+                os.remove(partPath)
+                return False
+            numRows = min(stripRows, shape[0] - start)
+            top = maxY - start * pixelSize
+            stripBox = ((minX, top - numRows * pixelSize),
+                        (minX + shape[1] * pixelSize, top))
+            writer.writeRows(extractRegion(tiles, stripBox, pixelSize,
+                                           background,
+                                           out = buffer[:numRows]))
+            if reportProgress is not None:
+                reportProgress(start + numRows, shape[0])
+        writer.close()
+    except:
+        writer.abort()
+        os.remove(partPath)
+        raise
+    os.replace(partPath, path)
+    return True
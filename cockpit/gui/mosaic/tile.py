@@ -50,6 +50,9 @@
 ## POSSIBILITY OF SUCH DAMAGE.
 
 
+import collections
+import ctypes
+
 import numpy
 from OpenGL.GL import *
 from OpenGL.GL.framebufferobjects import *
@@ -57,16 +60,6 @@ from OpenGL.GL.framebufferobjects import *
 ## This module contains the Tile and MegaTile classes, along with some
 # supporting functions and constants.
 
-## Finds the smallest powers of two that will contain a texture with the 
-# specified dimensions.
-def getTexSize(width, height):
-    result = [2, 2]
-    for i, val in enumerate([width, height]):
-        while result[i] < val:
-            result[i] *= 2
-    return tuple(result)
-
-
 ## Maps numpy datatypes to OpenGL datatypes
 dtypeToGlTypeMap = {
     numpy.uint8: GL_UNSIGNED_BYTE,
@@ -80,10 +73,263 @@ dtypeToGlTypeMap = {
     numpy.complex128: GL_FLOAT,
 }
 
-## This class handles a single tile in the mosaic.
+## Maps numpy datatypes to the internal format of their textures.  Textures
+# keep the data as they are, so 8 and 16 bit unsigned data keep their
+# size, and everything else is stored as floats.
+dtypeToInternalFormatMap = {
+    numpy.uint8: GL_R8,
+    numpy.uint16: GL_R16,
+}
+
+## Bytes of video memory used per texel of each texture internal format.
+internalFormatToBytesMap = {
+    GL_R8: 1,
+    GL_R16: 2,
+    GL_R32F: 4,
+}
+
+## Downsampling factor of each level of detail kept for a tile, finest
+# first.
+LEVEL_FACTORS = (1, 2, 4, 16)
+
+## Default limit on the video memory used by tile textures, in bytes.
+DEFAULT_TEXTURE_MEMORY = 1024 * 2**20
+
+## Limit on the video memory used by deleted textures kept for reuse, in
+# bytes.
+TEXTURE_POOL_MEMORY = 64 * 2**20
+
+
+## Reduce an image by factor in each dimension, by averaging blocks of
+# factor x factor pixels.  Pixels at the edges that do not fill a block
+# are dropped.
+def downsample(image, factor):
+    ny, nx = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:ny * factor, :nx * factor].reshape(ny, factor, nx, factor)
+    return blocks.mean(axis = (1, 3)).astype(image.dtype)
+
+
+## Return the bytes of video memory used by a texture of (width, height,
+# internalFormat).
+def getTextureBytes(key):
+    width, height, internalFormat = key
+    return width * height * internalFormatToBytesMap[internalFormat]
+
+
+## Return the value of data that OpenGL normalizes to 1 when uploading
+# data of type dtype, since integer data are mapped to [0, 1] ([-1, 1] if
+# signed) and floats are kept as they are.
+def getMaxTexelValue(dtype):
+    dtype = numpy.dtype(dtype)
+    if dtype.type == numpy.uint16:
+        return (1<<16) -1
+    elif dtype.type == numpy.int16:
+        return (1<<15) -1
+    elif dtype.type == numpy.uint8:
+        return (1<<8) -1
+    return 1
+
+
+## Return the (gain, offset) to apply to texels of data of type dtype so
+# that minVal maps to 0 and maxVal to 1.  If targetScale is given, map
+# to the (blackpoint, whitepoint) of a render target instead, so that
+# the target shows the same when drawn with targetScale.
+def getContrastUniforms(dtype, minVal, maxVal, targetScale = None):
+    mmrange = float(maxVal) - float(minVal)
+    gain = getMaxTexelValue(dtype) / mmrange
+    offset = -float(minVal) / mmrange
+    if targetScale is not None:
+        targetRange = float(targetScale[1]) - float(targetScale[0])
+        gain *= targetRange
+        offset = float(targetScale[0]) + offset * targetRange
+    return gain, offset
+
+
+## Fragment shader that applies contrast to the red channel of a
+# texture, which holds the raw data.  The result is not clamped, so that
+# floating point render targets keep values outside [0, 1]; the screen
+# clamps them.
+_CONTRAST_FS = """
+#version 120
+uniform sampler2D tex;
+uniform float gain;
+uniform float offset;
+
+void main()
+{
+    float value = offset + gain * texture2D(tex, gl_TexCoord[0].st).r;
+    gl_FragColor = vec4(value, value, value, 1.0);
+}
+"""
+
+## Shader program for _CONTRAST_FS.  Set to None initially since we have
+# to wait for OpenGL to get set up in our window before we can compile
+# it.
+contrastShader = None
+
+
+## Return the contrast shader program, compiling it if needed.
+def getContrastShader():
+    global contrastShader
+    if contrastShader is None:
+        shader = glCreateShader(GL_FRAGMENT_SHADER)
+        glShaderSource(shader, _CONTRAST_FS)
+        glCompileShader(shader)
+        if not glGetShaderiv(shader, GL_COMPILE_STATUS):
+            raise RuntimeError(glGetShaderInfoLog(shader))
+        program = glCreateProgram()
+        glAttachShader(program, shader)
+        glLinkProgram(program)
+        if not glGetProgramiv(program, GL_LINK_STATUS):
+            raise RuntimeError(glGetProgramInfoLog(program))
+        contrastShader = program
+    return contrastShader
+
+
+## Keeps track of the video memory used by tile textures, and deletes the
+# textures used least recently to keep within a limit.  Deleted textures
+# are uploaded again when next rendered.
+class TextureBudget:
+    ## \param maxBytes Limit on the video memory to use, or None for
+    #         no limit.
+    def __init__(self, maxBytes = DEFAULT_TEXTURE_MEMORY):
+        self.maxBytes = maxBytes
+        ## Maps (tile, level) to the bytes used by its texture, least
+        # recently used first.
+        self.textures = collections.OrderedDict()
+        ## Total bytes used by the textures.
+        self.numBytes = 0
+        ## Number of textures deleted to keep within the limit.
+        self.numEvicted = 0
+
+
+    ## Mark the texture of a tile's level as used, and evict others if
+    # that takes us over the limit.
+    def touch(self, tile, level):
+        key = (tile, level)
+        if key in self.textures:
+            self.textures.move_to_end(key)
+            return
+        numBytes = tile.getTextureBytes(level)
+        self.textures[key] = numBytes
+        self.numBytes += numBytes
+        self.evict()
+
+
+    ## Forget about a texture that has been deleted.
+    def discard(self, tile, level):
+        numBytes = self.textures.pop((tile, level), None)
+        if numBytes is not None:
+            self.numBytes -= numBytes
+
+
+    ## Delete least recently used textures until within the limit.  The
+    # most recently used texture is always kept, since it is about to
+    # be drawn.
+    def evict(self):
+        if self.maxBytes is None:
+            return
+        while self.numBytes > self.maxBytes and len(self.textures) > 1:
+            (tile, level), numBytes = self.textures.popitem(last = False)
+            self.numBytes -= numBytes
+            self.numEvicted += 1
+            tile.deleteTexture(level)
+
+
+## Keeps deleted textures so that they can be reused for new textures
+# of the same size, instead of allocating storage for a new texture
+# every time one is uploaded.
+class TexturePool:
+    ## \param maxBytes Limit on the video memory used by pooled textures.
+    def __init__(self, maxBytes = TEXTURE_POOL_MEMORY):
+        self.maxBytes = maxBytes
+        ## Maps (width, height, internalFormat) to a list of free textures
+        # of that size and format.
+        self.textures = collections.defaultdict(list)
+        ## Total bytes used by the pooled textures.
+        self.numBytes = 0
+
+
+    ## Return a free texture of (width, height, internalFormat), or None
+    # if there is none.
+    def get(self, key):
+        textures = self.textures.get(key)
+        if not textures:
+            return None
+        self.numBytes -= getTextureBytes(key)
+        return textures.pop()
+
+
+    ## Keep a texture that is no longer used, or delete it if the pool
+    # is full.
+    def put(self, key, texture):
+        numBytes = getTextureBytes(key)
+        if self.numBytes + numBytes > self.maxBytes:
+            glDeleteTextures([texture])
+            return
+        self.textures[key].append(texture)
+        self.numBytes += numBytes
+
+
+## Uploads pixel data to the bound texture.  If pixel buffer objects are
+# available, the data are copied straight from the array into one and
+# the driver transfers them to the texture asynchronously.  Otherwise
+# they are uploaded from the array directly.
+class PixelUploader:
+    def __init__(self):
+        ## Pixel buffer object, or None if not created yet.
+        self.buffer = None
+        ## Whether pixel buffer objects are available, or None if not
+        # known yet.  Checking needs a GL context.
+        self.havePixelBuffers = None
+
+
+    ## Upload data, a contiguous 2D array, to the bound texture.
+    def upload(self, data, glType):
+        height, width = data.shape
+        if self.havePixelBuffers is None:
+            self.havePixelBuffers = bool(glGenBuffers) and bool(glBufferData)
+        if not self.havePixelBuffers:
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, width, height,
+                            GL_RED, glType, data)
+            return
+        if self.buffer is None:
+            self.buffer = glGenBuffers(1)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, self.buffer)
+        # Allocating new storage each time means we don't have to wait for
+        # the previous upload to finish.
+        glBufferData(GL_PIXEL_UNPACK_BUFFER, data.nbytes, data,
+                     GL_STREAM_DRAW)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, width, height,
+                        GL_RED, glType, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+
+
+## Budget for the textures of all tiles.  Mosaic canvases share their
+# tiles and GL context, so they share this, the pool of textures for
+# reuse and the uploader too.
+textureBudget = TextureBudget()
+texturePool = TexturePool()
+pixelUploader = PixelUploader()
+
+
+## This class handles a single tile in the mosaic.  The tile has a
+# pyramid of downsampled copies of its image, one for each of
+# LEVEL_FACTORS, and renders the coarsest one that still has at least one
+# texel per screen pixel.  Levels are computed from the image when their
+# texture is uploaded, which happens when they are first rendered, and
+# textures may be deleted again by the textureBudget.
+#
+# Textures hold the data as they are, and contrast is applied by a
+# shader when rendering, so changing histogramScale is cheap.
 class Tile:
+    ## Downsampling factors of the levels of detail.
+    levelFactors = LEVEL_FACTORS
+
+    ## \param store TileStore holding textureData, if any.
+    # \param storeIndex Index of the tile in store.
     def __init__(self, textureData, pos, size,
-            histogramScale, layer, shouldDelayAllocation=False):
+            histogramScale, layer, store = None, storeIndex = None):
 
         ## Array of pixel brightnesses
         self.textureData = textureData
@@ -99,18 +345,72 @@ class Tile:
         ## Grouping this tile belongs to, used to toggle display
         self.layer = layer
 
-        ## OpenGL texture ID
-        self.texture = glGenTextures(1)
+        ## TileStore holding our image data, and our index in it.
+        self.store = store
+        self.storeIndex = storeIndex
+
+        ## Image shape for each level of detail, finest first.
+        self.levelShapes = self.makeLevelShapes(textureData.shape)
+        ## Maps level index to the OpenGL texture ID of those levels that
+        # are in video memory.
+        self.textures = {}
+        ## Levels whose textures need their data uploading again.
+        self.staleLevels = set()
         self.scaleHistogram(histogramScale[0], histogramScale[1])
-        # Indicate refresh required after scaling histogram.
-        self.shouldRefresh = False
-        if not shouldDelayAllocation:
-            self.bindTexture()
-            self.refresh()
 
 
-    def bindTexture(self):
-        glBindTexture(GL_TEXTURE_2D, self.texture)
+    ## Return the image shapes of the levels of detail for an image of
+    # shape, stopping if the image gets too small.
+    def makeLevelShapes(self, shape):
+        shapes = [tuple(shape)]
+        for prevFactor, factor in zip(self.levelFactors,
+                                      self.levelFactors[1:]):
+            ratio = factor // prevFactor
+            if min(shapes[-1]) < ratio:
+                break
+            shapes.append((shapes[-1][0] // ratio, shapes[-1][1] // ratio))
+        return shapes
+
+
+    ## Return the image data of a level of detail.  Each level is computed
+    # from the previous one.
+    def getLevelData(self, level):
+        data = self.textureData
+        for i in range(1, level + 1):
+            data = downsample(data,
+                              self.levelFactors[i] // self.levelFactors[i - 1])
+        return data
+
+
+    ## OpenGL texture ID of the full resolution level, or None if it is not
+    # in video memory.
+    @property
+    def texture(self):
+        return self.textures.get(0)
+
+
+    ## Bind the texture of a level of detail, creating it first if needed.
+    # New textures have their storage allocated but no data.
+    def bindTexture(self, level = 0):
+        if level in self.textures:
+            glBindTexture(GL_TEXTURE_2D, self.textures[level])
+            return
+        imgType = self.textureData.dtype.type
+        if imgType not in dtypeToGlTypeMap:
+            raise ValueError("Unsupported data mode %s" % str(imgType))
+
+        pic_ny, pic_nx = self.levelShapes[level]
+        self.staleLevels.add(level)
+        internalFormat = self.getInternalFormat()
+        texture = texturePool.get((pic_nx, pic_ny, internalFormat))
+        if texture is not None:
+            # Same size and parameters; only the data are stale.
+            self.textures[level] = texture
+            glBindTexture(GL_TEXTURE_2D, texture)
+            return
+
+        self.textures[level] = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.textures[level])
         glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_MIN_FILTER,GL_LINEAR)
         glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_MAG_FILTER,GL_NEAREST)
         # These two are only really needed for megatiles; normal
@@ -118,55 +418,37 @@ class Tile:
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
 
-        img = self.textureData
+        # Textures are not padded to powers of two, which needs OpenGL 2.0.
+        glTexImage2D(GL_TEXTURE_2D, 0, internalFormat, pic_nx, pic_ny, 0,
+                     GL_RED, dtypeToGlTypeMap[imgType], None)
 
-        pic_ny, pic_nx = img.shape
-        tex_nx,tex_ny = getTexSize(pic_nx,pic_ny)
 
-        imgType = img.dtype.type
-        if imgType not in dtypeToGlTypeMap:
-            raise ValueError("Unsupported data mode %s" % str(imgType))
-        glTexImage2D(GL_TEXTURE_2D,0,  GL_RGB, tex_nx,tex_ny, 0, 
-                     GL_LUMINANCE, dtypeToGlTypeMap[imgType], None)
+    ## Return the internal format of our textures.
+    def getInternalFormat(self):
+        return dtypeToInternalFormatMap.get(self.textureData.dtype.type,
+                                            GL_R32F)
 
 
-    def refresh(self):
-        img = self.textureData
-        mi,ma = self.histogramScale
-        pic_ny, pic_nx = img.shape
+    ## Upload the data of a level of detail to its texture, or of all
+    # levels in video memory if level is None.
+    def refresh(self, level = None):
+        if level is None:
+            for level in list(self.textures):
+                self.refresh(level)
+            return
+        self.staleLevels.discard(level)
+        img = self.getLevelData(level)
         if img.dtype.type in (numpy.float64, numpy.int32, numpy.uint32):
             data = img.astype(numpy.float32)
-            imgString = data.tostring()
             imgType = numpy.float32
         else:
-            imgString = img.tostring()
+            # Pass the bytes as they are; byte order is dealt with by
+            # GL_UNPACK_SWAP_BYTES.
+            data = numpy.ascontiguousarray(img).view(
+                img.dtype.newbyteorder('='))
             imgType = img.dtype.type
-            
-        # maxUShort: value that represents "maximum color" - i.e. white
-        if img.dtype.type == numpy.uint16:
-            maxUShort = (1<<16) -1
-        elif img.dtype.type == numpy.int16:
-            maxUShort = (1<<15) -1
-        elif img.dtype.type == numpy.uint8:
-            maxUShort = (1<<8) -1
-        else:
-            maxUShort = 1
 
-        mmrange =  float(ma)-float(mi)
-        fBias =  -float(mi) / mmrange
-        f  =  maxUShort / mmrange
-        
-        glBindTexture(GL_TEXTURE_2D, self.texture)
-        glPixelTransferf(GL_RED_SCALE,   f)
-        glPixelTransferf(GL_GREEN_SCALE, f)
-        glPixelTransferf(GL_BLUE_SCALE,  f)
-        
-        glPixelTransferf(GL_RED_BIAS,   fBias)
-        glPixelTransferf(GL_GREEN_BIAS, fBias)
-        glPixelTransferf(GL_BLUE_BIAS,  fBias)
-        
-        glPixelTransferi(GL_MAP_COLOR, False)
-        
+        glBindTexture(GL_TEXTURE_2D, self.textures[level])
         if img.dtype.type in (numpy.float64, numpy.int32, numpy.uint32,
                 numpy.complex64, numpy.complex128):
             itSize = 4
@@ -179,20 +461,36 @@ class Tile:
 
         if imgType not in dtypeToGlTypeMap:
             raise ValueError("Unsupported data mode %s" % str(imgType))
-        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, pic_nx, pic_ny,  
-                     GL_LUMINANCE, dtypeToGlTypeMap[imgType], imgString)
+        pixelUploader.upload(data, dtypeToGlTypeMap[imgType])
+
+
+    ## Return the bytes of video memory used by the texture of a level.
+    def getTextureBytes(self, level):
+        ny, nx = self.levelShapes[level]
+        return getTextureBytes((nx, ny, self.getInternalFormat()))
+
+
+    ## Delete the texture of a level of detail, if it is in video memory.
+    def deleteTexture(self, level):
+        texture = self.textures.pop(level, None)
+        if texture is not None:
+            pic_ny, pic_nx = self.levelShapes[level]
+            texturePool.put((pic_nx, pic_ny, self.getInternalFormat()),
+                            texture)
+        self.staleLevels.discard(level)
+        textureBudget.discard(self, level)
 
 
     ## Free up memory we were using.
     def wipe(self):
-        glDeleteTextures([self.texture])
+        for level in list(self.textures):
+            self.deleteTexture(level)
 
 
     ## Wipe our texture and recreate it, presumably because it has
     # changed somehow.
     def recreateTexture(self):
         self.wipe()
-        self.texture = glGenTextures(1)
         self.bindTexture()
 
 
@@ -210,35 +508,65 @@ class Tile:
         return True
 
 
-    ## Draw the tile, if it intersects the given view box
-    def render(self, viewBox):
+    ## Return the index of the level of detail to render at scale, in
+    # screen pixels per micron: the coarsest level with at least one
+    # texel per screen pixel.  Return the full resolution level if scale
+    # is None.
+    def getLevel(self, scale):
+        if scale is None:
+            return 0
+        screenPixelsPerPixel = scale * self.size[0] / self.textureData.shape[1]
+        level = 0
+        for i in range(1, len(self.levelShapes)):
+            if self.levelFactors[i] * screenPixelsPerPixel <= 1:
+                level = i
+        return level
+
+
+    ## Note that the texture of a level was used, so that it is kept in
+    # video memory over those not used recently.
+    def touchTexture(self, level):
+        textureBudget.touch(self, level)
+
+
+    ## Draw the tile, if it intersects the given view box, at the level of
+    # detail for scale.
+    # \param targetScale (blackpoint, whitepoint) of the render target, if
+    #        it keeps the data rather than showing them, as for
+    #        MegaTile.prerenderTiles.
+    def render(self, viewBox, scale = None, targetScale = None):
         if not self.intersectsBox(viewBox):
             return
-        if self.shouldRefresh:
-            self.refresh()
-            self.shouldRefresh = False
-        
-        glColor3f(1, 1, 1)
-
-        img = self.textureData
-        pic_ny, pic_nx = img.shape
-        tex_nx,tex_ny = getTexSize(pic_nx,pic_ny)
-        picTexRatio_x = float(pic_nx) / tex_nx
-        picTexRatio_y = float(pic_ny) / tex_ny
+        level = self.getLevel(scale)
+        if level not in self.textures:
+            self.bindTexture(level)
+        if level in self.staleLevels:
+            self.refresh(level)
+        self.touchTexture(level)
+
+        gain, offset = getContrastUniforms(self.textureData.dtype,
+                                           *self.histogramScale,
+                                           targetScale = targetScale)
+        shader = getContrastShader()
+        glUseProgram(shader)
+        glUniform1i(glGetUniformLocation(shader, "tex"), 0)
+        glUniform1f(glGetUniformLocation(shader, "gain"), gain)
+        glUniform1f(glGetUniformLocation(shader, "offset"), offset)
 
         (x,y) = self.pos[:2]
 
-        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glBindTexture(GL_TEXTURE_2D, self.textures[level])
         glBegin(GL_QUADS)
-        glTexCoord2f(0, picTexRatio_y)
+        glTexCoord2f(0, 1)
         glVertex2f(x, y)
-        glTexCoord2f(picTexRatio_x, picTexRatio_y)
+        glTexCoord2f(1, 1)
         glVertex2f(x + self.size[0], y)
-        glTexCoord2f(picTexRatio_x, 0)
+        glTexCoord2f(1, 0)
         glVertex2f(x + self.size[0], y + self.size[1])
         glTexCoord2f(0, 0)
         glVertex2f(x, y + self.size[1])
         glEnd()
+        glUseProgram(0)
 
 
     ## Set our histogramScale tuple to (min, max), or base those off of 
@@ -255,7 +583,6 @@ class Tile:
         ## Used to scale the brightness of the overall tile, like the
         # histogram controls used for the camera views.
         self.histogramScale = (minVal, maxVal)
-        self.shouldRefresh = True
 
 
     ## Return the (xSize, ySize) tuple of a single pixel of texture data in GL
@@ -269,15 +596,29 @@ class Tile:
 # use it.
 megaTileFramebuffer = None
 
+## Value of MegaTile texels where no tile has been prerendered, which is
+# above any whitepoint so that they show white.
+MEGATILE_EMPTY_VALUE = 1e30
+
 ## This class handles pre-rendering of normal-sized Tile instances
 # at a reduced level of detail, which allows us to keep the program
 # responsive even when thousands of tiles are in view.
+#
+# MegaTile textures are floating point and keep the data of the tiles,
+# so that they can be drawn with a new histogramScale without
+# prerendering the tiles again, as long as all tiles were prerendered
+# with the same histogramScale.  Tiles with a different histogramScale are
+# mapped to look the same under ours, which is only valid until we are
+# rescaled.
 class MegaTile(Tile):
+    ## Megatiles are drawn at a single level of detail.
+    levelFactors = (1,)
     ## Length in pixels of one edge of a MegaTile's texture.
     pixelSize = None
     ## Length in microns of one edge of a MegaTile's texture.
     micronSize = None
-    ## An array of ones, used to initialize the MegaTile textures.
+    ## An array of MEGATILE_EMPTY_VALUE, used to initialize the MegaTile
+    # textures.
     _emptyTileData = None
 
     ## Instantiate the megatile. The main difference here is that
@@ -290,12 +631,14 @@ class MegaTile(Tile):
     def __init__(self, pos):
         super().__init__(self._emptyTileData, pos,
                  (self.micronSize, self.micronSize),
-                 (0, 1), 'megatiles',
-                 shouldDelayAllocation = True)
+                 (0, 1), 'megatiles')
         ## Counts the number of tiles we've rendered to ourselves.
         self.numRenderedTiles = 0
         ## Whether or not we've allocated memory for our texture yet.
         self.haveAllocatedMemory = False
+        ## Whether any tiles were prerendered with a different
+        # histogramScale from ours.
+        self.hasMixedScales = False
         
         global megaTileFramebuffer
         if megaTileFramebuffer is None:
@@ -312,7 +655,8 @@ class MegaTile(Tile):
             return
         cls.pixelSize = edge
         cls.micronSize = edge * 1
-        cls._emptyTileData = numpy.ones( (edge, edge), dtype=numpy.float32)
+        cls._emptyTileData = numpy.full((edge, edge), MEGATILE_EMPTY_VALUE,
+                                        dtype=numpy.float32)
 
     ## Go through the provided list of Tiles, find the ones that overlap
     # our area, and prerender them to our texture
@@ -334,7 +678,6 @@ class MegaTile(Tile):
                 self.bindTexture()
                 self.refresh()
                 self.haveAllocatedMemory = True
-            self.numRenderedTiles += len(newTiles)
             glBindFramebuffer(GL_DRAW_FRAMEBUFFER, megaTileFramebuffer)
             glFramebufferTexture2D(GL_DRAW_FRAMEBUFFER,
                     GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D,
@@ -351,7 +694,13 @@ class MegaTile(Tile):
 
             glEnable(GL_TEXTURE_2D)
             for tile in newTiles:
-                tile.render(viewBox)
+                if not self.numRenderedTiles:
+                    self.histogramScale = tile.histogramScale
+                elif tile.histogramScale != self.histogramScale:
+                    self.hasMixedScales = True
+                tile.render(viewBox, self.pixelSize / self.micronSize,
+                            self.histogramScale)
+                self.numRenderedTiles += 1
 
             glPopMatrix()            
             glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
@@ -363,6 +712,7 @@ class MegaTile(Tile):
             super().wipe()
             self.haveAllocatedMemory = False
             self.numRenderedTiles = 0
+            self.hasMixedScales = False
             
 
     ## Prevent allocating a new texture if we haven't drawn anything yet.
@@ -372,7 +722,23 @@ class MegaTile(Tile):
             self.refresh()
 
 
-    def render(self, viewBox):
+    ## Show our tiles with histogramScale (minVal, maxVal), which all of
+    # them have been given.  Return False if our tiles must be prerendered
+    # again for that, because their data are not all in our texture.
+    def rescale(self, minVal, maxVal):
+        if self.hasMixedScales:
+            return False
+        self.scaleHistogram(minVal, maxVal)
+        return True
+
+
+    ## Megatile textures are render targets that cannot be uploaded
+    # again, so they are not subject to the textureBudget.
+    def touchTexture(self, level):
+        pass
+
+
+    def render(self, viewBox, scale = None):
         if not self.numRenderedTiles:
             # We're empty, so no need to render.
             return
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+## This module contains the TileStore class, which keeps the image data
+# of mosaic tiles on disk instead of in memory.
+
+import mmap
+import os
+import threading
+
+import numpy
+
+
+## Extension of tile store data files.  The index is in a file of the
+# same name with INDEX_EXTENSION appended.
+STORE_EXTENSION = '.tiles'
+INDEX_EXTENSION = '.index'
+
+## Size of the segments that the data file is mapped in.  Tiles that fit
+# in a segment are never split between segments.
+SEGMENT_BYTES = 64 * 2**20
+
+## Record of the index for each tile in a store.  Scalings that were
+# None are stored as NaN.
+INDEX_DTYPE = numpy.dtype([
+    ('offset', '<i8'),
+    ('shape', '<i4', (2,)),
+    ('dtype', 'S8'),
+    ('pos', '<f8', (3,)),
+    ('size', '<f8', (2,)),
+    ('scalings', '<f8', (2,)),
+    ('layer', '<i4'),
+    ('deleted', 'u1'),
+])
+
+
+## Append-only store of tile images on disk.  Each tile image is appended
+# to a data file as a contiguous chunk, and then a record of its
+# position, size, Z and scalings is appended to an index file.  The data
+# file is memory mapped, so that the image of a tile is only read from
+# disk when it is used, and the operating system can drop it again
+# when memory is short.
+#
+# The data file is mapped in fixed segments of segmentBytes, each mapped
+# once, so the number and total size of the maps only grow with the
+# size of the file.  A tile that would straddle the end of a segment is
+# instead written at the start of the next one, and the file is extended
+# a whole segment at a time.  Only tiles larger than a segment, or in
+# files written without segments, get a map of their own.
+#
+# Since a tile is only in the index once its data is written, a store
+# left behind by a crash can be opened and holds every tile appended
+# before the crash.
+class TileStore:
+    ## \param path Path of the data file, which is created if it does
+    #         not exist.
+    # \param readOnly If True, do not allow appending or deleting tiles.
+    # \param segmentBytes Size of the segments the file is mapped in; a
+    #        multiple of mmap.ALLOCATIONGRANULARITY.
+    def __init__(self, path, readOnly = False,
+                 segmentBytes = SEGMENT_BYTES):
+        self.path = path
+        self.segmentBytes = segmentBytes
+        self.indexPath = path + INDEX_EXTENSION
+        self.readOnly = readOnly
+        mode = 'rb' if readOnly else 'r+b'
+        if not readOnly and not os.path.exists(path):
+            mode = 'w+b'
+        ## Unbuffered, so that appended data is visible through the map.
+        self.dataFile = open(path, mode, buffering = 0)
+        if readOnly or os.path.exists(self.indexPath):
+            records = numpy.fromfile(self.indexPath, dtype = numpy.uint8)
+            # Drop a partial record, from a crash while appending.
+            numRecords = records.size // INDEX_DTYPE.itemsize
+            records = records[:numRecords * INDEX_DTYPE.itemsize]
+        else:
+            numRecords = 0
+            records = numpy.zeros(0, dtype = numpy.uint8)
+        ## Index records, one per tile, which may have spare capacity at
+        # the end.
+        self.records = records.view(INDEX_DTYPE).copy()
+        self.numRecords = numRecords
+        if not readOnly:
+            indexMode = 'r+b' if os.path.exists(self.indexPath) else 'w+b'
+            self.indexFile = open(self.indexPath, indexMode, buffering = 0)
+            self.indexFile.truncate(numRecords * INDEX_DTYPE.itemsize)
+        ## End of the data of the last tile in the index.  Any data after
+        # this is from a crash while appending, and is overwritten.
+        self.dataEnd = 0
+        if numRecords:
+            last = self.records[numRecords - 1]
+            self.dataEnd = int(last['offset']) + self.getNumBytes(last)
+        ## Maps read-only maps of the data file by the offset they start
+        # at: one for each segment, and one for each tile that is not in a
+        # segment.
+        self.maps = {}
+        self.lock = threading.Lock()
+
+
+    def __len__(self):
+        return self.numRecords
+
+
+    ## Return the number of bytes of image data of an index record.
+    def getNumBytes(self, record):
+        return (int(record['shape'][0]) * int(record['shape'][1])
+                * numpy.dtype(record['dtype'].decode()).itemsize)
+
+
+    ## Append a tile and return its index.
+    def append(self, data, pos, size, scalings, layer):
+        if self.readOnly:
+            raise RuntimeError("Tile store %s is read only" % self.path)
+        data = numpy.ascontiguousarray(data)
+        if data.ndim != 2:
+            raise ValueError("Tile images must be 2D, not %dD" % data.ndim)
+        with self.lock:
+            if self.numRecords == len(self.records):
+                self.records.resize(max(16, 2 * len(self.records)),
+                                    refcheck = False)
+            record = self.records[self.numRecords]
+            record['offset'] = self.dataEnd
+            record['shape'] = data.shape
+            record['dtype'] = data.dtype.str.encode()
+            record['pos'] = pos
+            record['size'] = size
+            record['scalings'] = [numpy.nan if s is None else s
+                                  for s in scalings]
+            record['layer'] = layer
+            record['deleted'] = 0
+            segmentEnd = (self.dataEnd // self.segmentBytes + 1) * self.segmentBytes
+            if (self.dataEnd + data.nbytes > segmentEnd
+                    and data.nbytes <= self.segmentBytes):
+                # Start the next segment rather than straddle this one.
+                self.dataEnd = segmentEnd
+                record['offset'] = self.dataEnd
+            # Extend the file to the end of the tile's last segment, so
+            # that whole segments can be mapped.
+            fileEnd = -(-(self.dataEnd + data.nbytes) // self.segmentBytes
+                        ) * self.segmentBytes
+            if os.fstat(self.dataFile.fileno()).st_size < fileEnd:
+                self.dataFile.truncate(fileEnd)
+            self.dataFile.seek(self.dataEnd)
+            self.dataFile.write(data.reshape(-1).view(numpy.uint8))
+            self.indexFile.seek(self.numRecords * INDEX_DTYPE.itemsize)
+            self.indexFile.write(
+                self.records[self.numRecords:self.numRecords + 1].tobytes())
+            self.dataEnd += data.nbytes
+            self.numRecords += 1
+            return self.numRecords - 1
+
+
+    ## Return the image of a tile, as a read-only view of the data file.
+    def getData(self, index):
+        record = self.getRecord(index)
+        offset = int(record['offset'])
+        end = offset + self.getNumBytes(record)
+        start = offset - offset % self.segmentBytes
+        if end > start + self.segmentBytes:
+            # Not in one segment; map just this tile.
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            length = end - start
+        else:
+            fileSize = os.fstat(self.dataFile.fileno()).st_size
+            length = min(self.segmentBytes, fileSize - start)
+        with self.lock:
+            dataMap = self.maps.get(start)
+            if dataMap is None or len(dataMap) < end - start:
+                # Only the last segment of a read-only file can be short,
+                # and it does not grow, so this only replaces maps of
+                # files that were appended to by another store.
+                dataMap = mmap.mmap(self.dataFile.fileno(), length,
+                                    offset = start,
+                                    access = mmap.ACCESS_READ)
+                self.maps[start] = dataMap
+        shape = tuple(int(n) for n in record['shape'])
+        return numpy.frombuffer(dataMap, dtype = record['dtype'].decode(),
+                                count = shape[0] * shape[1],
+                                offset = offset - start).reshape(shape)
+
+
+    ## Return a copy of the index record of a tile.
+    def getRecord(self, index):
+        with self.lock:
+            if not 0 <= index < self.numRecords:
+                raise IndexError("No tile %d in store %s"
+                                 % (index, self.path))
+            return self.records[index:index + 1].copy()[0]
+
+
+    ## Return the (pos, size, scalings, layer) a tile was appended with.
+    def getTileInfo(self, index):
+        record = self.getRecord(index)
+        scalings = tuple(None if numpy.isnan(s) else float(s)
+                         for s in record['scalings'])
+        return (tuple(float(p) for p in record['pos']),
+                tuple(float(s) for s in record['size']), scalings,
+                int(record['layer']))
+
+
+    ## Mark a tile as deleted.  Its data stays in the store.
+    def markDeleted(self, index):
+        if self.readOnly:
+            raise RuntimeError("Tile store %s is read only" % self.path)
+        self.getRecord(index)
+        with self.lock:
+            self.records[index]['deleted'] = 1
+            self.indexFile.seek(index * INDEX_DTYPE.itemsize
+                                + INDEX_DTYPE.fields['deleted'][1])
+            self.indexFile.write(b'\x01')
+
+
+    ## Return the indices of the tiles that are not deleted.
+    def getLiveIndices(self):
+        with self.lock:
+            deleted = self.records['deleted'][:self.numRecords].copy()
+        return numpy.flatnonzero(deleted == 0).tolist()
+
+
+    ## Make sure that everything appended so far is on disk.
+    def flush(self):
+        if not self.readOnly:
+            os.fsync(self.dataFile.fileno())
+            os.fsync(self.indexFile.fileno())
+
+
+    def close(self):
+        self.dataFile.close()
+        if not self.readOnly:
+            self.indexFile.close()
+        # Arrays keep their own references to the maps, which are closed
+        # once they are no longer used.
+        self.maps = {}
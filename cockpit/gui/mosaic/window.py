@@ -52,11 +52,14 @@
 ## POSSIBILITY OF SUCH DAMAGE.
 
 import collections
+import concurrent.futures
 import math
+import os
 import threading
+import time
+import traceback
 
 import numpy
-import scipy.ndimage.measurements
 import wx
 from OpenGL.GL import *
 
@@ -69,10 +72,15 @@ import cockpit.gui.guiUtils
 import cockpit.gui.keyboard
 import cockpit.interfaces.stageMover
 import cockpit.util.files
+import cockpit.util.logger
+import cockpit.util.threads
 import cockpit.util.userConfig
 from cockpit import depot
 from cockpit import events
+from cockpit.gui.mosaic import beadFinder
 from cockpit.gui.mosaic import canvas
+from cockpit.gui.mosaic import export
+from cockpit.gui.mosaic import tileStore
 from cockpit.gui.primitive import Primitive
 from cockpit.util import ftgl
 
@@ -84,12 +92,116 @@ SITE_COLORS = [('green', (0, 1, 0)), ('red', (1, 0, 0)),
 ## Timeout for mosaic new image events
 CAMERA_TIMEOUT = 1
 
+## Maximum number of images that a pipelined mosaic has taken but not
+# yet received.
+MAX_PENDING_TILES = 2
+
 ## Simple structure for marking potential beads.
 BeadSite = collections.namedtuple('BeadSite', ['pos', 'size', 'intensity'])
 
+## Minimum distance in microns between marked beads.
+BEAD_MIN_SEPARATION = 40
+
+## Number of composite tiles to queue for each bead finding thread.
+BEAD_TILES_PER_WORKER = 2
+
 from functools import wraps
 
 
+## Matches the images of a camera to the positions at which they were
+# taken, so that a mosaic can move the stage to the next position while
+# an image is still being read out and transferred.  Images are added to
+# the canvas as they arrive, in the order they were taken.
+class PendingTiles:
+    def __init__(self, canvas, camera, size, maxPending=MAX_PENDING_TILES):
+        self.canvas = canvas
+        self.camera = camera
+        ## Tile size in microns.
+        self.size = size
+        self.maxPending = maxPending
+        ## [position, deadline] of images taken and not yet received,
+        # oldest first.  The deadline is None until the image is taken.
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        # Adding tiles can be slow, so do it in a worker thread rather
+        # than the camera's, keeping every image and their order.
+        events.subscribe(events.NEW_IMAGE % camera.name, self.onImage,
+                         events.QUEUED)
+
+
+    ## Record that an image is about to be taken at pos.  Call before
+    # taking the image, in case it arrives before the call returns, and
+    # then call taken() with the returned entry.
+    def add(self, pos):
+        entry = [pos, None]
+        with self.condition:
+            self.pending.append(entry)
+        return entry
+
+
+    ## The image of entry was taken and should arrive within timeout
+    # seconds.
+    def taken(self, entry, timeout):
+        with self.condition:
+            entry[1] = time.time() + timeout
+            self.condition.notify_all()
+
+
+    ## Forget about all pending images, e.g. because one failed.
+    def clear(self):
+        with self.condition:
+            self.pending.clear()
+            self.condition.notify_all()
+
+
+    ## Receive an image from the camera, and add it to the canvas at the
+    # position of the oldest image taken.
+    def onImage(self, data, timestamp):
+        with self.condition:
+            if not self.pending:
+                # Not one of ours, e.g. the stage was not moving.
+                return
+            pos, deadline = self.pending.popleft()
+            self.condition.notify_all()
+        try:
+            scalings = cockpit.gui.camera.window.getCameraScaling(self.camera)
+        except Exception:
+            scalings = (None, None)
+        self.canvas.addImage(data, pos, self.size, scalings=scalings)
+
+
+    ## Wait until at most numPending images are pending.  Return False
+    # if one of them did not arrive in time, in which case the others
+    # can not be matched to their positions and are discarded.
+    def waitForPending(self, numPending):
+        with self.condition:
+            while len(self.pending) > numPending:
+                deadline = self.pending[0][1]
+                if deadline is None:
+                    # Still being taken.
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.pending.clear()
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+
+    ## Wait for room to take another image.
+    def waitForRoom(self):
+        return self.waitForPending(self.maxPending - 1)
+
+
+    ## Stop receiving images.  Wait for pending images first unless
+    # shouldWait is False.
+    def close(self, shouldWait=True):
+        if shouldWait:
+            self.waitForPending(0)
+        events.unsubscribe(events.NEW_IMAGE % self.camera.name, self.onImage)
+
+
 def _pauseMosaicLoop(func):
     @wraps(func)
     def wrapped(self, *args, **kwargs):
@@ -341,6 +453,9 @@ class MosaicWindow(wx.Frame, MosaicCommon):
         ## Mosaic tile overlap
         self.overlap = cockpit.util.userConfig.getValue('mosaicTileOverlap',
                                                         default = 0.0)
+        ## Whether to move to the next tile while an image is read out.
+        self.pipelined = cockpit.util.userConfig.getValue('mosaicPipelined',
+                                                          default = False)
 
         ## Size of the box to draw at the center of the crosshairs.
         self.crosshairBoxSize = 0
@@ -398,6 +513,10 @@ class MosaicWindow(wx.Frame, MosaicCommon):
                 ('Load mosaic', self.loadMosaic, None,
                  "Load a mosaic file that was previously saved. Make " +
                  "certain you load the .txt file, not the .mrc file."),
+                ('Export region', self.selectRegionForExport, None,
+                 "Left-click and drag to select a region of the mosaic, " +
+                 "and save it as a single stitched image in a TIFF or " +
+                 "MRC file."),
                 ('Calculate focal plane', self.setFocalPlane, self.clearFocalPlane,
                  "Calculate the focal plane of the sample, assuming that " +
                  "the currently-selected sites are all in focus, and that " +
@@ -505,7 +624,7 @@ class MosaicWindow(wx.Frame, MosaicCommon):
     def onAxisRefresh(self, axis, *args):
         if axis in [0, 1]:
             # Only care about the X and Y axes.
-            wx.CallAfter(self.canvas.Refresh)
+            cockpit.gui.ScheduleRefresh(self.canvas)
 
 
     ## User changed the objective in use; resize our crosshair box to suit.
@@ -589,6 +708,12 @@ class MosaicWindow(wx.Frame, MosaicCommon):
             self.Bind(wx.EVT_MENU,
                       lambda event: self.togglescalebar(),
                       id=menuId)
+            menuId += 1
+            menu.AppendCheckItem(menuId, "Move stage during image readout")
+            menu.Check(menuId, self.pipelined)
+            self.Bind(wx.EVT_MENU,
+                      lambda event: self.togglePipelined(),
+                      id=menuId)
 
             cockpit.gui.guiUtils.placeMenuAtMouse(self, menu)
 
@@ -655,12 +780,19 @@ class MosaicWindow(wx.Frame, MosaicCommon):
     ## Move the stage in a spiral pattern, stopping to take images at regular
     # intervals, to generate a stitched-together high-level view of the stage
     # contents.
+    # In pipelined mode, the stage moves to the next position as soon as
+    # the exposure ends, and images are added to the canvas by a
+    # PendingTiles as they arrive.
     def mosaicLoop(self):
         from sys import stderr
         stepper = self.mosaicStepper()
         target = None
+        pendingTiles = None
         while True:
             if not self.shouldContinue.is_set():
+                if pendingTiles is not None:
+                    pendingTiles.close()
+                    pendingTiles = None
                 ## Enter idle state.
                 # Update button label in main thread.
                 events.publish("mosaic stop")
@@ -705,40 +837,43 @@ class MosaicWindow(wx.Frame, MosaicCommon):
                 width *= objective.getPixelSize()
                 height *= objective.getPixelSize()
                 self.offset = objective.getOffset()
+                if pendingTiles is not None:
+                    pendingTiles.close()
+                    pendingTiles = None
+                if self.pipelined:
+                    pendingTiles = PendingTiles(self.canvas, camera,
+                                                (width, height))
                 # Successfully reconfigured: clear the flag.
                 self.shouldReconfigure = False
 
             pos = cockpit.interfaces.stageMover.getPosition()
             curZ = pos[2] - self.offset[2]
-            # Take an image. Use timeout to prevent getting stuck here.
-            try:
-                data, timestamp = events.executeAndWaitForOrTimeout(
-                    events.NEW_IMAGE % camera.name,
-                    cockpit.interfaces.imager.takeImage,
-                    camera.getExposureTime()/1000 + CAMERA_TIMEOUT,
-                    shouldBlock=True)
-            except Exception as e:
-                # Go to idle state.
-                self.shouldContinue.clear()
-                stderr.write("Mosaic stopping - problem taking image: %s\n" % str(e))
-                continue
-
-            # Get the scaling for the camera we're using, since they may
-            # have changed.
-            try:
-                minVal, maxVal = cockpit.gui.camera.window.getCameraScaling(camera)
-            except Exception as e:
-                # Go to idle state.
-                self.shouldContinue.clear()
-                stderr.write("Mosaic stopping - problem in getCameraScaling: %s\n" % str(e))
-                continue
+            # Position of the tile for an image at the current stage position.
+            tilePos = (-pos[0] + self.offset[0] - width / 2,
+                       pos[1] - self.offset[1] - height / 2,
+                       curZ)
+            if pendingTiles is not None:
+                if not pendingTiles.waitForRoom():
+                    self.shouldContinue.clear()
+                    stderr.write("Mosaic stopping - timed out waiting for image\n")
+                    continue
+                exposureTime = camera.getExposureTime() / 1000
+                entry = pendingTiles.add(tilePos)
+                try:
+                    cockpit.interfaces.imager.takeImage(shouldBlock=True)
+                except Exception as e:
+                    pendingTiles.clear()
+                    self.shouldContinue.clear()
+                    stderr.write("Mosaic stopping - problem taking image: %s\n" % str(e))
+                    continue
+                pendingTiles.taken(entry, exposureTime + CAMERA_TIMEOUT)
+                # The stage can move once the exposure has ended, while the
+                # image is read out.
+                time.sleep(exposureTime)
+            else:
+                if not self.takeTile(camera, tilePos, (width, height)):
+                    continue
 
-            # Paint the tile at the stage position at which image was captured.
-            self.canvas.addImage(data,
-                                 ( -pos[0] + self.offset[0] - width / 2,
-                                    pos[1] - self.offset[1] - height / 2,
-                                    curZ,),
-                                 (width, height), scalings=(minVal, maxVal))
             # Move to the next position in shifted coords.
             dx, dy = next(stepper)
             target = (centerX + self.offset[0] + dx * width,
@@ -751,6 +886,46 @@ class MosaicWindow(wx.Frame, MosaicCommon):
                 continue
 
 
+    ## Take an image with camera and wait for it before adding it to the
+    # canvas at pos.  Return False, and stop the mosaic, if that fails.
+    def takeTile(self, camera, pos, size):
+        from sys import stderr
+        # Take an image. Use timeout to prevent getting stuck here.
+        try:
+            data, timestamp = events.executeAndWaitForOrTimeout(
+                events.NEW_IMAGE % camera.name,
+                cockpit.interfaces.imager.takeImage,
+                camera.getExposureTime()/1000 + CAMERA_TIMEOUT,
+                shouldBlock=True)
+        except Exception as e:
+            # Go to idle state.
+            self.shouldContinue.clear()
+            stderr.write("Mosaic stopping - problem taking image: %s\n" % str(e))
+            return False
+
+        # Get the scaling for the camera we're using, since they may
+        # have changed.
+        try:
+            minVal, maxVal = cockpit.gui.camera.window.getCameraScaling(camera)
+        except Exception as e:
+            # Go to idle state.
+            self.shouldContinue.clear()
+            stderr.write("Mosaic stopping - problem in getCameraScaling: %s\n" % str(e))
+            return False
+
+        # Paint the tile at the stage position at which image was captured.
+        self.canvas.addImage(data, pos, size, scalings=(minVal, maxVal))
+        return True
+
+
+    ## Toggle whether mosaics move the stage during image readout.
+    def togglePipelined(self):
+        self.pipelined = not self.pipelined
+        cockpit.util.userConfig.setValue('mosaicPipelined', self.pipelined)
+        # Takes effect the next time the mosaic loop is configured.
+        self.shouldReconfigure = True
+
+
     ## Display dialogue box to set tile overlap.
     def setTileOverlap(self):
         value = cockpit.gui.dialogs.getNumberDialog.getNumberFromUser(
@@ -1094,7 +1269,8 @@ class MosaicWindow(wx.Frame, MosaicCommon):
 
 
     ## Save the mosaic to disk. We generate a text file describing the
-    # locations of the mosaic tiles, and an MRC file of the tiles themselves.
+    # locations of the mosaic tiles, which refers to the tile store holding
+    # the tiles themselves.
     def saveMosaic(self, event = None):
         dialog = wx.FileDialog(self, style = wx.FD_SAVE, wildcard = '*.txt',
                 message = "Please select where to save the file.",
@@ -1106,22 +1282,101 @@ class MosaicWindow(wx.Frame, MosaicCommon):
 
     ## Load a mosaic that was previously saved to disk.
     def loadMosaic(self, event = None):
-        dialog = wx.FileDialog(self, style = wx.FD_OPEN, wildcard = '*.txt',
+        dialog = wx.FileDialog(self, style = wx.FD_OPEN,
+                wildcard = '*.txt;*%s' % tileStore.STORE_EXTENSION,
                 message = "Please select the .txt file the mosaic was saved to.")
         if dialog.ShowModal() != wx.ID_OK:
             return
         self.canvas.loadTiles(dialog.GetPath())
 
 
+    ## Prepare to export a region of the mosaic.
+    def selectRegionForExport(self):
+        self.setSelectFunc(self.exportRegion)
+
+
+    ## Export the (start, end) box of the mosaic as one image, downsampled
+    # from the finest pixel size of its tiles by a factor the user picks.
+    def exportRegion(self, start, end):
+        self.setSelectFunc(None)
+        tiles = self.canvas.getTilesIntersecting(start, end)
+        if not tiles:
+            return
+        # Unlike getNumberFromUser, this dialog can be cancelled.
+        numberDialog = wx.TextEntryDialog(self, "Downsampling factor",
+                "Export mosaic region", "1")
+        if numberDialog.ShowModal() != wx.ID_OK:
+            return
+        try:
+            factor = float(numberDialog.GetValue())
+        except ValueError:
+            factor = None
+        if factor is None or not 0 < factor < math.inf:
+            wx.MessageDialog(self,
+                    "The downsampling factor must be a number greater than 0.",
+                    "Invalid downsampling factor").ShowModal()
+            return
+        pixelSize = (factor * min(tile.size[0] / tile.textureData.shape[1]
+                                  for tile in tiles))
+        dialog = wx.FileDialog(self, style = wx.FD_SAVE,
+                wildcard = 'TIFF files (*.tif)|*.tif|MRC files (*.mrc)|*.mrc',
+                message = "Please select where to save the image.",
+                defaultDir = cockpit.util.files.getUserSaveDir())
+        if dialog.ShowModal() != wx.ID_OK:
+            return
+        # Export from a grid of our own, since the canvas' tiles may
+        # change while we work.
+        allowedTiles = canvas.TileGrid()
+        allowedTiles.extend(tiles)
+        statusDialog = wx.ProgressDialog(parent = self,
+                title = "Exporting...",
+                message = "Exporting mosaic region...",
+                style = wx.PD_AUTO_HIDE | wx.PD_CAN_ABORT)
+        statusDialog.Show()
+        shouldStop = threading.Event()
+        def onProgress(count, total):
+            if shouldStop.is_set():
+                return
+            statusDialog.SetRange(max(1, total))
+            shouldContinue, shouldSkip = statusDialog.Update(count)
+            if not shouldContinue:
+                shouldStop.set()
+        def onDone():
+            shouldStop.set()
+            statusDialog.Destroy()
+        self.exportRegionInThread(allowedTiles, (start, end), pixelSize,
+                                  dialog.GetPath(), shouldStop,
+                                  lambda *args: wx.CallAfter(onProgress, *args),
+                                  lambda: wx.CallAfter(onDone))
+
+
+    ## Do the work of exportRegion.
+    @cockpit.util.threads.callInNewThread
+    def exportRegionInThread(self, tiles, box, pixelSize, path, shouldStop,
+                             reportProgress, reportDone):
+        try:
+            export.exportRegion(tiles, box, pixelSize, path,
+                                shouldStop = shouldStop,
+                                reportProgress = reportProgress)
+        except Exception as e:
+            message = "Failed to export the mosaic to %s: %s" % (path, e)
+            wx.CallAfter(lambda: wx.MessageDialog(self, message,
+                    style = wx.ICON_INFORMATION | wx.OK).ShowModal())
+        finally:
+            reportDone()
+
+
     ## Prepare to mark bead centers.
     def selectTilesForBeads(self):
         self.setSelectFunc(self.markBeadCenters)
 
 
     ## Examine the mosaic, trying to find isolated bead centers, and putting
-    # a site marker on each one. We partition each tile of the mosaic into
-    # subsections, find connected components, and mark them if they
-    # are isolated.
+    # a site marker on each one.  Tiles are searched for beads by
+    # beadFinder.findBeads in a pool of threads, and potential beads are
+    # collected as each tile is done.  Threads are used rather than
+    # processes, since forking this process is unsafe and new processes
+    # would import all of cockpit; most of the work is in numpy and scipy.
     def markBeadCenters(self, start, end):
         # Cancel selecting beads now that we have what we need.
         self.setSelectFunc(None)
@@ -1129,103 +1384,111 @@ class MosaicWindow(wx.Frame, MosaicCommon):
         statusDialog = wx.ProgressDialog(parent = self,
                 title = "Finding bead centers",
                 message = "Scanning mosaic...",
-                maximum = len(tiles),
+                maximum = max(1, len(tiles)),
                 style = wx.PD_CAN_ABORT)
         statusDialog.Show()
-        regionSize = 300
+        shouldStop = threading.Event()
         # List of BeadSite instances for potential beads
         beadSites = []
-        for i, tile in enumerate(tiles):
-            # NB shouldSkip is always false because we don't provide a skip
-            # button.
-            shouldContinue, shouldSkip = statusDialog.Update(i)
-            if not shouldContinue:
-                # User cancelled.
-                break
-            try:
-                data = self.canvas.getCompositeTileData(tile, tiles)
-            except Exception as e:
-                print ("Failed to get tile data at %s: %s" % (tile.pos, e))
-                break
-            pixelSize = tile.getPixelSize()
-            median = numpy.median(data)
-            std = numpy.std(data)
-            # Threshold the data so that background becomes 0 and signal
-            # becomes 1 -- admittedly the threshold value is somewhat
-            # arbitrary.
-            thresholded = numpy.zeros(data.shape, dtype = numpy.uint16)
-            thresholded[numpy.where(data > median + std * 15)] = 1
-
-            # Slice up into overlapping regions. Only examine the center
-            # portion of the composite image.
-            for j in range(data.shape[0] / 3, 2 * data.shape[0] / 3, regionSize / 4):
-                for k in range(data.shape[1] / 3, 2 * data.shape[1] / 3, regionSize / 4):
-                    region = thresholded[j : j + regionSize, k : k + regionSize]
-                    # Skip overly small regions (on the off-chance that
-                    # regionSize is a significant portion of the tile size).
-                    if region.shape[0] < regionSize or region.shape[1] < regionSize:
-                        continue
-                    # Find connected components in data.
-                    numComponents = scipy.ndimage.measurements.label(region)[1]
-                    if numComponents != 1:
-                        # More than one bead visible, or no beads at all.
-                        continue
-                    # Find the centroid of the component
-                    yVals, xVals = numpy.where(region == 1)
-                    x, y = numpy.mean(xVals), numpy.mean(yVals)
-                    # Ensure that the bead is not near the edge, where
-                    # it might be close to a bead in a different region. Note
-                    # that our region iteration overlaps, so if a bead is truly
-                    # isolated we'll pick it up on a different loop.
-                    if (x < regionSize * .25 or x > regionSize * .75 or
-                            y < regionSize * .25 or y > regionSize * .75):
-                        continue
-                    # Ensure that the bead is circular, by comparing the area
-                    # of the bead to the area of a circle containing all of
-                    # the bead's pixels.
-                    xDists = [(x - xi) ** 2 for xi in xVals]
-                    yDists = [(y - yi) ** 2 for yi in yVals]
-                    maxDistSquared = max(map(sum, list(zip(xDists, yDists))))
-                    # Area of a circle containing all pixels
-                    area = numpy.pi * maxDistSquared
-                    # Reject beads whose area is less than 60% of the area of
-                    # the circle.
-                    if len(xVals) / area < .6:
+        # The dialog and beadSites are only touched in the main thread.
+        def onSites(sites):
+            for site in sites:
+                # Check for other marked beads that are close to this one.
+                if beadSites:
+                    positions = numpy.array([b.pos for b in beadSites])
+                    distances = numpy.sqrt(((positions - site.pos) ** 2).sum(1))
+                    if distances.min() < BEAD_MIN_SEPARATION:
                         continue
-
-                    # Go from the subregion coordinates to full-tile coordinates
-                    x += k - data.shape[1] / 3
-                    y += j - data.shape[0] / 3
-                    pos = numpy.array([-tile.pos[0] - x * pixelSize[0],
-                            tile.pos[1] + y * pixelSize[1],
-                            tile.pos[2]])
-                    # Check for other marked beads that are close to this one.
-                    # \todo This process makes the entire system N^2
-                    # (where N is the number of sites), so it's moderately
-                    # expensive.
-                    canKeep = True
-                    for site in beadSites:
-                        distance = numpy.sqrt(sum((pos - site.pos) ** 2))
-                        if distance < 40:
-                            # Within 40 microns of another bead; skip it.
-                            canKeep = False
-                            break
-                    if not canKeep:
-                        continue
-                    # Record this potential bead. Its "size" is the number
-                    # of pixels in the component, and its intensity is the
-                    # average intensity of pixels in the component.
-                    newSite = BeadSite(pos, len(xVals),
-                            numpy.mean(data[(yVals, xVals)]))
-                    beadSites.append(newSite)
-
-        # Examine our bead sites and reject ones that are:
-        # - too large (probably conjoined or overlapping beads)
-        # - too bright (ditto)
-        # - too dim (bad signal:noise ratio)
-        # - too small (Could just be autoflourescing dust or something)
-        # Part of the trick here is that many beads may be slightly out of
-        # focus, so these constraints can't actually be all that tight.
+                beadSites.append(site)
+        def onProgress(count):
+            if shouldStop.is_set():
+                return
+            shouldContinue, shouldSkip = statusDialog.Update(count)
+            if not shouldContinue:
+                # User cancelled; we still use the beads found so far.
+                shouldStop.set()
+        def onDone():
+            shouldStop.set()
+            statusDialog.Destroy()
+            self.focusBeadSites(self.filterBeadSites(beadSites))
+        self.findBeadsInThread(tiles, shouldStop,
+                               lambda *args: wx.CallAfter(onSites, *args),
+                               lambda *args: wx.CallAfter(onProgress, *args),
+                               lambda: wx.CallAfter(onDone))
+
+
+    ## Do the work of markBeadCenters.  reportSites is called with a list
+    # of BeadSites for each tile searched, reportProgress with the number
+    # of tiles searched so far, and reportDone once finished.  Stop early
+    # if shouldStop is set.
+    @cockpit.util.threads.callInNewThread
+    def findBeadsInThread(self, tiles, shouldStop, reportSites,
+                          reportProgress, reportDone):
+        # Composites are made from a grid of our own, since the canvas'
+        # tiles may change while we work.
+        allowedTiles = canvas.TileGrid()
+        allowedTiles.extend(tiles)
+        remainingTiles = collections.deque(tiles)
+        numWorkers = os.cpu_count() or 1
+        executor = concurrent.futures.ThreadPoolExecutor(numWorkers)
+        futureToTile = {}
+        numDone = 0
+        try:
+            while ((remainingTiles or futureToTile)
+                   and not shouldStop.is_set()):
+                # Keep the threads busy, without making the composites
+                # of every tile at once.
+                while (remainingTiles and len(futureToTile)
+                       < numWorkers * BEAD_TILES_PER_WORKER):
+                    tile = remainingTiles.popleft()
+                    data = self.canvas.getCompositeTileData(tile,
+                                                            allowedTiles)
+                    future = executor.submit(beadFinder.findBeads, data)
+                    futureToTile[future] = tile
+                done, notDone = concurrent.futures.wait(futureToTile,
+                        timeout = .1,
+                        return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    tile = futureToTile.pop(future)
+                    # Composites have square pixels of the tile's X
+                    # pixel size, with rows going down from the top.
+                    pixelSize = tile.size[0] / tile.textureData.shape[1]
+                    sites = []
+                    for x, y, size, intensity in future.result():
+                        pos = numpy.array([
+                                -tile.pos[0] - (x + .5) * pixelSize,
+                                tile.pos[1] + tile.size[1]
+                                - (y + .5) * pixelSize,
+                                tile.pos[2]])
+                        sites.append(BeadSite(pos, size, intensity))
+                    reportSites(sites)
+                    numDone += 1
+                if done:
+                    reportProgress(numDone)
+        except Exception as e:
+            cockpit.util.logger.log.error("Failed to find beads: %s" % e)
+            cockpit.util.logger.log.error(traceback.format_exc())
+            message = "Failed to find beads: %s" % e
+            wx.CallAfter(lambda: wx.MessageDialog(self, message,
+                    style = wx.ICON_INFORMATION | wx.OK).ShowModal())
+        finally:
+            for future in futureToTile:
+                future.cancel()
+            executor.shutdown(wait = False)
+            reportDone()
+
+
+    ## Examine our bead sites and return the positions of those that
+    # aren't:
+    # - too large (probably conjoined or overlapping beads)
+    # - too bright (ditto)
+    # - too dim (bad signal:noise ratio)
+    # - too small (Could just be autoflourescing dust or something)
+    # Part of the trick here is that many beads may be slightly out of
+    # focus, so these constraints can't actually be all that tight.
+    def filterBeadSites(self, beadSites):
+        if not beadSites:
+            return []
         sizes = numpy.array([b.size for b in beadSites])
         sizeMedian = numpy.median(sizes)
         sizeStd = numpy.std(sizes)
@@ -1242,9 +1505,13 @@ class MosaicWindow(wx.Frame, MosaicCommon):
                 # Wrong brightness.
                 continue
             siteQueue.append(site.pos)
+        return siteQueue
+
 
-        # Scan each site in Z to get perfect focus. Look up/down +- 1 micron,
-        # and pick the Z altitude with the brightest image.
+    ## Scan each site in Z to get perfect focus. Look up/down +- 1 micron,
+    # and pick the Z altitude with the brightest image.
+    @cockpit.util.threads.callInNewThread
+    def focusBeadSites(self, siteQueue):
         # HACK: use the first active camera we find.
         cameras = depot.getHandlersOfType(depot.CAMERA)
         camera = None
@@ -1265,7 +1532,6 @@ class MosaicWindow(wx.Frame, MosaicCommon):
             newSite = cockpit.interfaces.stageMover.Site((x, y, z + bestOffset),
                     group = 'beads', size = 2)
             wx.CallAfter(cockpit.interfaces.stageMover.saveSite, newSite)
-        statusDialog.Destroy()
         wx.CallAfter(self.Refresh)
 
 
@@ -387,7 +387,11 @@ class TouchScreenWindow(wx.Frame, mosaic.MosaicCommon):
 
         self.panel.SetSizerAndFit(sizer)
 
-        events.subscribe(events.STAGE_POSITION, self.onAxisRefresh)
+        # Only the latest position of each axis matters.  This is
+        # handled in a thread of its own, which stops when we unsubscribe.
+        events.subscribe(events.STAGE_POSITION, self.onAxisRefresh,
+                         events.LATEST, key = lambda axis, *args: axis)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.onDestroy)
         events.subscribe('stage step size', self.onAxisRefresh)
         events.subscribe('stage step index', self.stageIndexChange)
         events.subscribe('soft safety limit', self.onAxisRefresh)
@@ -586,16 +590,26 @@ class TouchScreenWindow(wx.Frame, mosaic.MosaicCommon):
     def onAxisRefresh(self, axis, *args):
         if axis in [0, 1]:
             # Only care about the X and Y axes.
-            wx.CallAfter(self.Refresh)
+            cockpit.gui.ScheduleRefresh(self)
         if axis is 2:
-            #Z axis updates
-            posString=self.nameToText['Zpos']
-            label = 'Z Pos %5.2f'%(cockpit.interfaces.stageMover.getPosition()[2])
-            posString.SetLabel(label.rjust(10))
-            stepString=self.nameToText['ZStep']
-            label = 'Z Step %5.2f'%(cockpit.interfaces.stageMover.getCurStepSizes()[2])
-            stepString.SetLabel(label.rjust(10))
-            wx.CallAfter(self.Refresh)
+            #Z axis updates, which may come from any thread.
+            wx.CallAfter(self.updateZLabels)
+            cockpit.gui.ScheduleRefresh(self)
+
+
+    def updateZLabels(self):
+        posString=self.nameToText['Zpos']
+        label = 'Z Pos %5.2f'%(cockpit.interfaces.stageMover.getPosition()[2])
+        posString.SetLabel(label.rjust(10))
+        stepString=self.nameToText['ZStep']
+        label = 'Z Step %5.2f'%(cockpit.interfaces.stageMover.getCurStepSizes()[2])
+        stepString.SetLabel(label.rjust(10))
+
+
+    def onDestroy(self, event):
+        if event.GetEventObject() is self:
+            events.unsubscribe(events.STAGE_POSITION, self.onAxisRefresh)
+        event.Skip()
 
     ## User changed the objective in use; resize our crosshair box to suit.
     def onObjectiveChange(self, name, pixelSize, transform, offset, **kwargs):
@@ -677,6 +691,11 @@ class TouchScreenWindow(wx.Frame, mosaic.MosaicCommon):
             menu.Append(menuId, "Toggle mosaic scale bar")
             self.panel.Bind(wx.EVT_MENU,
                             lambda event: self.togglescalebar(), id= menuId)
+            menuId += 1
+            menu.AppendCheckItem(menuId, "Move stage during image readout")
+            menu.Check(menuId, mosaic.window.pipelined)
+            self.panel.Bind(wx.EVT_MENU,
+                            lambda event: mosaic.window.togglePipelined(), id= menuId)
 
             cockpit.gui.guiUtils.placeMenuAtMouse(self.panel, menu)
 
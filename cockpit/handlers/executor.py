@@ -52,11 +52,14 @@
 
 
 import collections
+import collections.abc
+import hashlib
 from cockpit import depot
 from cockpit.handlers import deviceHandler
 from cockpit import events
 from cockpit.handlers.genericPositioner import GenericPositionerHandler
 from numbers import Number
+import numpy
 import operator
 import time
 from cockpit import util
@@ -64,6 +67,88 @@ import wx
 import functools
 
 
+## Number of compiled profiles kept by each ExecutorHandler.
+PROFILE_CACHE_SIZE = 8
+
+
+## A small least-recently-used cache of compiled profiles, keyed by the
+# digest returned by ExecutorHandler.getProfileKey.  Devices use it as
+# well, to keep what they derive from the compiled actions.
+class ProfileCache:
+    def __init__(self, maxSize=PROFILE_CACHE_SIZE):
+        self.maxSize = maxSize
+        self._entries = collections.OrderedDict()
+        ## Number of lookups that were found, and not found, in the cache.
+        self.hits = 0
+        self.misses = 0
+
+    ## Return the value for key, or None if it is not in the cache.
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+## The actions that ExecutorHandler.executeTable passes to its
+# executeTable callback, as arrays with one element per time point:
+# - times: the time of the actions, as float64;
+# - digital: the state of all digital lines, as uint32, or None if the
+#   handler has no digital lines;
+# - analog: the level of each analogue line, as float64 with shape
+#   (number of time points, number of lines), or None if the handler
+#   has no analogue lines.
+# For compatibility it is also a sequence of (time, (digitalState,
+# analogStates)) tuples.
+# key identifies its content: two compilations with the same key have
+# the same actions, so devices can use it to tell if they already
+# hold a profile.  It is shared between calls, so must not be modified.
+class CompiledActions(collections.abc.Sequence):
+    def __init__(self, times, digital, analog, key=None):
+        self.times = times
+        self.digital = digital
+        self.analog = analog
+        self.key = key
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if self.digital is None:
+            dstate = None
+        else:
+            dstate = int(self.digital[index])
+        if self.analog is None:
+            astate = None
+        else:
+            astate = self.analog[index].tolist()
+        return (float(self.times[index]), (dstate, astate))
+
+
+## For each element of a boolean array, return the index of the last
+# True element up to it, or -1 if there is none.
+def _lastWhere(condition):
+    indices = numpy.where(condition, numpy.arange(len(condition)), -1)
+    return numpy.maximum.accumulate(indices)
+
+
 ## This handler is responsible for executing portions of experiments.
 class ExecutorHandler(deviceHandler.DeviceHandler):
     ## callbacks must include the following:
@@ -90,6 +175,8 @@ class ExecutorHandler(deviceHandler.DeviceHandler):
         # Number of digital and analogue lines.
         self._dlines = dlines
         self._alines = alines
+        ## Compiled actions of recent tables, see getProfileKey.
+        self.profileCache = ProfileCache()
         if not isinstance(self, DigitalMixin):
             self.registerDigital = self._raiseNoDigitalException
             self.getDigital = self._raiseNoDigitalException
@@ -152,52 +239,16 @@ class ExecutorHandler(deviceHandler.DeviceHandler):
         else:
             astate = None
 
-        actions = []
-
-        tPrev = None
-        hPrev = None
-        argsPrev = None
-
-        for i in range(startIndex, stopIndex):
-            t, h, args = table[i]
-            if h in self.analogClients:
-                # update analog state
-                lineHandler = self.analogClients[h]
-                if isinstance(args, collections.Iterable):
-                    # Using an indexed position
-                    pos = lineHandler.indexedPosition(*args)
-                else:
-                    pos = args
-                astate[lineHandler.line] = lineHandler.posToNative(pos)
-            elif h in self.digitalClients:
-                # set/clear appropriate bit
-                change = 1 << self.digitalClients[h]
-                # args contains new bit state
-                if args:
-                    dstate |= change
-                else:
-                    dstate = dstate & (2**self._dlines - 1) - (change)
-
-            # Check for simultaneous actions.
-            if tPrev is not None and t == tPrev:
-                if h not in hPrev:
-                    # Update last action to merge actions at same timepoint.
-                    actions[-1] = (t, (dstate, astate[:]))
-                    # Add handler and args to list for next check.
-                    hPrev.append(h)
-                    argsPrev.append(args)
-                elif args == argsPrev[hPrev.index(h)]:
-                    # Just a duplicate entry
-                    continue
-                else:
-                    # Simultaneous, different actions with same handler.
-                    raise Exception("Simultaneous actions with same hander, %s." % h)
-            else:
-                # Append new action.
-                actions.append((t, (dstate, astate[:])))
-                # Reinitialise hPrev and argsPrev for next check.
-                hPrev, argsPrev = [h], [args]
-                tPrev = t
+        # Experiments that are repeated, such as on each site of a
+        # multi-site experiment, generate the same table every time so
+        # reuse the previous compilation.
+        key = self.getProfileKey(table, startIndex, stopIndex, dstate, astate)
+        actions = self.profileCache.get(key)
+        if actions is None:
+            actions = self._compileActions(table, startIndex, stopIndex,
+                                           dstate, astate)
+            actions.key = key
+            self.profileCache.put(key, actions)
 
         events.publish(events.UPDATE_STATUS_LIGHT, 'device waiting',
                        'Waiting for %s to finish' % self.name)
@@ -205,6 +256,151 @@ class ExecutorHandler(deviceHandler.DeviceHandler):
         return self.callbacks['executeTable'](actions, 0, len(actions), numReps,
                                               repDuration)
 
+    ## Describe how this handler outputs the actions of a handler in
+    # the table, for getProfileKey.
+    def _describeClient(self, handler):
+        if handler is self:
+            return 'self'
+        elif handler in self.analogClients:
+            lineHandler = self.analogClients[handler]
+            return ('analog', lineHandler.line, lineHandler.gain,
+                    lineHandler.offset, repr(lineHandler.positions))
+        elif handler in self.digitalClients:
+            return ('digital', self.digitalClients[handler])
+        return None
+
+    ## Return a digest of everything that the compiled actions of
+    # executeTable depend on: the times and parameters of the actions
+    # between startIndex and stopIndex, the lines of the handlers they
+    # are for, and the initial digital and analogue states.
+    def getProfileKey(self, table, startIndex, stopIndex, dstate, astate):
+        digest = hashlib.sha1(repr((dstate, astate)).encode())
+        table.updateDigest(digest, startIndex, stopIndex, self._describeClient)
+        return digest.hexdigest()
+
+    ## Replace the actions of our clients with the states of the lines
+    # that this handler needs to output, as CompiledActions.  Actions at
+    # the same time are merged into a single state.
+    def _compileActions(self, table, startIndex, stopIndex, dstate, astate):
+        times, handlers, codes, params = table.getColumns(startIndex,
+                                                          stopIndex)
+        # Group the actions by time point.
+        isFirst = numpy.ones(len(times), dtype=bool)
+        isFirst[1:] = times[1:] != times[:-1]
+        self._checkSimultaneous(numpy.cumsum(isFirst), codes, handlers,
+                                params)
+        firsts = numpy.flatnonzero(isFirst)
+        # The state of a time point is the state after its last action.
+        lasts = numpy.flatnonzero(numpy.roll(isFirst, -1))
+
+        digital = None
+        if dstate is not None:
+            digital = self._compileDigital(handlers, codes, params, dstate)
+            digital = digital[lasts].astype(numpy.uint32)
+        analog = None
+        if astate is not None:
+            analog = self._compileAnalog(handlers, codes, params, astate)
+            analog = analog[lasts]
+        return CompiledActions(times[firsts], digital, analog)
+
+    ## Raise an exception if a handler has different actions at the
+    # same time point.  Identical actions are just duplicates.
+    # \param groups The time point of each action.
+    def _checkSimultaneous(self, groups, codes, handlers, params):
+        order = numpy.lexsort((codes, groups))
+        isRepeat = ((groups[order[1:]] == groups[order[:-1]])
+                    & (codes[order[1:]] == codes[order[:-1]]))
+        if not isRepeat.any():
+            return
+        # Position in order of the first action of each repeated
+        # handler and time point.
+        positions = numpy.arange(len(order))
+        firsts = numpy.maximum.accumulate(
+            numpy.where(numpy.append(False, isRepeat), 0, positions))
+        for position in numpy.flatnonzero(isRepeat) + 1:
+            row = order[position]
+            if not params[row] == params[order[firsts[position]]]:
+                raise Exception("Simultaneous actions with same hander, %s."
+                                % handlers[codes[row]])
+
+    ## Return the digital state after each action.
+    def _compileDigital(self, handlers, codes, params, dstate):
+        # Line of each handler, or -1 if it is not a digital client.
+        # Analogue clients take precedence if a handler is both.  The
+        # extra -1 at the end is for deleted actions, with code -1.
+        handlerLines = numpy.array(
+            [self.digitalClients[h]
+             if h in self.digitalClients and h not in self.analogClients
+             else -1 for h in handlers] + [-1], dtype=numpy.int64)
+        lines = handlerLines[codes]
+        rows = numpy.flatnonzero(lines >= 0)
+        values = numpy.zeros(len(codes), dtype=bool)
+        values[rows] = [bool(params[row]) for row in rows]
+
+        if self._dlines is None:
+            mask = -1
+        else:
+            mask = 2**self._dlines - 1
+        states = numpy.full(len(codes), dstate & mask, dtype=numpy.int64)
+        for line in numpy.unique(lines[rows]).tolist():
+            bit = 1 << line
+            last = _lastWhere(lines == line)
+            isSet = numpy.where(last >= 0, values[last], bool(dstate & bit))
+            states = numpy.where(isSet, states | bit, states & ~bit)
+        # Clearing a line also clears any bits beyond our lines.
+        if dstate & ~mask:
+            cleared = numpy.logical_or.accumulate((lines >= 0) & ~values)
+            states[~cleared] |= dstate & ~mask
+        return states
+
+    ## Return the analogue state after each action.
+    def _compileAnalog(self, handlers, codes, params, astate):
+        states = numpy.empty((len(codes), len(astate)), dtype=numpy.float64)
+        states[:] = astate
+        # Levels of the actions on each line, and which actions they are.
+        lineLevels = {}
+        for code, handler in enumerate(handlers):
+            lineHandler = self.analogClients.get(handler)
+            if lineHandler is None:
+                continue
+            isAction = codes == code
+            rows = numpy.flatnonzero(isAction)
+            if not len(rows):
+                continue
+            args = [params[row] for row in rows]
+            try:
+                positions = numpy.array(args, dtype=numpy.float64)
+            except (TypeError, ValueError):
+                positions = None
+            if positions is None or positions.ndim != 1:
+                positions = self._indexedPositions(lineHandler, args)
+            levels, isLine = lineLevels.setdefault(
+                lineHandler.line, (numpy.zeros(len(codes)),
+                                   numpy.zeros(len(codes), dtype=bool)))
+            levels[rows] = lineHandler.posToNative(positions)
+            isLine |= isAction
+        for line, (levels, isLine) in lineLevels.items():
+            last = _lastWhere(isLine)
+            states[:, line] = numpy.where(last >= 0, levels[last],
+                                          states[:, line])
+        return states
+
+    ## Return the positions of analogue actions, some of which are
+    # indexed positions, as an array.
+    def _indexedPositions(self, lineHandler, allArgs):
+        indexed = {}
+        result = numpy.empty(len(allArgs), dtype=numpy.float64)
+        for i, args in enumerate(allArgs):
+            if isinstance(args, collections.abc.Iterable):
+                # Using an indexed position
+                key = tuple(args)
+                if key not in indexed:
+                    indexed[key] = lineHandler.indexedPosition(*args)
+                result[i] = indexed[key]
+            else:
+                result[i] = args
+        return result
+
     ## Debugging function: display ExecutorOutputWindow.
     def showDebugWindow(self):
         # Ensure only a single instance of the window.
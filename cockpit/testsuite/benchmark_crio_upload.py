@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark for uploading action tables to the NI cRIO.
+
+This times :meth:`cockpit.devices.ni_cRIOFPGA.Connection.sendTables`
+against a :class:`cockpit.testsuite.fake_crio.FakeCRIO` on localhost,
+with the decimal string protocol and with the binary protocol, and
+reports the number of bytes sent.  Run it with::
+
+    python -m cockpit.testsuite.benchmark_crio_upload --sizes 10000 1000000
+
+"""
+
+import argparse
+import collections
+import sys
+import time
+
+import numpy
+
+import cockpit.devices.ni_cRIOFPGA
+import cockpit.testsuite.fake_crio
+
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+## Protocols to benchmark, mapped to the capabilities the fake cRIO
+## reports for them.
+PROTOCOLS = collections.OrderedDict([
+    ('ascii', []),
+    ('binary', ['binaryTables']),
+])
+
+## Result of uploading tables with `size` digital entries and the same
+## number of entries over `n_analogues` analogue tables.
+Result = collections.namedtuple('Result', ['protocol', 'size', 'seconds',
+                                           'bytes_sent'])
+
+
+def make_tables(size, n_analogues=2):
+    """Digital and analogue tables like the ones made by
+    :meth:`NIcRIO._adaptActions`, with ``size`` entries in total for
+    the analogues.
+    """
+    ticks = numpy.arange(1, size+1, dtype=numpy.uint32) * 10
+    digitals = numpy.stack([ticks, ticks % 2**16], axis=1)
+    analogues = []
+    for i in range(n_analogues):
+        n = size // n_analogues
+        analogue_ticks = ticks[i::n_analogues][:n]
+        values = numpy.arange(n, dtype=numpy.uint32) % 2**16
+        analogues.append(numpy.stack([analogue_ticks, values], axis=1))
+    return digitals, analogues
+
+
+def run_benchmark(protocol, size):
+    """Upload tables of ``size`` entries with ``protocol``."""
+    fake = cockpit.testsuite.fake_crio.FakeCRIO(PROTOCOLS[protocol])
+    try:
+        connection = cockpit.devices.ni_cRIOFPGA.Connection(
+            parent=None, ipAddress='127.0.0.1', port=[fake.port, None],
+            localIp='127.0.0.1')
+        connection.connection = connection.createSendSocket('127.0.0.1',
+                                                            fake.port, 60)
+        connection.queryCapabilities()
+        n_before = len(fake.bytesReceived)
+        digitals, analogues = make_tables(size)
+        start = time.perf_counter()
+        connection.sendTables(digitals, analogues)
+        seconds = time.perf_counter() - start
+        connection.connection.close()
+        return Result(protocol, size, seconds,
+                      sum(fake.bytesReceived[n_before:]))
+    finally:
+        fake.close()
+
+
+def format_result(result):
+    return ('%-8s %9d entries %9.3f s %12d bytes %12.0f entries/s'
+            % (result.protocol, result.size, result.seconds,
+               result.bytes_sent, result.size / result.seconds))
+
+
+def _parse_cmd_line_options(options):
+    parser = argparse.ArgumentParser(
+        prog='python -m cockpit.testsuite.benchmark_crio_upload',
+        description='Benchmark uploading action tables to the NI cRIO.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='number of entries per table')
+    parser.add_argument('--protocols', nargs='+', default=list(PROTOCOLS),
+                        choices=list(PROTOCOLS))
+    return parser.parse_args(options)
+
+
+def main(argv):
+    options = _parse_cmd_line_options(argv[1:])
+    for protocol in options.protocols:
+        for size in options.sizes:
+            print(format_result(run_benchmark(protocol, size)))
+            sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for the experiment pre-flight path.
+
+This builds experiments against dummy camera, light, and executor
+handlers, without devices or wx windows, and measures how long it
+takes to go from experiment parameters to what gets sent to the
+executor.  Each experiment is timed in stages:
+
+``createValidActionTable``
+    Generate, sort, and validate the action table.
+``executeTable``
+    Compile the table into digital and analogue states in
+    :meth:`cockpit.handlers.executor.ExecutorHandler.executeTable`.
+``tables_from_arrays``
+    Convert the compiled states into the digital and analogue tables
+    of a device profile, as executor devices with array profiles do
+    with :func:`cockpit.devices.executorDevices.arrays_from_table`
+    and :func:`cockpit.devices.executorDevices.tables_from_arrays`.
+``actions_from_table``
+    Convert the compiled states into the list of actions sent by
+    executor devices without array profiles, with
+    :func:`cockpit.devices.executorDevices.actions_from_table`.
+
+Run it with::
+
+    python -m cockpit.testsuite.benchmark_experiment --sizes 1000 100000
+
+"""
+
+import argparse
+import collections
+import decimal
+import sys
+import time
+import tracemalloc
+
+import cockpit.depot
+import cockpit.devices.executorDevices
+import cockpit.experiment.structuredIllumination
+import cockpit.experiment.stutteredZStack
+import cockpit.experiment.zStack
+import cockpit.handlers.camera
+import cockpit.handlers.executor
+import cockpit.handlers.genericPositioner
+import cockpit.handlers.lightSource
+import cockpit.handlers.stagePositioner
+
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+STAGES = ['createValidActionTable', 'executeTable', 'tables_from_arrays',
+          'actions_from_table']
+
+## Ticks per ms of the device profiles, as for the DSP.
+TICKRATE = 10
+
+## Result of a single benchmark stage.  `actions` is the number of
+## actions in the table (or compiled actions, for the device stages),
+## `seconds` is the wall time, and `peak_memory` is the peak of memory
+## allocated during the stage in bytes, or None if not traced.
+Result = collections.namedtuple('Result', ['experiment', 'size', 'stage',
+                                           'actions', 'seconds',
+                                           'peak_memory'])
+
+
+class DummySetup:
+    """Handlers for a simulated microscope.
+
+    Creates a new depot with an analogue and digital executor, a
+    number of cameras and lights triggered by it, a Z positioner and,
+    for SI experiments, angle and phase positioners on its analogue
+    lines.  All callbacks are dummies.
+    """
+    def __init__(self, n_cameras=2, n_lights=2):
+        cockpit.depot.deviceDepot = cockpit.depot.DeviceDepot()
+        ## Actions passed from ExecutorHandler.executeTable to its
+        ## executeTable callback.
+        self.compiled_actions = None
+
+        def executeTable(actions, startIndex, stopIndex, numReps,
+                         repDuration):
+            self.compiled_actions = actions
+
+        self.executor = cockpit.handlers.executor.AnalogDigitalExecutorHandler(
+            'benchmark executor', 'benchmark',
+            {'examineActions': lambda table: None,
+             'executeTable': executeTable,
+             'readDigital': lambda: 0,
+             'writeDigital': lambda state: None,
+             'getAnalog': lambda line: 0,
+             'setAnalog': lambda line, level: None,},
+            dlines=16, alines=4)
+        cockpit.depot.addHandler(self.executor)
+
+        ## Digital line 0 is not valid as a trigger line for cameras
+        ## and lights, so start from 1.
+        lines = iter(range(1, 16))
+        self.cameras = []
+        for i in range(n_cameras):
+            exposure_time = [decimal.Decimal(10)]
+            callbacks = {
+                'getExposureTime': (lambda name, isExact, t=exposure_time:
+                                    t[0] if isExact else float(t[0])),
+                'setExposureTime': (lambda name, value, t=exposure_time:
+                                    t.__setitem__(0, decimal.Decimal(value))),
+                'getTimeBetweenExposures': (lambda name, isExact:
+                                            decimal.Decimal('5') if isExact
+                                            else 5.0),
+                'setEnabled': lambda name, state: state,
+            }
+            camera = cockpit.handlers.camera.CameraHandler(
+                'benchmark camera %d' % i, 'benchmark', callbacks,
+                cockpit.handlers.camera.TRIGGER_BEFORE,
+                trigHandler=self.executor, trigLine=next(lines))
+            self.cameras.append(camera)
+
+        self.lights = []
+        for i in range(n_lights):
+            light = cockpit.handlers.lightSource.LightHandler(
+                'benchmark light %d' % i, 'benchmark', {},
+                wavelength=488 + 100*i, exposureTime=10,
+                trigHandler=self.executor, trigLine=next(lines))
+            self.lights.append(light)
+
+        self.z_positioner = cockpit.handlers.stagePositioner.PositionerHandler(
+            'benchmark Z', 'benchmark', True,
+            {'getMovementTime': lambda axis, start, delta:
+             (decimal.Decimal(1), decimal.Decimal(1)),},
+            axis=2, stepSizes=[1], stepIndex=0, hardLimits=(-1e6, 1e6))
+        self.z_positioner.connectToAnalogSource(self.executor, 0, 0, 1)
+
+        self.angle_positioner = self._make_analog_positioner('angle', 1)
+        self.angle_positioner.positions = [0, 120, 240]
+        self.phase_positioner = self._make_analog_positioner('phase', 2)
+
+
+    def _make_analog_positioner(self, name, line):
+        client = cockpit.handlers.genericPositioner.GenericPositionerHandler(
+            'benchmark %s' % name, 'benchmark', True, {})
+        return self.executor.registerAnalog(client, line,
+                                            movementTimeFunc=lambda *args: (1, 1))
+
+
+    def exposure_settings(self):
+        """One exposure per camera, each with a single light."""
+        return [([camera], [(light, decimal.Decimal(10))])
+                for camera, light in zip(self.cameras, self.lights)]
+
+
+def _zstack_args(setup, n_slices):
+    return {
+        'numReps': 1,
+        'repDuration': 0,
+        'zPositioner': setup.z_positioner,
+        'altBottom': 0,
+        'zHeight': n_slices - 1,
+        'sliceHeight': 1,
+        'exposureSettings': setup.exposure_settings(),
+    }
+
+
+def make_zstack(setup, n_slices):
+    return cockpit.experiment.zStack.ZStackExperiment(
+        **_zstack_args(setup, n_slices))
+
+
+def make_stuttered_zstack(setup, n_slices):
+    return cockpit.experiment.stutteredZStack.StutteredZStackExperiment(
+        [(1, 1)], **_zstack_args(setup, n_slices))
+
+
+def make_sim(setup, n_slices):
+    return cockpit.experiment.structuredIllumination.SIExperiment(
+        collectionOrder='Z, Angle, Phase',
+        bleachCompensations={light: 0 for light in setup.lights},
+        numAngles=3, numPhases=5,
+        angleHandler=setup.angle_positioner,
+        phaseHandler=setup.phase_positioner,
+        **_zstack_args(setup, n_slices))
+
+
+## Maps experiment names, as used in the command line, to functions
+## that create them for a given number of Z slices.
+EXPERIMENTS = collections.OrderedDict([
+    ('zstack', make_zstack),
+    ('sim', make_sim),
+    ('stuttered', make_stuttered_zstack),
+])
+
+
+def _prepare(setup, experiment):
+    """Do the parts of :meth:`Experiment.run` needed before
+    generating the action table, without moving any stage.
+    """
+    experiment.zStart = 0
+    for camera in experiment.cameras:
+        camera.setExposureTime(experiment.getExposureTimeForCamera(camera))
+    experiment.cameraToReadoutTime = {
+        c: c.getTimeBetweenExposures(isExact=True) for c in experiment.cameras
+    }
+
+
+def _table_length(make_experiment, n_slices):
+    setup = DummySetup()
+    experiment = make_experiment(setup, n_slices)
+    _prepare(setup, experiment)
+    return len(experiment.generateActions())
+
+
+def slices_for_size(make_experiment, size):
+    """Number of Z slices needed for a table of approximately
+    ``size`` actions.
+    """
+    ## The table length is linear on the number of slices, so
+    ## extrapolate from two small experiments.
+    short = _table_length(make_experiment, 2)
+    long = _table_length(make_experiment, 4)
+    per_slice = (long - short) / 2
+    return max(2, int(round(2 + (size - short) / per_slice)))
+
+
+def _run_stage(func, trace_memory):
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return seconds, peak
+
+
+def _tables_from_compiled(compiled_actions):
+    times, digital, analog = cockpit.devices.executorDevices.arrays_from_table(
+        compiled_actions, 0, len(compiled_actions), None)
+    return cockpit.devices.executorDevices.tables_from_arrays(
+        times, digital, analog, TICKRATE)
+
+
+def _run_once(make_experiment, n_slices, trace_memory):
+    setup = DummySetup()
+    experiment = make_experiment(setup, n_slices)
+    _prepare(setup, experiment)
+    stages = [
+        lambda: experiment.createValidActionTable(),
+        lambda: setup.executor.executeTable(experiment.table, 0,
+                                            len(experiment.table), 1, None),
+        lambda: _tables_from_compiled(setup.compiled_actions),
+        lambda: cockpit.devices.executorDevices.actions_from_table(
+            setup.compiled_actions, 0, len(setup.compiled_actions), None),
+    ]
+    measurements = []
+    for stage in stages:
+        seconds, peak = _run_stage(stage, trace_memory)
+        measurements.append((seconds, peak))
+    lengths = [len(experiment.table), len(experiment.table),
+               len(setup.compiled_actions), len(setup.compiled_actions)]
+    return measurements, lengths
+
+
+def run_benchmark(name, size, trace_memory=True):
+    """Benchmark experiment ``name`` with about ``size`` actions.
+
+    Returns a list of :class:`Result`, one per stage.  Memory tracing
+    slows down execution, so when ``trace_memory`` is set each stage
+    is run twice: once for wall time and once for peak memory.
+    """
+    make_experiment = EXPERIMENTS[name]
+    n_slices = slices_for_size(make_experiment, size)
+    timings, lengths = _run_once(make_experiment, n_slices, False)
+    if trace_memory:
+        memory = _run_once(make_experiment, n_slices, True)[0]
+    else:
+        memory = [(None, None)] * len(STAGES)
+    return [Result(name, size, stage, n_actions, seconds, peak)
+            for stage, n_actions, (seconds, _), (_, peak)
+            in zip(STAGES, lengths, timings, memory)]
+
+
+def format_result(result):
+    rate = result.actions / result.seconds if result.seconds else float('inf')
+    if result.peak_memory is None:
+        memory = '%10s' % '-'
+    else:
+        memory = '%7.1f MiB' % (result.peak_memory / 2**20)
+    return ('%-10s %9d %-22s %9d %10.3f s %s %12.0f actions/s'
+            % (result.experiment, result.size, result.stage, result.actions,
+               result.seconds, memory, rate))
+
+
+def _parse_cmd_line_options(options):
+    parser = argparse.ArgumentParser(
+        prog='python -m cockpit.testsuite.benchmark_experiment',
+        description='Benchmark experiment table generation and compilation.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='approximate number of actions per table')
+    parser.add_argument('--experiments', nargs='+', default=list(EXPERIMENTS),
+                        choices=list(EXPERIMENTS))
+    parser.add_argument('--no-memory', dest='trace_memory',
+                        action='store_false',
+                        help='do not measure peak memory (faster)')
+    return parser.parse_args(options)
+
+
+def main(argv):
+    options = _parse_cmd_line_options(argv[1:])
+    for name in options.experiments:
+        for size in options.sizes:
+            for result in run_benchmark(name, size, options.trace_memory):
+                print(format_result(result))
+            sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark for the histograms of the camera views.
+
+This compares the CPU time per frame of
+:func:`cockpit.gui.imageViewer.histogram.shiftedHistogram` with the
+previous implementation, which called :func:`numpy.digitize` once per
+shifted histogram over the whole frame, on simulated camera frames.
+Run it with::
+
+    python -m cockpit.testsuite.benchmark_histogram --megapixels 4 16
+
+"""
+
+import argparse
+import collections
+import sys
+import time
+
+import numpy
+
+import cockpit.gui.imageViewer.histogram
+
+
+DEFAULT_MEGAPIXELS = [4, 16]
+
+## CPU seconds per frame of each method for frames of `megapixels`.
+Result = collections.namedtuple('Result', ['megapixels', 'dtype',
+                                           'digitize', 'shifted'])
+
+
+def digitize_histogram(data, nbins=cockpit.gui.imageViewer.histogram.NUM_BINS,
+                       m=cockpit.gui.imageViewer.histogram.NUM_SHIFTS):
+    """The histogram as the view canvas used to compute it."""
+    bins = numpy.linspace(data.min(), data.max(), nbins)
+    counts = numpy.zeros(nbins)
+    h = bins[1] - bins[0]
+    for i in range(m):
+        these = numpy.bincount(numpy.digitize(data.flat, bins + i*h/m,
+                                              right=True),
+                               minlength=nbins)
+        counts += these[0:nbins]
+    return bins, counts
+
+
+def make_frame(megapixels, dtype=numpy.uint16, seed=0):
+    """A square frame of camera noise on a background, with some beads."""
+    side = int(numpy.sqrt(megapixels * 2**20))
+    rng = numpy.random.default_rng(seed)
+    frame = rng.poisson(100, (side, side)).astype(numpy.float64)
+    y, x = rng.integers(0, side, (2, 50))
+    frame[y, x] += 20000
+    return frame.astype(dtype)
+
+
+def time_cpu(function, data, repeats):
+    start = time.process_time()
+    for i in range(repeats):
+        function(data)
+    return (time.process_time() - start) / repeats
+
+
+def run_benchmark(megapixels, dtype=numpy.uint16, repeats=3):
+    frame = make_frame(megapixels, dtype)
+    return Result(megapixels, numpy.dtype(dtype).name,
+                  time_cpu(digitize_histogram, frame, repeats),
+                  time_cpu(cockpit.gui.imageViewer.histogram.shiftedHistogram,
+                           frame, repeats))
+
+
+def format_result(result):
+    return ('%5g MP %-8s digitize %8.2f ms  shifted %8.2f ms  %6.1fx'
+            % (result.megapixels, result.dtype, result.digitize * 1000,
+               result.shifted * 1000,
+               result.digitize / max(result.shifted, 1e-9)))
+
+
+def _parse_cmd_line_options(options):
+    parser = argparse.ArgumentParser(
+        prog='python -m cockpit.testsuite.benchmark_histogram',
+        description='Benchmark the histograms of the camera views.')
+    parser.add_argument('--megapixels', type=float, nargs='+',
+                        default=DEFAULT_MEGAPIXELS,
+                        help='size of the simulated frames')
+    parser.add_argument('--dtypes', nargs='+', default=['uint16'],
+                        help='numpy types of the simulated frames')
+    parser.add_argument('--repeats', type=int, default=3)
+    return parser.parse_args(options)
+
+
+def main(argv):
+    options = _parse_cmd_line_options(argv[1:])
+    for dtype in options.dtypes:
+        for megapixels in options.megapixels:
+            print(format_result(run_benchmark(megapixels, dtype,
+                                              options.repeats)))
+            sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
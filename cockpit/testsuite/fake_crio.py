@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Fake NI cRIO RT host for testing.
+
+This implements the command side of the TCP protocol used by
+:class:`cockpit.devices.ni_cRIOFPGA.Connection`: a JSON command
+cluster terminated by ``\\r\\n``, followed by ``Number of Messages``
+messages of ``Message Length`` bytes each, to which it replies with a
+JSON status.  Messages of binary commands are decoded as little-endian
+uint64, and all others as zero-padded decimal strings.
+"""
+
+import json
+import socket
+import threading
+
+import numpy
+
+
+## Commands whose messages are binary, see Connection.commandDict.
+BINARY_COMMANDS = {110, 210, 211, 212, 213}
+
+## Command that asks for the host capabilities.
+CAPABILITIES_COMMAND = 414
+
+
+class FakeCRIO:
+    """Accepts a single connection on localhost and records the commands
+    received.
+
+    Args:
+        capabilities: list of capabilities to report, or None to
+            behave like an old RT host that does not know the
+            capabilities command.
+    """
+    def __init__(self, capabilities=None):
+        self.capabilities = capabilities
+        ## List of (command, messages) tuples, in order received.
+        ## Messages are a numpy array of uint64.
+        self.commands = []
+        ## Number of bytes received for each command, including the
+        ## command cluster.
+        self.bytesReceived = []
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(1)
+        self.port = self._server.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True,
+                                        name='fake-cRIO')
+        self._thread.start()
+
+    def close(self):
+        self._server.close()
+
+    def _serve(self):
+        try:
+            connection, address = self._server.accept()
+        except OSError:
+            return # closed before anyone connected
+        with connection:
+            buf = bytearray()
+            while True:
+                while b'\r\n' not in buf:
+                    data = connection.recv(65536)
+                    if not data:
+                        return
+                    buf.extend(data)
+                end = buf.index(b'\r\n')
+                cluster = json.loads(bytes(buf[:end]))
+                del buf[:end+2]
+                size = cluster['Message Length'] * cluster['Number of Messages']
+                while len(buf) < size:
+                    data = connection.recv(max(65536, size - len(buf)))
+                    if not data:
+                        return
+                    buf.extend(data)
+                payload = bytes(buf[:size])
+                del buf[:size]
+                connection.sendall(json.dumps(self._handle(cluster, payload))
+                                   .encode())
+
+    def _handle(self, cluster, payload):
+        command = cluster['Command']
+        self.bytesReceived.append(len(json.dumps(cluster)) + 2 + len(payload))
+        if command in BINARY_COMMANDS:
+            messages = numpy.frombuffer(payload, dtype='<u8')
+        else:
+            length = cluster['Message Length']
+            messages = numpy.array([int(payload[i:i+length])
+                                    for i in range(0, len(payload), length)],
+                                   dtype=numpy.uint64)
+        self.commands.append((command, messages))
+        reply = {'status': False, 'code': 0, 'source': ''}
+        if command == CAPABILITIES_COMMAND:
+            if self.capabilities is None:
+                reply = {'status': True, 'code': 1, 'source': 'unknown command'}
+            else:
+                reply['capabilities'] = self.capabilities
+        return reply
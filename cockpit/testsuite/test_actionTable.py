@@ -203,6 +203,21 @@ class TestActionTable(unittest.TestCase):
         self.assertEqual(self.action_table.getLastActionFor(handler),
                          (0, None))
 
+    def test_getLastActionFor_unsorted(self):
+        """The last action added, not the latest, until the table is sorted.
+        """
+        handler = _MockDeviceHandler()
+        self.action_table.addAction(2, handler, 'late')
+        self.assertEqual(self.action_table.getLastActionFor(handler),
+                         (2, 'late'))
+        self.action_table.addAction(1, handler, 'early')
+        self.action_table.addAction(3, None, None)
+        self.assertEqual(self.action_table.getLastActionFor(handler),
+                         (1, 'early'))
+        self.action_table.sort()
+        self.assertEqual(self.action_table.getLastActionFor(handler),
+                         (2, 'late'))
+
     # TODO: test marktime, no elements, no elements that need to be moved
     def test_shiftActionsBack(self):
         """Tests that moving actions back introduces moves them later in time.
@@ -235,5 +250,75 @@ class TestActionTable(unittest.TestCase):
         self.assertEqual(0.1, self.action_table.addAction(0.1, None, None))
 
 
+class TestColumnarActionTable(TestActionTable):
+    def setUp(self):
+        self.action_table = cockpit.experiment.actionTable.ColumnarActionTable()
+
+    def test_enforcePositiveTimepoints_unsorted(self):
+        """Unlike ActionTable, the columnar table does not need to be sorted.
+        """
+        for time in [0, -1]:
+            self.action_table.addAction(time, None, None)
+        self.action_table.enforcePositiveTimepoints()
+        self.assertEqual([1, 0], [action[0] for action in self.action_table])
+
+    def test___getitem___slice(self):
+        for n in range(5):
+            self.action_table.addAction(n, None, n)
+        self.assertEqual([(3, None, 3), (4, None, 4)], self.action_table[3:])
+
+    def test_getLastActionFor_missing(self):
+        self.action_table.addAction(0, _MockDeviceHandler(), None)
+        self.assertEqual(self.action_table.getLastActionFor(
+            _MockDeviceHandler()), (None, None))
+
+    def test_getLastActionFor_deleted(self):
+        handler = _MockDeviceHandler()
+        self.action_table.addAction(0, handler, 'first')
+        self.action_table.addAction(1, handler, 'second')
+        self.action_table[1] = None
+        self.assertEqual(self.action_table.getLastActionFor(handler),
+                         (0, 'first'))
+
+    def test_getLastActionFor_after_shift(self):
+        handler = _MockDeviceHandler()
+        self.action_table.addAction(1, handler, 'first')
+        self.action_table.addAction(2, handler, 'second')
+        self.action_table.shiftActionsBack(0, -5)
+        self.assertEqual(self.action_table.getLastActionFor(handler),
+                         (-3, 'second'))
+
+    def test_shiftActionsBack_keeps_decimal(self):
+        self.action_table.addAction(decimal.Decimal('1'), None, None)
+        self.action_table.addAction(decimal.Decimal('3'), None, None)
+        self.action_table.shiftActionsBack(decimal.Decimal('2'),
+                                           decimal.Decimal('1e-10'))
+        self.assertEqual(self.action_table[0][0], decimal.Decimal('1'))
+        self.assertEqual(self.action_table[1][0],
+                         decimal.Decimal('3.0000000001'))
+
+    def test_sort_close_decimal(self):
+        """Times closer than a tick must still be sorted.
+        """
+        late = decimal.Decimal('1e-15')
+        self.action_table.addAction(late, None, 'late')
+        self.action_table.addAction(decimal.Decimal(0), None, 'early')
+        self.action_table.sort()
+        self.assertEqual(['early', 'late'],
+                         [action[2] for action in self.action_table])
+
+    def test_sort_stable(self):
+        for parameter in range(5):
+            self.action_table.addAction(1, None, parameter)
+        self.action_table.addAction(0, None, None)
+        self.action_table.sort()
+        self.assertEqual([None, 0, 1, 2, 3, 4],
+                         [action[2] for action in self.action_table])
+
+    def test_actions(self):
+        self.action_table.addAction(0, None, None)
+        self.assertEqual([(0, None, None)], self.action_table.actions)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import cockpit.testsuite.benchmark_experiment as benchmark
+
+
+class TestBenchmarkExperiment(unittest.TestCase):
+    """Run the benchmarks at a small size so they don't rot."""
+
+    def test_all_experiments(self):
+        for name in benchmark.EXPERIMENTS:
+            with self.subTest(experiment=name):
+                results = benchmark.run_benchmark(name, 500,
+                                                  trace_memory=False)
+                self.assertEqual([r.stage for r in results],
+                                 benchmark.STAGES)
+                for result in results:
+                    self.assertGreater(result.actions, 0)
+                    self.assertIsNone(result.peak_memory)
+
+    def test_size_is_approximate(self):
+        result = benchmark.run_benchmark('zstack', 2000,
+                                         trace_memory=False)[0]
+        self.assertLess(abs(result.actions - 2000), 100)
+
+    def test_target(self):
+        """A table of 200k actions is generated well under a second."""
+        result = benchmark.run_benchmark('stuttered', 200000,
+                                         trace_memory=False)[0]
+        self.assertEqual(result.stage, 'createValidActionTable')
+        self.assertLess(result.seconds, 1.0)
+
+    def test_trace_memory(self):
+        results = benchmark.run_benchmark('zstack', 100)
+        for result in results:
+            self.assertGreater(result.peak_memory, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
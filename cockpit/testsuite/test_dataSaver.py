@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import numpy
+
+import cockpit.depot
+import cockpit.events
+import cockpit.experiment.dataSaver
+import cockpit.util.logger
+
+
+class MockCamera:
+    def __init__(self, name, width, height, wavelength):
+        self.name = name
+        self.dye = None
+        self.wavelength = wavelength
+        self._size = (width, height)
+
+    def getImageSize(self):
+        return self._size
+
+
+class TestDataSaver(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        objective = unittest.mock.Mock()
+        objective.getPixelSize.return_value = 0.1
+        objective.getLensID.return_value = 0
+        patcher = unittest.mock.patch('cockpit.depot.getHandlersOfType',
+                                      return_value=[objective])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        ## The second camera has smaller images, which need padding,
+        ## and discards the first image of each repeat.
+        self.cameras = [MockCamera('camera 0', 16, 12, 525),
+                        MockCamera('camera 1', 8, 10, 600)]
+        self.imagesPerRep = {self.cameras[0]: 4, self.cameras[1]: 5}
+        self.ignoredIndices = {self.cameras[0]: [], self.cameras[1]: [1]}
+        self.numReps = 3
+        rng = numpy.random.RandomState(0)
+        self.images = {}
+        for camera in self.cameras:
+            width, height = camera.getImageSize()
+            n = self.imagesPerRep[camera] * self.numReps
+            self.images[camera] = rng.randint(0, 2**16, (n, height, width),
+                                              dtype=numpy.uint16)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def makeSaver(self, filename, **kwargs):
+        runThread = threading.Thread(target=lambda: None)
+        runThread.start()
+        path = os.path.join(self.tempdir, filename)
+        saver = cockpit.experiment.dataSaver.DataSaver(
+            self.cameras, self.numReps, self.imagesPerRep,
+            self.ignoredIndices, runThread, path, 0.2, ['a title'],
+            {camera: 488 for camera in self.cameras}, **kwargs)
+        saver.startCollecting()
+        return saver, path
+
+    def publishImages(self):
+        for i in range(max(len(images) for images in self.images.values())):
+            for camera in self.cameras:
+                if i < len(self.images[camera]):
+                    cockpit.events.publish(cockpit.events.NEW_IMAGE
+                                           % camera.name,
+                                           self.images[camera][i], 10.0 + i)
+
+    def save(self, filename, numWriterThreads, planeIndexMap=None):
+        saver, path = self.makeSaver(filename,
+                                     numWriterThreads=numWriterThreads,
+                                     planeIndexMap=planeIndexMap)
+        self.publishImages()
+        saver.executeAndSave()
+        return path
+
+    def test_parallel_matches_serial(self):
+        with open(self.save('serial.dv', 0), 'rb') as fh:
+            serial = fh.read()
+        with open(self.save('parallel.dv', 3), 'rb') as fh:
+            parallel = fh.read()
+        self.assertEqual(len(serial), len(parallel))
+        self.assertTrue(serial == parallel)
+
+    def test_parallel_counts_written_planes(self):
+        ## Planes only count as kept once written, and saving waits for
+        ## the saver thread before finishing the files.
+        saver, path = self.makeSaver('slow.dv', numWriterThreads=2)
+        writePlane = saver._writePlane
+        def slowWritePlane(*args):
+            time.sleep(.01)
+            self.assertLess(sum(saver.imagesKept), sum(saver.imagesPlaced))
+            writePlane(*args)
+        saver._writePlane = slowWritePlane
+        self.publishImages()
+        saver.executeAndSave()
+        self.assertFalse(saver.saveThread.is_alive())
+        self.assertEqual(saver.imagesKept, [12, 12])
+        self.assertEqual(saver.imagesKept, saver.imagesPlaced)
+        with open(self.save('serial.dv', 0), 'rb') as fh:
+            serial = fh.read()
+        with open(path, 'rb') as fh:
+            self.assertTrue(fh.read() == serial)
+
+    def test_parallel_data(self):
+        path = self.save('parallel.dv', 2)
+        ## Size of the extended header is at byte 92 of the header.
+        extendedBytes = numpy.fromfile(path, dtype=numpy.int32, count=1,
+                                       offset=92)[0]
+        ## Planes are in TZW order, with camera images padded to the
+        ## largest.
+        data = numpy.fromfile(path, dtype=numpy.uint16,
+                              offset=1024 + extendedBytes)
+        data = data.reshape(self.numReps, 4, 2, 12, 16).transpose(2, 0, 1, 3, 4)
+        numpy.testing.assert_array_equal(
+            data[0].reshape(-1, 12, 16), self.images[self.cameras[0]])
+        kept = self.images[self.cameras[1]].reshape(self.numReps, 5, 10, 8)
+        numpy.testing.assert_array_equal(data[1, :, :, :10, :8],
+                                         kept[:, 1:])
+        self.assertFalse(data[1, :, :, 10:, :].any())
+        self.assertFalse(data[1, :, :, :, 8:].any())
+
+    def test_plane_index_map(self):
+        reverse = lambda index: 3 - index
+        for numWriterThreads in (0, 2):
+            path = self.save('mapped-%d.dv' % numWriterThreads,
+                             numWriterThreads, planeIndexMap=reverse)
+            extendedBytes = numpy.fromfile(path, dtype=numpy.int32, count=1,
+                                           offset=92)[0]
+            data = numpy.fromfile(path, dtype=numpy.uint16,
+                                  offset=1024 + extendedBytes)
+            data = data.reshape(self.numReps, 4, 2, 12, 16)
+            numpy.testing.assert_array_equal(
+                data[:, ::-1, 0].reshape(-1, 12, 16),
+                self.images[self.cameras[0]])
+            ## Metadata is moved with the plane.
+            extended = numpy.fromfile(
+                path, dtype=cockpit.experiment.dataSaver.EXTENDED_HEADER_DTYPE,
+                count=self.numReps * 4 * 2, offset=1024)
+            timestamps = extended['floats'][:, 1].reshape(self.numReps, 4, 2)
+            self.assertTrue((numpy.diff(timestamps[:, ::-1, 0].ravel()) > 0)
+                            .all())
+
+    @unittest.mock.patch('cockpit.util.logger.log')
+    def test_dropped_planes(self, log):
+        ## Only room for one image and it can't be written until the
+        ## file is unlocked, so all others are dropped.
+        saver, path = self.makeSaver(
+            'dropped.dv', maxQueueBytes=1,
+            queuePolicy=cockpit.experiment.dataSaver.QUEUE_DROP)
+        with saver.fileLocks[0]:
+            self.publishImages()
+        saver.executeAndSave()
+
+        numPlanes = 2 * self.numReps * 4
+        self.assertEqual(sorted(saver.droppedPlanes),
+                         [(0, i) for i in range(1, numPlanes)])
+        log.error.assert_called_once()
+        extended = numpy.fromfile(
+            path, dtype=cockpit.experiment.dataSaver.EXTENDED_HEADER_DTYPE,
+            count=numPlanes, offset=1024)
+        self.assertEqual(extended['ints'][0, 0], 0)
+        numpy.testing.assert_array_equal(
+            extended['ints'][1:, 0], cockpit.experiment.dataSaver.PLANE_DROPPED)
+        ## Blank planes for the dropped images, up to the full size.
+        data = numpy.fromfile(path, dtype=numpy.uint16,
+                              offset=1024 + 160 * numPlanes)
+        self.assertEqual(data.size, numPlanes * 12 * 16)
+        self.assertFalse(data[12*16:].any())
+        with open(path, 'rb') as fh:
+            self.assertIn(b'Image queue: drop policy', fh.read(1024))
+
+
+class TestImageQueue(unittest.TestCase):
+    def setUp(self):
+        self.images = [numpy.full((4, 4), i, dtype=numpy.uint16)
+                       for i in range(5)]
+
+    def test_drop(self):
+        queue = cockpit.experiment.dataSaver.ImageQueue(
+            64, cockpit.experiment.dataSaver.QUEUE_DROP)
+        results = [queue.put(0, image, i)
+                   for i, image in enumerate(self.images)]
+        self.assertEqual(results, ['block', 'block', 'drop', 'drop', 'drop'])
+        self.assertEqual(queue.numDropped, 3)
+        first = queue.get()
+        queue.get()
+        queue.release(first[1])
+        self.assertIsNone(queue.get()[1])
+        self.assertEqual(queue.put(0, self.images[0], 5), 'block')
+
+    def test_spill(self):
+        queue = cockpit.experiment.dataSaver.ImageQueue(
+            32, cockpit.experiment.dataSaver.QUEUE_SPILL, spillBytes=80)
+        results = [queue.put(0, image, i)
+                   for i, image in enumerate(self.images[:3])]
+        self.assertEqual(results, ['block', 'spill', 'spill'])
+        self.assertEqual(queue.numSpilled, 2)
+        for i in range(3):
+            cameraIndex, image, timestamp = queue.get()
+            self.assertEqual(timestamp, i)
+            numpy.testing.assert_array_equal(image, self.images[i])
+            queue.release(image)
+        ## Spill file wraps around once emptied.
+        for i in range(10):
+            queue.put(0, self.images[0], 0)
+            self.assertEqual(queue.put(0, self.images[i % 5], i), 'spill')
+            queue.release(queue.get()[1])
+            numpy.testing.assert_array_equal(queue.get()[1],
+                                             self.images[i % 5])
+
+    def test_spill_unlocked(self):
+        ## Writing to the spill file does not hold up the queue, and
+        # the spilled image keeps its place in it.
+        queue = cockpit.experiment.dataSaver.ImageQueue(
+            32, cockpit.experiment.dataSaver.QUEUE_SPILL, spillBytes=80)
+        queue.put(0, self.images[0], 0)
+        isWriting = threading.Event()
+        canWrite = threading.Event()
+        writeAt = queue.spillFile.writeAt
+        def slowWriteAt(*args):
+            isWriting.set()
+            canWrite.wait(1)
+            writeAt(*args)
+        queue.spillFile.writeAt = slowWriteAt
+        thread = threading.Thread(target=queue.put,
+                                  args=(0, self.images[1], 1))
+        thread.start()
+        self.assertTrue(isWriting.wait(1))
+        cameraIndex, image, timestamp = queue.get()
+        self.assertEqual(timestamp, 0)
+        queue.release(image)
+        self.assertEqual(queue.put(0, self.images[2], 2), 'block')
+        canWrite.set()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        for i in (1, 2):
+            cameraIndex, image, timestamp = queue.get()
+            self.assertEqual(timestamp, i)
+            numpy.testing.assert_array_equal(image, self.images[i])
+            queue.release(image)
+
+    def test_block(self):
+        queue = cockpit.experiment.dataSaver.ImageQueue(
+            32, cockpit.experiment.dataSaver.QUEUE_BLOCK)
+        queue.put(0, self.images[0], 0)
+        thread = threading.Thread(target=queue.put,
+                                  args=(0, self.images[1], 1))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        queue.release(queue.get()[1])
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(queue.get()[2], 1)
+
+    def test_close(self):
+        queue = cockpit.experiment.dataSaver.ImageQueue(32)
+        thread = threading.Thread(target=queue.get)
+        thread.start()
+        queue.close()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        queue.put(0, self.images[0], 0)
+        self.assertIsNone(queue.get())
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            cockpit.experiment.dataSaver.ImageQueue(32, 'discard')
+
+
+if __name__ == '__main__':
+    unittest.main()
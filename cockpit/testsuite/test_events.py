@@ -153,5 +153,125 @@ class TestExecuteAndWait(TestEvents):
         self.subscriber.assert_not_called()
 
 
+class TestDispatchModes(TestEvents):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        ## Set to let the subscriber return.
+        self.release = threading.Event()
+        self.release.set()
+
+    def subscriber_func(self, *args):
+        self.release.wait(5)
+        self.calls.append((threading.current_thread(), args))
+
+    def wait_for_calls(self, n):
+        deadline = time.monotonic() + 5
+        while len(self.calls) < n and time.monotonic() < deadline:
+            time.sleep(.001)
+        self.assertEqual(len(self.calls), n)
+
+    def wait_until_taken(self):
+        """Wait for the worker to take all pending events."""
+        deadline = time.monotonic() + 5
+        while self.get_stats()['pending'] and time.monotonic() < deadline:
+            time.sleep(.001)
+
+    def get_stats(self):
+        [stats] = [s for s in cockpit.events.getSubscriberStats()
+                   if s['event'] == self.event_name]
+        return stats
+
+    def test_inline(self):
+        cockpit.events.subscribe(self.event_name, self.subscriber_func)
+        cockpit.events.publish(self.event_name, 1)
+        self.assertEqual(self.calls, [(threading.current_thread(), (1,))])
+        stats = self.get_stats()
+        self.assertEqual(stats['mode'], cockpit.events.INLINE)
+        self.assertEqual((stats['delivered'], stats['dropped']), (1, 0))
+
+    def test_queued(self):
+        """Queued subscribers get every event, in order, in another thread"""
+        cockpit.events.subscribe(self.event_name, self.subscriber_func,
+                                 cockpit.events.QUEUED)
+        for i in range(10):
+            cockpit.events.publish(self.event_name, i)
+        self.wait_for_calls(10)
+        self.assertEqual([args for thread, args in self.calls],
+                         [(i,) for i in range(10)])
+        self.assertNotIn(threading.current_thread(),
+                         [thread for thread, args in self.calls])
+
+    def test_queued_overflow(self):
+        for overflow, expected in [(cockpit.events.DROP_NEWEST, [0, 1, 2]),
+                                   (cockpit.events.DROP_OLDEST, [0, 3, 4])]:
+            with self.subTest(overflow=overflow):
+                self.calls.clear()
+                self.release.clear()
+                cockpit.events.subscribe(self.event_name, self.subscriber_func,
+                                         cockpit.events.QUEUED, maxQueue=2,
+                                         overflow=overflow)
+                cockpit.events.publish(self.event_name, 0)
+                self.wait_until_taken()
+                for i in range(1, 5):
+                    cockpit.events.publish(self.event_name, i)
+                self.release.set()
+                self.wait_for_calls(3)
+                self.assertEqual([args[0] for thread, args in self.calls],
+                                 expected)
+                self.assertEqual(self.get_stats()['dropped'], 2)
+                cockpit.events.unsubscribe(self.event_name,
+                                           self.subscriber_func)
+
+    def test_latest(self):
+        """Latest subscribers only get the latest event of each key"""
+        self.release.clear()
+        cockpit.events.subscribe(self.event_name, self.subscriber_func,
+                                 cockpit.events.LATEST,
+                                 key=lambda axis, position: axis)
+        cockpit.events.publish(self.event_name, 0, 0)
+        self.wait_until_taken()
+        for position in range(1, 4):
+            for axis in range(2):
+                cockpit.events.publish(self.event_name, axis, position)
+        self.release.set()
+        self.wait_for_calls(3)
+        self.assertEqual([args for thread, args in self.calls],
+                         [(0, 0), (0, 3), (1, 3)])
+        self.assertEqual(self.get_stats()['dropped'], 4)
+
+    def test_latest_bad_key(self):
+        """Errors in the key of latest subscribers do not reach publish"""
+        cockpit.events.subscribe(self.event_name, self.subscriber_func,
+                                 cockpit.events.LATEST,
+                                 key=lambda axis, position: {}[axis])
+        with unittest.mock.patch('sys.stderr'):
+            cockpit.events.publish(self.event_name, 0, 0)
+        self.assertEqual(self.get_stats()['dropped'], 1)
+        self.assertEqual(self.calls, [])
+
+    def test_unsubscribe_stops_worker(self):
+        cockpit.events.subscribe(self.event_name, self.subscriber_func,
+                                 cockpit.events.QUEUED)
+        cockpit.events.unsubscribe(self.event_name, self.subscriber_func)
+        cockpit.events.publish(self.event_name)
+        time.sleep(.01)
+        self.assertEqual(self.calls, [])
+        self.assertNotIn(self.event_name,
+                         [stats['event'] for stats
+                          in cockpit.events.getSubscriberStats()])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            cockpit.events.subscribe(self.event_name, self.subscriber,
+                                     'sometimes')
+        with self.assertRaises(ValueError):
+            cockpit.events.subscribe(self.event_name, self.subscriber,
+                                     cockpit.events.QUEUED, overflow='spill')
+        with self.assertRaises(ValueError):
+            cockpit.events._one_shot_publisher.subscribe(
+                self.event_name, self.subscriber, cockpit.events.QUEUED)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import numpy
+
+import cockpit.experiment.actionTable
+import cockpit.handlers.executor
+import cockpit.testsuite.benchmark_experiment as benchmark
+
+
+class TestProfileCache(unittest.TestCase):
+    def setUp(self):
+        self.setup = benchmark.DummySetup()
+
+    def compile(self, make_experiment=benchmark.make_zstack, n_slices=10):
+        experiment = make_experiment(self.setup, n_slices)
+        benchmark._prepare(self.setup, experiment)
+        experiment.createValidActionTable()
+        self.setup.executor.executeTable(experiment.table, 0,
+                                         len(experiment.table), 1, None)
+        return self.setup.compiled_actions
+
+    def test_same_table_is_compiled_once(self):
+        first = self.compile()
+        second = self.compile()
+        self.assertIsInstance(first, cockpit.handlers.executor.CompiledActions)
+        self.assertIs(first, second)
+        self.assertEqual(self.setup.executor.profileCache.hits, 1)
+        self.assertEqual(len(self.setup.executor.profileCache), 1)
+
+    def test_cached_matches_compiled(self):
+        cached = self.compile(benchmark.make_sim, 3)
+        cache = self.setup.executor.profileCache
+        cache.clear()
+        self.assertEqual(list(self.compile(benchmark.make_sim, 3)),
+                         list(cached))
+
+    def test_different_table(self):
+        self.assertNotEqual(self.compile(n_slices=10).key,
+                            self.compile(n_slices=11).key)
+
+    def test_initial_state(self):
+        first = self.compile()
+        self.setup.executor.callbacks['readDigital'] = lambda: 1
+        second = self.compile()
+        self.assertNotEqual(first.key, second.key)
+        self.assertEqual(second[0][1][0] & 1, 1)
+
+    def test_indexed_positions(self):
+        first = self.compile(benchmark.make_sim, 2)
+        self.setup.angle_positioner.positions = [0, 60, 120]
+        second = self.compile(benchmark.make_sim, 2)
+        self.assertNotEqual(first.key, second.key)
+
+    def test_list_table(self):
+        ## Same actions in an ActionTable and a ColumnarActionTable
+        ## compile to the same actions, but are hashed differently.
+        z = self.setup.z_positioner
+        camera = self.setup.cameras[0]
+        results = []
+        for tableClass in (cockpit.experiment.actionTable.ActionTable,
+                           cockpit.experiment.actionTable.ColumnarActionTable):
+            table = tableClass()
+            table.addAction(0, z, 1)
+            table.addAction(1, camera, True)
+            table.addAction(1, z, 2)
+            table.addAction(2, camera, False)
+            self.setup.executor.executeTable(table, 0, len(table), 1, None)
+            results.append(self.setup.compiled_actions)
+        self.assertEqual(list(results[0]), list(results[1]))
+        self.assertNotEqual(results[0].key, results[1].key)
+
+    def test_cache_size(self):
+        cache = cockpit.handlers.executor.ProfileCache(maxSize=2)
+        for key in 'abc':
+            cache.put(key, key.upper())
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 'B')
+        cache.put('d', 'D')
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+
+class TestCompileActions(unittest.TestCase):
+    def setUp(self):
+        self.setup = benchmark.DummySetup()
+        self.z = self.setup.z_positioner
+        self.angle = self.setup.angle_positioner
+        self.camera, self.light = self.setup.cameras[0], self.setup.lights[0]
+        self.table = cockpit.experiment.actionTable.ColumnarActionTable()
+
+    def compile(self, dstate=0):
+        self.setup.executor.callbacks['readDigital'] = lambda: dstate
+        self.setup.executor.executeTable(self.table, 0, len(self.table), 1,
+                                         None)
+        return self.setup.compiled_actions
+
+    def test_arrays(self):
+        self.table.addAction(0, self.z, 10)
+        self.table.addAction(1, self.camera, True)
+        self.table.addAction(2, self.camera, False)
+        self.table.addAction(2, self.angle, (1, None))
+        actions = self.compile()
+        numpy.testing.assert_array_equal(actions.times, [0, 1, 2])
+        self.assertEqual(actions.digital.dtype, numpy.uint32)
+        numpy.testing.assert_array_equal(actions.digital, [0, 2, 0])
+        numpy.testing.assert_array_equal(actions.analog,
+                                         [[10, 0, 0, 0], [10, 0, 0, 0],
+                                          [10, 120, 0, 0]])
+        self.assertEqual(actions[1], (1.0, (2, [10.0, 0.0, 0.0, 0.0])))
+
+    def test_simultaneous_actions_are_merged(self):
+        self.table.addAction(1, self.camera, True)
+        self.table.addAction(1, self.light, True)
+        self.table.addAction(1, self.camera, True)
+        self.table.addAction(2, self.light, False)
+        actions = self.compile(dstate=1)
+        ## Camera 0 is on line 1 and light 0 on line 3.
+        numpy.testing.assert_array_equal(actions.digital, [0b1011, 0b0011])
+
+    def test_simultaneous_conflict(self):
+        self.table.addAction(1, self.camera, True)
+        self.table.addAction(1, self.light, True)
+        self.table.addAction(1, self.camera, False)
+        with self.assertRaisesRegex(Exception, 'Simultaneous actions'):
+            self.compile()
+
+    def test_clear_drops_unknown_lines(self):
+        ## Bits beyond the executor lines are kept until a line is
+        ## cleared, as the executor lines are masked when clearing.
+        self.table.addAction(1, self.camera, True)
+        self.table.addAction(2, self.camera, False)
+        actions = self.compile(dstate=2**20)
+        numpy.testing.assert_array_equal(actions.digital, [2**20 | 2, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,10 +21,14 @@
 import unittest
 import unittest.mock
 
+import numpy
 import wx
 
 import cockpit.events
 import cockpit.gui
+import cockpit.gui.imageViewer.fftView
+import cockpit.gui.imageViewer.renderStats
+import cockpit.gui.imageViewer.viewCanvas
 
 
 class WxTestCase(unittest.TestCase):
@@ -74,5 +78,169 @@ class TestCockpitEvents(WxTestCase):
         self.mock_function.assert_not_called()
 
 
+class FakeWindow:
+    def __init__(self):
+        self.refreshes = 0
+        self.destroyed = False
+
+    def __bool__(self):
+        return not self.destroyed
+
+    def Refresh(self):
+        self.refreshes += 1
+
+
+@unittest.mock.patch('wx.CallLater')
+@unittest.mock.patch('wx.CallAfter')
+class TestFrameScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = cockpit.gui.FrameScheduler(interval=0.125)
+        self.now = 10.0
+        self.scheduler.clock = lambda: self.now
+        self.windows = [FakeWindow(), FakeWindow()]
+
+    def test_coalesces(self, CallAfter, CallLater):
+        for i in range(100):
+            for window in self.windows:
+                self.scheduler.Invalidate(window)
+        CallAfter.assert_called_once_with(self.scheduler._OnFrame)
+        self.scheduler._OnFrame()
+        self.assertEqual([w.refreshes for w in self.windows], [1, 1])
+        CallLater.assert_not_called()
+        ## Nothing pending, so the next invalidation schedules a frame.
+        self.scheduler.Invalidate(self.windows[0])
+        self.assertEqual(CallAfter.call_count, 2)
+
+    def test_caps_rate(self, CallAfter, CallLater):
+        self.scheduler.Invalidate(self.windows[0])
+        self.scheduler._OnFrame()
+        self.now += .03125
+        self.scheduler.Invalidate(self.windows[0])
+        self.scheduler.Invalidate(self.windows[1])
+        self.scheduler._OnFrame()
+        ## The second window is new so is refreshed straight away; the
+        ## first waits until its interval is up.
+        self.assertEqual([w.refreshes for w in self.windows], [1, 1])
+        CallLater.assert_called_once_with(93, self.scheduler._OnFrame)
+        self.now += .09375
+        self.scheduler._OnFrame()
+        self.assertEqual([w.refreshes for w in self.windows], [2, 1])
+
+    def test_destroyed_window(self, CallAfter, CallLater):
+        self.windows[0].destroyed = True
+        self.scheduler.Invalidate(self.windows[0])
+        self.scheduler._OnFrame()
+        self.assertEqual(self.windows[0].refreshes, 0)
+        self.assertNotIn(self.windows[0], self.scheduler._last_frame)
+
+
+class TestImageContrast(unittest.TestCase):
+    def shade(self, image, values):
+        ## What the fragment shader does, before clamping, to the texels
+        ## that GL makes of values.
+        texels = (numpy.asarray(values, dtype=numpy.float64)
+                  / cockpit.gui.mosaic.tile.getMaxTexelValue(
+                      image._textureDtype))
+        return image.offset + image.gain * texels
+
+    def test_uint16(self):
+        image = cockpit.gui.imageViewer.viewCanvas.Image()
+        image._textureDtype = numpy.dtype(numpy.uint16)
+        image.setDisplayRange(100, 1100)
+        numpy.testing.assert_allclose(self.shade(image, [100, 600, 1100]),
+                                      [0, .5, 1], atol=1e-12)
+
+    def test_float(self):
+        image = cockpit.gui.imageViewer.viewCanvas.Image()
+        image.setDisplayRange(-2, 2)
+        numpy.testing.assert_allclose(self.shade(image, [-2, 0, 2]),
+                                      [0, .5, 1])
+
+    def test_empty_range(self):
+        image = cockpit.gui.imageViewer.viewCanvas.Image()
+        image.setDisplayRange(5, 5)
+        self.assertTrue(numpy.isfinite([image.gain, image.offset]).all())
+
+
+class TestRenderStats(unittest.TestCase):
+    def setUp(self):
+        self.stats = cockpit.gui.imageViewer.renderStats.RenderStats(
+            windowSize=3)
+        self.now = 0.0
+        self.stats.clock = lambda: self.now
+
+    def test_counts(self):
+        for i in range(5):
+            self.stats.addReceived()
+        self.stats.addDropped(2)
+        self.stats.addPaint(.01, .002)
+        self.stats.addPaint(.03)
+        summary = self.stats.getSummary()
+        self.assertEqual((summary['received'], summary['displayed'],
+                          summary['dropped']), (5, 1, 2))
+        numpy.testing.assert_allclose(summary['upload'], (2, 2))
+        numpy.testing.assert_allclose(summary['paint'], (20, 30))
+
+    def test_fps_over_window(self):
+        self.assertEqual(self.stats.getSummary()['fps'], 0)
+        for t in [0, 1, 1.5, 2]:
+            self.now = t
+            self.stats.addPaint(.01, .001)
+        ## Only the last three frames count.
+        self.assertAlmostEqual(self.stats.getSummary()['fps'], 2)
+
+    def test_reset(self):
+        self.stats.addReceived()
+        self.stats.addPaint(.01, .001)
+        self.stats.reset()
+        summary = self.stats.getSummary()
+        self.assertEqual(summary['received'], 0)
+        self.assertEqual(summary['paint'], (0, 0))
+        self.assertIn('0 dropped', self.stats.format())
+
+
+class TestFFTView(unittest.TestCase):
+    def setUp(self):
+        self.rng = numpy.random.default_rng(0)
+
+    def expected(self, image):
+        return numpy.log(numpy.abs(numpy.fft.fftshift(numpy.fft.fft2(image))))
+
+    def test_matches_fft2(self):
+        for shape in [(64, 64), (63, 65), (50, 41)]:
+            with self.subTest(shape=shape):
+                image = self.rng.poisson(100, shape).astype(numpy.uint16)
+                result = cockpit.gui.imageViewer.fftView.FFTView().compute(image)
+                self.assertEqual(result.dtype, numpy.float32)
+                numpy.testing.assert_allclose(result, self.expected(image),
+                                              atol=1e-3)
+
+    def test_cache(self):
+        view = cockpit.gui.imageViewer.fftView.FFTView()
+        image = self.rng.poisson(100, (32, 32)).astype(numpy.uint16)
+        self.assertIsNone(view.getCached(image))
+        result = view.compute(image)
+        self.assertIs(view.getCached(image), result)
+        self.assertIs(view.compute(image), result)
+        ## A new image, even with the same data, is computed again into
+        ## a new result, which doesn't change the old one.
+        old = result.copy()
+        other = view.compute(image * 2)
+        self.assertIsNot(other, result)
+        numpy.testing.assert_array_equal(result, old)
+        view.setRegion(16)
+        self.assertIsNone(view.getCached(image))
+
+    def test_region(self):
+        image = self.rng.poisson(100, (100, 80)).astype(numpy.uint16)
+        view = cockpit.gui.imageViewer.fftView.FFTView(maxSize=32,
+                                                        downsample=2)
+        numpy.testing.assert_array_equal(view.getRegion(image),
+                                         image[::2, ::2][9:41, 4:36])
+        numpy.testing.assert_allclose(view.compute(image),
+                                      self.expected(view.getRegion(image)),
+                                      atol=1e-3)
+
+
 if __name__ == '__main__':
     unittest.main()
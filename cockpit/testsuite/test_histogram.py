@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import numpy
+
+import cockpit.gui.imageViewer.histogram as histogram
+import cockpit.testsuite.benchmark_histogram as benchmark
+
+
+class TestShiftedHistogram(unittest.TestCase):
+    def setUp(self):
+        self.rng = numpy.random.default_rng(0)
+
+    def assertSameAsDigitize(self, data):
+        bins, counts = histogram.shiftedHistogram(data)
+        expected_bins, expected_counts = benchmark.digitize_histogram(data)
+        numpy.testing.assert_allclose(bins, expected_bins)
+        numpy.testing.assert_array_equal(counts, expected_counts)
+
+    def test_uint16(self):
+        ## Values on the bin edges of every shifted histogram.
+        self.assertSameAsDigitize(self.rng.integers(0, 63*4*3 + 1, (200, 300))
+                                  .astype(numpy.uint16))
+
+    def test_uint8(self):
+        self.assertSameAsDigitize(self.rng.integers(10, 200, (100, 100))
+                                  .astype(numpy.uint8))
+
+    def test_int16(self):
+        self.assertSameAsDigitize(self.rng.integers(-2**15, 2**15, (100, 100))
+                                  .astype(numpy.int16))
+
+    def test_float(self):
+        self.assertSameAsDigitize(self.rng.normal(100, 20, (100, 100)))
+
+    def test_constant(self):
+        self.assertSameAsDigitize(numpy.full((10, 10), 7, numpy.uint16))
+
+    def test_subsample(self):
+        data = self.rng.normal(100, 20, (300, 400))
+        sample = histogram.subsample(data, 10000)
+        self.assertLessEqual(sample.size, 10000)
+        self.assertTrue(numpy.shares_memory(sample, data))
+        bins, counts = histogram.shiftedHistogram(data, maxPixels=10000)
+        self.assertEqual(counts.sum(), histogram.NUM_SHIFTS * sample.size)
+        ## The bins span all of the data, not only the sample.
+        self.assertEqual((bins[0], bins[-1]), (data.min(), data.max()))
+        self.assertIs(histogram.subsample(data, data.size), data)
+
+    def test_no_subsample_uint16(self):
+        data = self.rng.integers(0, 1000, (300, 400)).astype(numpy.uint16)
+        bins, counts = histogram.shiftedHistogram(data, maxPixels=10000)
+        expected_bins, expected_counts = benchmark.digitize_histogram(data)
+        numpy.testing.assert_allclose(bins, expected_bins)
+        numpy.testing.assert_array_equal(counts, expected_counts)
+
+
+class TestBenchmarkHistogram(unittest.TestCase):
+    """Run the benchmark at a small size so it doesn't rot."""
+
+    def test_benchmark(self):
+        result = benchmark.run_benchmark(.25, repeats=1)
+        self.assertGreater(result.digitize, 0)
+        self.assertIn('MP', benchmark.format_result(result))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import gc
+import queue
+import threading
+import unittest
+
+import numpy
+import Pyro4
+
+import cockpit.depot
+import cockpit.devices.server
+import cockpit.util.listener
+
+
+class PyroOnlyCamera:
+    """Stand-in for a device server camera that sends images as Pyro
+    call arguments.
+    """
+    def __init__(self):
+        self.clientUri = None
+        self.client = None
+        ## How each image was sent, 'pyro' or 'shared memory'.
+        self.sentBy = []
+
+    def receiveClient(self, uri):
+        self.clientUri = uri
+        self.client = None
+
+    def sendImage(self, image, timestamp):
+        # Proxies can't be shared between threads, so make it in the
+        # thread sending images.
+        if self.client is None:
+            self.client = Pyro4.Proxy(self.clientUri)
+        self.client.receiveData(image, timestamp)
+        self.sentBy.append('pyro')
+
+
+class SharedMemoryCamera(PyroOnlyCamera):
+    """Stand-in for a device server camera that supports sending
+    images through a SharedImageRing.
+    """
+    def __init__(self):
+        super().__init__()
+        self.memory = None
+
+    def receiveClient(self, uri):
+        super().receiveClient(uri)
+        if self.memory is not None:
+            self.states = None
+            self.memory.close()
+            self.memory = None
+
+    def receiveClientSharedMemory(self, uri, name, numSlots, slotBytes):
+        self.receiveClient(uri)
+        self.memory = (cockpit.util.listener.shared_memory
+                       .SharedMemory(name=name))
+        self.numSlots = numSlots
+        self.slotBytes = slotBytes
+        self.dataOffset = -(-numSlots // cockpit.util.listener.SLOT_ALIGNMENT
+                            ) * cockpit.util.listener.SLOT_ALIGNMENT
+        self.states = numpy.ndarray((numSlots,), dtype=numpy.uint8,
+                                    buffer=self.memory.buf)
+        self.nextSlot = 0
+        return True
+
+    def sendImage(self, image, timestamp):
+        slot = self.nextSlot
+        if (self.memory is None or image.nbytes > self.slotBytes
+            or self.states[slot] != cockpit.util.listener.SLOT_FREE):
+            return super().sendImage(image, timestamp)
+        if self.client is None:
+            self.client = Pyro4.Proxy(self.clientUri)
+        offset = self.dataOffset + slot * self.slotBytes
+        self.memory.buf[offset:offset+image.nbytes] = image.tobytes()
+        self.states[slot] = cockpit.util.listener.SLOT_FULL
+        self.nextSlot = (slot + 1) % self.numSlots
+        self.client.receiveData((slot, image.shape, image.dtype.str),
+                                timestamp)
+        self.sentBy.append('shared memory')
+
+
+@unittest.skipIf(cockpit.util.listener.shared_memory is None,
+                 'multiprocessing.shared_memory not available')
+class TestSharedMemoryListener(unittest.TestCase):
+    def setUp(self):
+        cockpit.depot.deviceDepot = cockpit.depot.DeviceDepot()
+        server = cockpit.devices.server.CockpitServer('server', {})
+        for handler in server.getHandlers():
+            cockpit.depot.addHandler(handler)
+
+        self.daemon = Pyro4.Daemon(host='127.0.0.1')
+        threading.Thread(target=self.daemon.requestLoop, daemon=True).start()
+        self.received = queue.Queue()
+        self.images = [numpy.full((30, 20), i, dtype=numpy.uint16)
+                       for i in range(5)]
+
+    def tearDown(self):
+        self.listener.disconnect()
+        self.daemon.shutdown()
+
+    def connect(self, camera, numSlots=4):
+        uri = self.daemon.register(camera)
+        self.listener = cockpit.util.listener.SharedMemoryListener(
+            Pyro4.Proxy(uri),
+            lambda image, timestamp: self.received.put((image, timestamp)),
+            numSlots=numSlots, slotBytes=30*20*2)
+        self.listener.connect()
+
+    def receive(self):
+        return self.received.get(timeout=5)
+
+    def test_shared_memory(self):
+        camera = SharedMemoryCamera()
+        self.connect(camera)
+        self.assertIsNotNone(self.listener.ring)
+        camera.sendImage(self.images[1], 10.0)
+        image, timestamp = self.receive()
+        self.assertEqual(camera.sentBy, ['shared memory'])
+        self.assertEqual(timestamp, 10.0)
+        numpy.testing.assert_array_equal(image, self.images[1])
+        self.assertEqual(self.listener.ring.states[0],
+                         cockpit.util.listener.SLOT_FULL)
+        ## Slot is freed once there are no more views of the image.
+        view = image[10:, :]
+        del image
+        gc.collect()
+        self.assertEqual(self.listener.ring.states[0],
+                         cockpit.util.listener.SLOT_FULL)
+        del view
+        gc.collect()
+        self.assertEqual(self.listener.ring.states[0],
+                         cockpit.util.listener.SLOT_FREE)
+
+    def test_falls_back_when_ring_is_full(self):
+        camera = SharedMemoryCamera()
+        self.connect(camera, numSlots=2)
+        held = []
+        for i, image in enumerate(self.images[:3]):
+            camera.sendImage(image, i)
+            held.append(self.receive()[0])
+        self.assertEqual(camera.sentBy,
+                         ['shared memory', 'shared memory', 'pyro'])
+        for image, expected in zip(held, self.images):
+            numpy.testing.assert_array_equal(image, expected)
+        del held[0]
+        gc.collect()
+        camera.sendImage(self.images[3], 3)
+        numpy.testing.assert_array_equal(self.receive()[0], self.images[3])
+        self.assertEqual(camera.sentBy[-1], 'shared memory')
+
+    def test_falls_back_without_support(self):
+        camera = PyroOnlyCamera()
+        self.connect(camera)
+        self.assertIsNone(self.listener.ring)
+        camera.sendImage(self.images[2], 2.0)
+        image, timestamp = self.receive()
+        numpy.testing.assert_array_equal(image, self.images[2])
+        self.assertEqual(camera.sentBy, ['pyro'])
+
+    def test_disconnect(self):
+        camera = SharedMemoryCamera()
+        self.connect(camera)
+        self.listener.disconnect()
+        self.assertIsNone(camera.memory)
+        self.assertIsNone(self.listener.ring)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,712 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import numpy
+
+import cockpit.events
+import cockpit.gui.mosaic.beadFinder
+import cockpit.gui.mosaic.canvas
+import cockpit.gui.mosaic.export
+import cockpit.util.datadoc
+import cockpit.gui.mosaic.tile
+import cockpit.gui.mosaic.tileStore
+import cockpit.gui.mosaic.window
+import cockpit.util.Mrc
+
+
+class BoxTile:
+    """Stand-in for a Tile, without the texture."""
+    intersectsBox = cockpit.gui.mosaic.tile.Tile.intersectsBox
+
+    def __init__(self, pos, size):
+        self.pos = pos
+        self.size = size
+        self.box = (pos, (pos[0] + size[0], pos[1] + size[1]))
+
+    def __repr__(self):
+        return 'BoxTile(%s, %s)' % (self.pos, self.size)
+
+
+class MockCamera:
+    name = 'camera'
+
+
+class TestPendingTiles(unittest.TestCase):
+    def setUp(self):
+        self.canvas = unittest.mock.Mock()
+        patcher = unittest.mock.patch('cockpit.gui.camera.window.getCameraScaling',
+                                      return_value=(0, 100))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tiles = cockpit.gui.mosaic.window.PendingTiles(
+            self.canvas, MockCamera(), (10, 20), maxPending=2)
+        self.addCleanup(self.tiles.close, shouldWait=False)
+
+    def take(self, pos, timeout=5):
+        self.tiles.taken(self.tiles.add(pos), timeout)
+
+    def publish(self, data):
+        cockpit.events.publish(cockpit.events.NEW_IMAGE % 'camera', data, 0.0)
+
+    def test_images_placed_in_order(self):
+        self.take((0, 0, 0))
+        self.take((10, 0, 0))
+        self.publish('first')
+        self.assertTrue(self.tiles.waitForRoom())
+        self.take((20, 0, 0))
+        self.publish('second')
+        self.publish('third')
+        self.assertTrue(self.tiles.waitForPending(0))
+        self.assertEqual([(c[0][0], c[0][1]) for c
+                          in self.canvas.addImage.call_args_list],
+                         [('first', (0, 0, 0)), ('second', (10, 0, 0)),
+                          ('third', (20, 0, 0))])
+        self.assertEqual(self.canvas.addImage.call_args[1]['scalings'],
+                         (0, 100))
+
+    def test_unexpected_image_is_ignored(self):
+        self.publish('stray')
+        self.canvas.addImage.assert_not_called()
+
+    def test_timeout(self):
+        self.take((0, 0, 0), timeout=0.01)
+        self.take((10, 0, 0), timeout=0.01)
+        self.assertFalse(self.tiles.waitForRoom())
+        self.assertEqual(len(self.tiles.pending), 0)
+        self.publish('late')
+        self.canvas.addImage.assert_not_called()
+
+    def test_close_unsubscribes(self):
+        self.tiles.close(shouldWait=False)
+        self.tiles.add((0, 0, 0))
+        self.publish('after close')
+        self.canvas.addImage.assert_not_called()
+
+
+class TestTileGrid(unittest.TestCase):
+    def setUp(self):
+        self.grid = cockpit.gui.mosaic.canvas.TileGrid()
+        ## A 10x10 mosaic of 10 micron tiles with a little overlap, and
+        ## a large tile on top.
+        self.tiles = [BoxTile((9 * i - 40, 9 * j - 40), (10, 10))
+                      for i in range(10) for j in range(10)]
+        self.tiles.append(BoxTile((-5, -5), (40, 30)))
+        self.grid.extend(self.tiles)
+
+    def assertSameAsScan(self, box):
+        (x1, y1), (x2, y2) = box
+        box = ((min(x1, x2), min(y1, y2)), (max(x1, x2), max(y1, y2)))
+        expected = [tile for tile in self.tiles
+                    if tile in self.grid and tile.intersectsBox(box)]
+        self.assertEqual(self.grid.getIntersecting(box), expected)
+
+    def test_intersecting(self):
+        self.assertEqual(self.grid.cellSize, 10)
+        for box in [((0, 0), (1, 1)), ((-100, -100), (100, 100)),
+                    ((5, 20), (-3, -7)), ((-31, 14), (-31, 14)),
+                    ((100, 100), (200, 200)), ((-1e6, -1e6), (1e6, 1e6))]:
+            self.assertSameAsScan(box)
+
+    def test_touching_edges(self):
+        ## Boxes that only touch are intersecting, as for Tile.
+        self.assertIn(self.tiles[0], self.grid.getIntersecting(
+            ((-30, -30), (-29, -29))))
+
+    def test_remove(self):
+        for tile in self.tiles[::3]:
+            self.grid.remove(tile)
+        self.assertEqual(len(self.grid), len(self.tiles) - 34)
+        self.assertEqual(list(self.grid),
+                         [tile for i, tile in enumerate(self.tiles) if i % 3])
+        self.assertSameAsScan(((-100, -100), (100, 100)))
+        self.assertSameAsScan(((0, 0), (12, 3)))
+
+    def test_remove_all(self):
+        for tile in self.tiles:
+            self.grid.remove(tile)
+        self.assertEqual(self.grid.cells, {})
+        self.assertEqual(self.grid.getIntersecting(((0, 0), (1, 1))), [])
+        ## Cell size is chosen again for the next tiles.
+        self.grid.add(BoxTile((0, 0), (100, 50)))
+        self.assertEqual(self.grid.cellSize, 100)
+
+
+class DataTile(BoxTile):
+    """Stand-in for a Tile with an image but no texture."""
+    def __init__(self, pos, size, data):
+        super().__init__(pos, size)
+        self.textureData = data
+
+
+class TestExtractRegion(unittest.TestCase):
+    def setUp(self):
+        self.grid = cockpit.gui.mosaic.canvas.TileGrid()
+        self.data = numpy.arange(20 * 30, dtype=numpy.uint16).reshape(20, 30)
+        ## 0.5 micron pixels.
+        self.tile = DataTile((10, 20), (15, 10), self.data)
+        self.grid.add(self.tile)
+
+    def extract(self, box, pixelSize, **kwargs):
+        return cockpit.gui.mosaic.canvas.extractRegion(self.grid, box,
+                                                       pixelSize, **kwargs)
+
+    def test_single_tile(self):
+        region = self.extract(((10, 20), (25, 30)), .5)
+        self.assertEqual(region.dtype, numpy.uint16)
+        numpy.testing.assert_array_equal(region, self.data)
+
+    def test_larger_region(self):
+        ## Rows go down from the top of the box.
+        region = self.extract(((5, 15), (30, 35)), .5, background=7)
+        self.assertEqual(region.shape, (40, 50))
+        numpy.testing.assert_array_equal(region[10:30, 10:40], self.data)
+        region[10:30, 10:40] = 7
+        self.assertTrue(numpy.all(region == 7))
+
+    def test_downsampled(self):
+        region = self.extract(((10, 20), (25, 30)), 1)
+        ## Nearest to the pixel centers.
+        numpy.testing.assert_array_equal(region, self.data[1::2, 1::2])
+
+    def test_later_tiles_on_top(self):
+        top = numpy.full((4, 4), 9999, dtype=numpy.uint16)
+        self.grid.add(DataTile((10, 28), (2, 2), top))
+        region = self.extract(((10, 20), (25, 30)), .5)
+        numpy.testing.assert_array_equal(region[:4, :4], top)
+        numpy.testing.assert_array_equal(region[4:], self.data[4:])
+
+    def test_out(self):
+        out = numpy.zeros((20, 30), dtype=numpy.float32)
+        self.assertIs(self.extract(((10, 20), (25, 30)), .5, out=out), out)
+        numpy.testing.assert_array_equal(out, self.data)
+        with self.assertRaises(ValueError):
+            self.extract(((10, 20), (25, 30)), 1, out=out)
+
+    def test_empty(self):
+        region = self.extract(((100, 100), (101, 102)), .5, background=3)
+        self.assertEqual(region.shape, (4, 2))
+        self.assertTrue(numpy.all(region == 3))
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.grid = cockpit.gui.mosaic.canvas.TileGrid()
+        self.data = numpy.arange(20 * 30, dtype=numpy.uint16).reshape(20, 30)
+        self.grid.add(DataTile((10, 20), (15, 10), self.data))
+        self.box = ((5, 15), (30, 35))
+        self.expected = cockpit.gui.mosaic.canvas.extractRegion(
+            self.grid, self.box, .5)
+
+    def export(self, ext, **kwargs):
+        path = os.path.join(self.tempdir, 'region' + ext)
+        ## Strips of 3 rows, so that the last is short.
+        with unittest.mock.patch('cockpit.gui.mosaic.export.EXPORT_STRIP_BYTES',
+                                 3 * 50 * 2):
+            result = cockpit.gui.mosaic.export.exportRegion(
+                self.grid, self.box, .5, path, **kwargs)
+        return result, path
+
+    def test_mrc(self):
+        result, path = self.export('.mrc')
+        self.assertTrue(result)
+        image = cockpit.util.Mrc.bindFile(path)
+        numpy.testing.assert_array_equal(image.reshape(40, 50), self.expected)
+        self.assertEqual(tuple(image.Mrc.hdr.d), (.5, .5, 1))
+        self.assertEqual(image.Mrc.hdr.mmm1[1], self.data.max())
+
+    def test_bigtiff(self):
+        try:
+            import PIL.Image
+        except ImportError:
+            self.skipTest('PIL is not available')
+        result, path = self.export('.tif')
+        self.assertTrue(result)
+        with PIL.Image.open(path) as image:
+            numpy.testing.assert_array_equal(numpy.array(image), self.expected)
+
+    def test_progress_and_stop(self):
+        shouldStop = threading.Event()
+        progress = []
+        def reportProgress(count, total):
+            progress.append((count, total))
+            if count >= 6:
+                shouldStop.set()
+        result, path = self.export('.mrc', shouldStop=shouldStop,
+                                   reportProgress=reportProgress)
+        self.assertFalse(result)
+        self.assertEqual(progress, [(3, 40), (6, 40)])
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            self.export('.png')
+
+
+class TestRegionCache(unittest.TestCase):
+    def test_least_recently_used_is_dropped(self):
+        cache = cockpit.gui.mosaic.canvas.RegionCache(maxBytes=200)
+        for key in 'abc':
+            cache.put(key, numpy.zeros(10))
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+        cache.put('d', numpy.zeros(10))
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.numBytes, 160)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_read_only(self):
+        cache = cockpit.gui.mosaic.canvas.RegionCache()
+        image = numpy.zeros(10)
+        cache.put('a', image)
+        with self.assertRaises(ValueError):
+            cache.get('a')[0] = 1
+
+    def test_grid_version(self):
+        grid = cockpit.gui.mosaic.canvas.TileGrid()
+        tile = BoxTile((0, 0), (1, 1))
+        grid.add(tile)
+        version = grid.version
+        grid.remove(tile)
+        self.assertNotEqual(grid.version, version)
+        self.assertNotEqual(grid.serial,
+                            cockpit.gui.mosaic.canvas.TileGrid().serial)
+
+    def test_cache_needs_grid(self):
+        ## A grid made from a list would never be found in the cache.
+        canvas = cockpit.gui.mosaic.canvas.MosaicCanvas.__new__(
+            cockpit.gui.mosaic.canvas.MosaicCanvas)
+        tile = DataTile((0, 0), (2, 2), numpy.ones((2, 2)))
+        with self.assertRaises(ValueError):
+            canvas.getRegionData((0, 0), (2, 2), 1, [tile], useCache=True)
+        image = canvas.getRegionData((0, 0), (2, 2), 1, [tile])
+        self.assertEqual(image.shape, (2, 2))
+
+
+class TestLevelsOfDetail(unittest.TestCase):
+    def setUp(self):
+        data = numpy.arange(48 * 64, dtype=numpy.uint16).reshape(48, 64)
+        ## 0.1 micron pixels.
+        self.tile = cockpit.gui.mosaic.tile.Tile(data, (0, 0, 0), (6.4, 4.8),
+                                                 (None, None), 0)
+
+    def test_levels(self):
+        self.assertEqual(self.tile.levelShapes,
+                         [(48, 64), (24, 32), (12, 16), (3, 4)])
+        self.assertEqual([self.tile.getLevelData(i).shape for i in range(4)],
+                         self.tile.levelShapes)
+        self.assertEqual(self.tile.getLevelData(1).dtype, numpy.uint16)
+        self.assertEqual(self.tile.getLevelData(1)[0, 0],
+                         int(self.tile.textureData[:2, :2].mean()))
+        ## No textures until rendered.
+        self.assertEqual(self.tile.textures, {})
+
+    def test_small_tile(self):
+        tile = cockpit.gui.mosaic.tile.Tile(numpy.ones((6, 6)), (0, 0, 0),
+                                            (1, 1), (None, None), 0)
+        self.assertEqual(len(tile.levelShapes), 3)
+
+    def test_level_for_scale(self):
+        self.assertEqual([self.tile.getLevel(scale)
+                          for scale in (None, 20, 10, 5, 2, 1, 0.1)],
+                         [0, 0, 0, 1, 2, 2, 3])
+
+
+class FakeTextureTile:
+    def __init__(self, numBytes):
+        self.numBytes = numBytes
+        self.deleted = []
+
+    def getTextureBytes(self, level):
+        return self.numBytes
+
+    def deleteTexture(self, level):
+        self.deleted.append(level)
+
+
+class TestTextureBudget(unittest.TestCase):
+    def test_least_recently_used_is_evicted(self):
+        budget = cockpit.gui.mosaic.tile.TextureBudget(maxBytes=300)
+        tiles = [FakeTextureTile(100) for i in range(4)]
+        for tile in tiles[:3]:
+            budget.touch(tile, 0)
+        budget.touch(tiles[0], 0)
+        budget.touch(tiles[3], 1)
+        self.assertEqual(tiles[1].deleted, [0])
+        self.assertEqual([t.deleted for t in tiles[2:]], [[], []])
+        self.assertEqual(budget.numBytes, 300)
+        self.assertEqual(budget.numEvicted, 1)
+        budget.discard(tiles[2], 0)
+        self.assertEqual(list(budget.textures), [(tiles[0], 0), (tiles[3], 1)])
+
+    def test_keeps_texture_over_budget(self):
+        budget = cockpit.gui.mosaic.tile.TextureBudget(maxBytes=10)
+        tile = FakeTextureTile(100)
+        budget.touch(tile, 0)
+        self.assertEqual(tile.deleted, [])
+
+    def test_no_limit(self):
+        budget = cockpit.gui.mosaic.tile.TextureBudget(maxBytes=None)
+        tiles = [FakeTextureTile(2**30) for i in range(10)]
+        for tile in tiles:
+            budget.touch(tile, 0)
+        self.assertEqual(budget.numBytes, 10 * 2**30)
+
+
+class TestTexturePool(unittest.TestCase):
+    @unittest.mock.patch('cockpit.gui.mosaic.tile.glDeleteTextures')
+    def test_reuse(self, glDeleteTextures):
+        R32F = cockpit.gui.mosaic.tile.GL_R32F
+        R16 = cockpit.gui.mosaic.tile.GL_R16
+        ## Room for two 8x8 float textures.
+        pool = cockpit.gui.mosaic.tile.TexturePool(maxBytes=2 * 8 * 8 * 4)
+        pool.put((8, 8, R32F), 1)
+        pool.put((8, 8, R32F), 2)
+        pool.put((8, 8, R32F), 3)
+        glDeleteTextures.assert_called_once_with([3])
+        self.assertIsNone(pool.get((8, 4, R32F)))
+        self.assertEqual(pool.get((8, 8, R32F)), 2)
+        pool.put((4, 8, R32F), 4)
+        self.assertEqual(pool.get((4, 8, R32F)), 4)
+        self.assertIsNone(pool.get((8, 8, R16)))
+        self.assertEqual(pool.get((8, 8, R32F)), 1)
+        self.assertIsNone(pool.get((8, 8, R32F)))
+        self.assertEqual(pool.numBytes, 0)
+
+    def test_texture_bytes(self):
+        ## Textures keep the size of 8 and 16 bit data.
+        for dtype, numBytes in ((numpy.uint8, 1), (numpy.uint16, 2),
+                                (numpy.int16, 4), (numpy.float64, 4)):
+            tile = cockpit.gui.mosaic.tile.Tile(numpy.ones((4, 8), dtype),
+                                                (0, 0, 0), (1, 1), (0, 1), 0)
+            self.assertEqual(tile.getTextureBytes(0), 4 * 8 * numBytes)
+
+
+class TestContrast(unittest.TestCase):
+    def contrast(self, dtype, value, minVal, maxVal, targetScale=None):
+        """Value a shader outputs for a pixel of value."""
+        gain, offset = cockpit.gui.mosaic.tile.getContrastUniforms(
+            dtype, minVal, maxVal, targetScale)
+        texel = value / cockpit.gui.mosaic.tile.getMaxTexelValue(dtype)
+        return offset + gain * texel
+
+    def test_black_and_white_points(self):
+        for dtype in (numpy.uint8, numpy.uint16, numpy.int16,
+                      numpy.float32):
+            self.assertAlmostEqual(self.contrast(dtype, 10, 10, 110), 0)
+            self.assertAlmostEqual(self.contrast(dtype, 60, 10, 110), .5)
+            self.assertAlmostEqual(self.contrast(dtype, 110, 10, 110), 1)
+
+    def test_target_keeps_data(self):
+        ## Rendering to a target with the same scale keeps the data.
+        self.assertAlmostEqual(self.contrast(numpy.uint16, 1234, 100, 2000,
+                                             (100, 2000)), 1234, places=3)
+
+    def test_target_looks_the_same(self):
+        ## Rendering to a target with another scale gives what shows the
+        ## same under the target's scale.
+        value = self.contrast(numpy.uint16, 600, 100, 1100, (0, 10))
+        self.assertAlmostEqual(self.contrast(numpy.float32, value, 0, 10),
+                               self.contrast(numpy.uint16, 600, 100, 1100))
+
+    def test_rescale_keeps_textures(self):
+        tile = cockpit.gui.mosaic.tile.Tile(
+            numpy.arange(16, dtype=numpy.uint16).reshape(4, 4), (0, 0, 0),
+            (1, 1), (None, None), 0)
+        self.assertEqual(tile.histogramScale, (0, 15))
+        tile.textures[0] = 1
+        tile.scaleHistogram(5, 5)
+        self.assertEqual(tile.histogramScale, (5, 6))
+        self.assertEqual(tile.staleLevels, set())
+
+
+class TestBeadFinder(unittest.TestCase):
+    def setUp(self):
+        ## Composite of 3x3 tiles of 300x300 pixels.
+        self.data = numpy.zeros((900, 900), dtype=numpy.uint16)
+        self.yy, self.xx = numpy.mgrid[:900, :900]
+
+    def addBead(self, y, x, radius=5, value=1000):
+        self.data[(self.yy - y) ** 2 + (self.xx - x) ** 2 <= radius ** 2] = value
+
+    def find(self):
+        return cockpit.gui.mosaic.beadFinder.findBeads(self.data)
+
+    def test_isolated_bead(self):
+        self.addBead(450, 420)
+        [(x, y, size, intensity)] = self.find()
+        self.assertAlmostEqual(x, 120)
+        self.assertAlmostEqual(y, 150)
+        self.assertEqual(size, numpy.count_nonzero(self.data))
+        self.assertEqual(intensity, 1000)
+
+    def test_close_beads(self):
+        self.addBead(450, 450)
+        self.addBead(450, 500)
+        self.assertEqual(self.find(), [])
+
+    def test_not_circular(self):
+        self.data[450:453, 400:500] = 1000
+        self.assertEqual(self.find(), [])
+
+    def test_bead_outside_center_tile(self):
+        self.addBead(100, 100)
+        self.assertEqual(self.find(), [])
+
+    def test_empty(self):
+        self.assertEqual(self.find(), [])
+
+
+class TestTileStore(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'test.tiles')
+        self.store = cockpit.gui.mosaic.tileStore.TileStore(self.path)
+        self.addCleanup(self.store.close)
+        self.images = [numpy.full((4, 6), 1, dtype=numpy.uint16),
+                       numpy.arange(12, dtype=numpy.float32).reshape(3, 4),
+                       numpy.full((8, 8), 3, dtype='>u2')]
+        for i, image in enumerate(self.images):
+            self.store.append(image, (i, -i, 0.5), (6, 4), (None, 100 + i), i)
+
+    def reopen(self, readOnly=True):
+        store = cockpit.gui.mosaic.tileStore.TileStore(self.path,
+                                                       readOnly=readOnly)
+        self.addCleanup(store.close)
+        return store
+
+    def test_data(self):
+        self.assertEqual(len(self.store), 3)
+        for i, image in enumerate(self.images):
+            data = self.store.getData(i)
+            self.assertEqual(data.dtype, image.dtype)
+            numpy.testing.assert_array_equal(data, image)
+        self.assertEqual(self.store.getTileInfo(1),
+                         ((1, -1, 0.5), (6, 4), (None, 101), 1))
+
+    def test_non_contiguous(self):
+        image = numpy.arange(100, dtype=numpy.uint16).reshape(10, 10)[::2, 1:4]
+        index = self.store.append(image, (0, 0, 0), (1, 1), (0, 1), 0)
+        numpy.testing.assert_array_equal(self.store.getData(index), image)
+
+    def test_reopen(self):
+        self.store.markDeleted(1)
+        store = self.reopen()
+        self.assertEqual(store.getLiveIndices(), [0, 2])
+        numpy.testing.assert_array_equal(store.getData(2), self.images[2])
+        with self.assertRaises(RuntimeError):
+            store.append(self.images[0], (0, 0, 0), (1, 1), (0, 1), 0)
+
+    def test_append_after_crash(self):
+        ## Partial data and index record of a tile being appended.
+        with open(self.path, 'ab') as fh:
+            fh.write(b'\xff' * 100)
+        with open(self.path + '.index', 'ab') as fh:
+            fh.write(b'\xff' * 10)
+        store = self.reopen(readOnly=False)
+        self.assertEqual(len(store), 3)
+        index = store.append(self.images[1], (0, 0, 0), (1, 1), (0, 1), 0)
+        self.assertEqual(index, 3)
+        numpy.testing.assert_array_equal(store.getData(3), self.images[1])
+        self.assertEqual(len(self.reopen()), 4)
+
+    def test_data_survives_growth(self):
+        first = self.store.getData(0)
+        for i in range(20):
+            self.store.append(numpy.full((64, 64), i, dtype=numpy.uint16),
+                              (0, 0, 0), (1, 1), (0, 1), 0)
+        numpy.testing.assert_array_equal(self.store.getData(22), 19)
+        numpy.testing.assert_array_equal(first, self.images[0])
+
+
+    def test_mappings_grow_with_file(self):
+        ## Every tile is read as soon as it is appended, as during a
+        ## mosaic, and the maps must still only cover the file once.
+        segment = mmap.ALLOCATIONGRANULARITY * 4
+        path = os.path.join(self.tempdir, 'segments.tiles')
+        store = cockpit.gui.mosaic.tileStore.TileStore(path,
+                                                       segmentBytes=segment)
+        self.addCleanup(store.close)
+        tileBytes = segment // 3 + 100
+        views = []
+        for i in range(30):
+            index = store.append(numpy.full(tileBytes, i, dtype=numpy.uint8)
+                                 .reshape(1, -1), (0, 0, 0), (1, 1), (0, 1), 0)
+            views.append(store.getData(index))
+        ## Two tiles per segment, none straddling.
+        self.assertEqual(len(store.maps), 15)
+        self.assertEqual(sum(len(m) for m in store.maps.values()),
+                         os.path.getsize(path))
+        for i, view in enumerate(views):
+            numpy.testing.assert_array_equal(view, i)
+        ## A tile larger than a segment gets a map of its own.
+        index = store.append(numpy.ones((1, 2 * segment), dtype=numpy.uint8),
+                             (0, 0, 0), (1, 1), (0, 1), 0)
+        numpy.testing.assert_array_equal(store.getData(index), 1)
+        self.assertEqual(len(store.maps), 16)
+        ## And so does the data of a read only store.
+        store.flush()
+        readOnly = cockpit.gui.mosaic.tileStore.TileStore(
+            path, readOnly=True, segmentBytes=segment)
+        self.addCleanup(readOnly.close)
+        for i in range(30):
+            numpy.testing.assert_array_equal(readOnly.getData(i), i)
+        self.assertEqual(len(readOnly.maps), 15)
+
+
+class TestLoadEntries(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.canvas = cockpit.gui.mosaic.canvas.MosaicCanvas.__new__(
+            cockpit.gui.mosaic.canvas.MosaicCanvas)
+        self.canvas.showLoadError = unittest.mock.Mock()
+        self.images = [numpy.full((6, 4), i, dtype=numpy.uint16)
+                       for i in range(3)]
+        ## Tile stats as in a saved mosaic, with a smaller last image.
+        self.stats = [[i, 2 * i, 0, 6, 4, 6, 4, 0, 10, 0] for i in range(3)]
+        self.stats[2][5:7] = [5, 3]
+
+    def test_legacy_mrc(self):
+        ## As written by older versions of saveTiles.
+        path = os.path.join(self.tempdir, 'mosaic.mrc')
+        imageData = numpy.zeros((1, 1, 3, 6, 4), dtype=numpy.uint16)
+        for i, image in enumerate(self.images):
+            imageData[0, 0, i] = image
+        imageData[0, 0, 2, 5:, 3:] = 99
+        header = cockpit.util.datadoc.makeHeaderFor(imageData)
+        with open(path, 'wb') as handle:
+            cockpit.util.datadoc.writeMrcHeader(header, handle)
+            handle.write(imageData)
+        entries = self.canvas.getMrcTileEntries(path, self.stats)
+        self.assertEqual(len(entries), 3)
+        numpy.testing.assert_array_equal(entries[1][0], self.images[1])
+        self.assertEqual(entries[2][0].shape, (5, 3))
+        self.assertFalse((entries[2][0] == 99).any())
+        self.assertEqual(entries[1][1:], ([1, 2, 0], [6, 4], [0, 10], 0,
+                                          None, None))
+
+    @unittest.mock.patch('cockpit.util.logger.log')
+    def test_store(self, log):
+        path = os.path.join(self.tempdir, 'mosaic.tiles')
+        store = cockpit.gui.mosaic.tileStore.TileStore(path)
+        for image in self.images:
+            store.append(image, (0, 0, 0), (6, 4), (None, None), 0)
+        store.markDeleted(0)
+        store.close()
+        ## All tiles that are not deleted, or those in the saved stats.
+        entries = self.canvas.getStoredTileEntries(path, None)
+        self.assertEqual([entry[-1] for entry in entries], [1, 2])
+        self.assertEqual(entries[0][1:5], ((0, 0, 0), (6, 4), (None, None), 0))
+        stats = [s + [i] for i, s in enumerate(self.stats)] + [self.stats[0] + [7]]
+        entries = self.canvas.getStoredTileEntries(path, stats)
+        self.assertEqual([entry[-1] for entry in entries], [0, 1, 2])
+        log.warning.assert_called_once()
+        numpy.testing.assert_array_equal(
+            entries[0][-2].getData(entries[0][-1]), self.images[0])
+
+    def test_missing_store(self):
+        self.assertIsNone(self.canvas.getStoredTileEntries(
+            os.path.join(self.tempdir, 'missing.tiles'), None))
+        self.canvas.showLoadError.assert_called_once()
+
+    def test_write_tiles(self):
+        tiles = [unittest.mock.Mock(textureData=image, pos=(i, 2 * i, 0),
+                                    size=(6, 4), histogramScale=(0, 10),
+                                    layer=0)
+                 for i, image in enumerate(self.images)]
+        savePath = os.path.join(self.tempdir, 'mosaic.txt')
+        ## Nothing is written if cancelled.
+        self.assertFalse(self.canvas.writeTiles(tiles, savePath,
+                                                lambda i: False))
+        self.assertEqual(os.listdir(self.tempdir), [])
+        self.assertTrue(self.canvas.writeTiles(tiles[1:], savePath,
+                                               lambda i: True))
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['mosaic.txt', 'mosaic.txt.tiles',
+                          'mosaic.txt.tiles.index'])
+        ## The store holds only the saved tiles, and is found relative to
+        ## the saved file.
+        with open(savePath) as handle:
+            self.assertEqual(handle.readline().strip(), 'mosaic.txt.tiles')
+        store = cockpit.gui.mosaic.tileStore.TileStore(
+            savePath + '.tiles', readOnly=True)
+        self.addCleanup(store.close)
+        self.assertEqual(len(store), 2)
+        numpy.testing.assert_array_equal(store.getData(1), self.images[2])
+
+    def test_remove_store(self):
+        MosaicCanvas = cockpit.gui.mosaic.canvas.MosaicCanvas
+        path = os.path.join(self.tempdir, 'mosaic.tiles')
+        with unittest.mock.patch.object(
+                MosaicCanvas, 'store',
+                cockpit.gui.mosaic.tileStore.TileStore(path)):
+            MosaicCanvas.store.append(self.images[0], (0, 0, 0), (6, 4),
+                                      (0, 10), 0)
+            MosaicCanvas.removeStore()
+            self.assertIsNone(MosaicCanvas.store)
+            self.assertEqual(os.listdir(self.tempdir), [])
+            MosaicCanvas.removeStore()
+
+    def test_add_batch(self):
+        ## Images are appended to the store before they are queued.
+        store = cockpit.gui.mosaic.tileStore.TileStore(
+            os.path.join(self.tempdir, 'mosaic.tiles'))
+        self.addCleanup(store.close)
+        self.canvas.getStore = lambda: store
+        self.canvas.pendingImages = cockpit.gui.mosaic.canvas.queue.Queue(1)
+        shouldStop = cockpit.gui.mosaic.canvas.threading.Event()
+        entry = (self.images[1], (0, 0, 0), (6, 4), (0, 10), 0, None, None)
+        self.assertTrue(self.canvas.addBatch([entry], shouldStop))
+        shouldStop.set()
+        self.assertFalse(self.canvas.addBatch([entry], shouldStop))
+        batch = self.canvas.pendingImages.get()
+        self.assertEqual(batch, [(None, (0, 0, 0), (6, 4), (0, 10), 0,
+                                  store, 0)])
+        numpy.testing.assert_array_equal(store.getData(0), self.images[1])
+        ## Nothing is appended if shouldStop is already set.
+        self.assertEqual(len(store), 1)
+
+    def test_cancelled_batch_is_deleted(self):
+        store = cockpit.gui.mosaic.tileStore.TileStore(
+            os.path.join(self.tempdir, 'mosaic.tiles'))
+        self.addCleanup(store.close)
+        self.canvas.getStore = lambda: store
+        self.canvas.pendingImages = cockpit.gui.mosaic.canvas.queue.Queue(1)
+        self.canvas.pendingImages.put([])
+        ## Stopped while waiting for room in the full buffer.
+        shouldStop = unittest.mock.Mock()
+        shouldStop.is_set.side_effect = [False, True]
+        entry = (self.images[1], (0, 0, 0), (6, 4), (0, 10), 0, None, None)
+        self.assertFalse(self.canvas.addBatch([entry], shouldStop))
+        self.assertEqual(len(store), 1)
+        self.assertEqual(list(store.getLiveIndices()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
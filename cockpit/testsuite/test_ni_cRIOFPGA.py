@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## This file is part of Cockpit.
+##
+## Cockpit is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## Cockpit is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import unittest.mock
+
+import numpy
+
+import cockpit.events
+import cockpit.devices.ni_cRIOFPGA as ni_cRIOFPGA
+import cockpit.handlers.executor
+import cockpit.testsuite.benchmark_crio_upload as benchmark
+import cockpit.testsuite.fake_crio
+
+
+class TestPackTable(unittest.TestCase):
+    def test_same_as_binary_repr(self):
+        table = numpy.array([[0, 0], [1, 2**16-1], [2**32-1, 5], [100, -1]],
+                            dtype=numpy.int64)
+        expected = [int(numpy.binary_repr(t, 32) + numpy.binary_repr(v, 32), 2)
+                    for t, v in table]
+        packed = ni_cRIOFPGA.packTable(table)
+        self.assertEqual(packed.dtype, numpy.dtype('<u8'))
+        self.assertEqual(packed.tolist(), expected)
+
+    def test_empty(self):
+        self.assertEqual(ni_cRIOFPGA.packTable([]).size, 0)
+
+
+class TestSendTables(unittest.TestCase):
+    def connect(self, capabilities):
+        self.fake = cockpit.testsuite.fake_crio.FakeCRIO(capabilities)
+        self.addCleanup(self.fake.close)
+        self.connection = ni_cRIOFPGA.Connection(
+            parent=None, ipAddress='127.0.0.1', port=[self.fake.port, None],
+            localIp='127.0.0.1')
+        self.connection.connection = self.connection.createSendSocket(
+            '127.0.0.1', self.fake.port, 5)
+        self.addCleanup(self.connection.connection.close)
+        self.connection.queryCapabilities()
+
+    def send(self):
+        self.digitals, self.analogues = benchmark.make_tables(100,
+                                                              n_analogues=3)
+        self.connection.sendTables(self.digitals, self.analogues)
+        return [command for command, messages in self.fake.commands]
+
+    def assertTablesReceived(self):
+        received = [messages for command, messages in self.fake.commands[-4:]]
+        for messages, table in zip(received,
+                                   [self.digitals] + self.analogues):
+            numpy.testing.assert_array_equal(messages,
+                                             ni_cRIOFPGA.packTable(table))
+
+    def test_binary(self):
+        self.connect(['binaryTables'])
+        self.assertEqual(self.connection.capabilities, {'binaryTables'})
+        self.assertEqual(self.send(), [414, 409, 110, 210, 211, 212])
+        self.assertTablesReceived()
+
+    def test_old_host(self):
+        self.connect(None)
+        self.assertEqual(self.connection.capabilities, set())
+        self.assertEqual(self.send(), [414, 409, 100, 200, 201, 202])
+        self.assertTablesReceived()
+
+    def test_host_without_binary_tables(self):
+        self.connect(['somethingElse'])
+        self.assertEqual(self.send()[2:], [100, 200, 201, 202])
+        self.assertTablesReceived()
+
+    def test_prepare_without_upload(self):
+        self.connect(['binaryTables'])
+        self.connection.PrepareActions([{}, [], []], 3, upload=False)
+        self.assertEqual([command for command, messages
+                          in self.fake.commands[1:]], [407])
+
+
+class TestExecuteTable(unittest.TestCase):
+    def setUp(self):
+        self.device = ni_cRIOFPGA.NIcRIO('cRIO', {'ipaddress': '127.0.0.1',
+                                                  'sendport': 0,
+                                                  'receiveport': 0})
+        self.device.nrAnalogLines = 2
+        self.device.connection = unittest.mock.Mock()
+        self.device.connection.RunActions.side_effect = (
+            lambda: cockpit.events.publish(cockpit.events.EXECUTOR_DONE
+                                           % self.device.name))
+
+    def execute(self, key, numReps=1):
+        table = cockpit.handlers.executor.CompiledActions(
+            numpy.array([10.0, 11.0, 11.001, 12.0]),
+            numpy.array([0, 1, 2, 0], dtype=numpy.uint32),
+            numpy.array([[0, 0], [5, 0], [5, 0], [5.5, 0]]), key)
+        self.device.executeTable(table, 0, len(table), numReps, None)
+        return self.device.connection.PrepareActions.call_args
+
+    def test_adapts_actions(self):
+        (profile, numReps), kwargs = self.execute('a')
+        ## Last digital state of each tick, and only analogue changes,
+        ## truncated to integers.
+        self.assertEqual(profile[1].tolist(), [[0, 0], [100, 2], [200, 0]])
+        self.assertEqual([a.tolist() for a in profile[2]],
+                         [[[0, 0], [100, 5], [200, 5]], [[0, 0]]])
+        self.assertEqual(profile[0], {'count': 200, 'clock': 10.0,
+                                      'InitDio': 0, 'nDigital': 3,
+                                      'nAnalog': [3, 1]})
+
+    def test_skips_upload_of_same_profile(self):
+        first = self.execute('a')
+        second = self.execute('a', numReps=2)
+        self.assertTrue(first[1]['upload'])
+        self.assertFalse(second[1]['upload'])
+        self.assertIs(first[0][0], second[0][0])
+        self.assertEqual(second[0][1], 2)
+        self.assertTrue(self.execute('b')[1]['upload'])
+        self.assertTrue(self.execute('a')[1]['upload'])
+
+    def test_uploads_after_sequence(self):
+        self.execute('a')
+        self.device.runSequence([(0, 1), (1, 0)])
+        self.assertTrue(self.execute('a')[1]['upload'])
+
+
+class TestBenchmarkCRIOUpload(unittest.TestCase):
+    def test_protocols(self):
+        results = {protocol: benchmark.run_benchmark(protocol, 1000)
+                   for protocol in benchmark.PROTOCOLS}
+        self.assertLess(results['binary'].bytes_sent,
+                        results['ascii'].bytes_sent / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
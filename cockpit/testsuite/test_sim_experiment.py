@@ -50,3 +50,29 @@ class PostpadTestCase(unittest.TestCase):
         data = numpy.ones((3,))
         padded = sim.postpad_data(data, (3,))
         self.assertEqual(padded.size, 3)
+
+
+class ZIndexMapTestCase(unittest.TestCase):
+    def test_z_angle_phase(self):
+        index_map = sim.z_index_map(('z', 'a', 'p'), (4, 3, 5),
+                                    ('a', 'z', 'p'))
+        self.assertEqual(index_map.shape, (60,))
+        for z in range(4):
+            for a in range(3):
+                for p in range(5):
+                    self.assertEqual(index_map[z*15 + a*5 + p],
+                                     a*20 + z*5 + p)
+
+    def test_z_phase_angle(self):
+        index_map = sim.z_index_map(('z', 'p', 'a'), (2, 5, 3),
+                                    ('a', 'z', 'p'))
+        for z in range(2):
+            for p in range(5):
+                for a in range(3):
+                    self.assertEqual(index_map[z*15 + p*3 + a],
+                                     a*10 + z*5 + p)
+
+    def test_same_order(self):
+        index_map = sim.z_index_map(('a', 'z', 'p'), (3, 2, 5),
+                                    ('a', 'z', 'p'))
+        self.assertEqual(list(index_map), list(range(30)))
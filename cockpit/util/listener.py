@@ -19,9 +19,17 @@
 ## along with Cockpit.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import numpy
 import Pyro4
+import weakref
 from cockpit import depot
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python older than 3.8, only the Pyro transport is available.
+    shared_memory = None
+
 ## Similar to the util.connection.Connection class.
 # Several device classes need to register functions with the cockpit
 # server to receive data from the remote object. The Connection class
@@ -78,3 +86,135 @@ class Listener:
         except Exception as e:
             print ("Couldn't disconnect listener from %s: %s" % (self._proxy, e))
         self._listening = False
+
+
+
+## State of each slot in a SharedImageRing, as written on the first
+# bytes of the shared memory.  A slot is FREE for the device server to
+# write a new image, or FULL from then until cockpit has no more
+# references to the image in it.
+SLOT_FREE = 0
+SLOT_FULL = 1
+
+## Alignment of the slots in the shared memory.
+SLOT_ALIGNMENT = 64
+
+
+## A ring of image slots in shared memory, for device servers on the
+# same computer to hand over images without copying them through Pyro.
+# The memory starts with one byte per slot for the slot state (see
+# SLOT_FREE and SLOT_FULL), padded to SLOT_ALIGNMENT, followed by
+# numSlots slots of slotBytes each.
+#
+# The device server attaches to the shared memory by its name and, to
+# send an image, copies it to the next slot in order if that slot is
+# free and large enough, marks it as full, and sends a (slot, shape,
+# dtype string) descriptor instead of the image.  Otherwise, it sends
+# the image as usual.  Cockpit marks the slot as free once all views
+# of the image are gone.
+class SharedImageRing:
+    def __init__(self, numSlots, slotBytes):
+        self.numSlots = numSlots
+        ## Round up so all slots, not just the first, are aligned.
+        self.slotBytes = -(-slotBytes // SLOT_ALIGNMENT) * SLOT_ALIGNMENT
+        self.dataOffset = -(-numSlots // SLOT_ALIGNMENT) * SLOT_ALIGNMENT
+        self._memory = shared_memory.SharedMemory(
+            create=True, size=self.dataOffset + numSlots * self.slotBytes)
+        ## Name for the device server to attach to the memory.
+        self.name = self._memory.name
+        self.states = numpy.ndarray((numSlots,), dtype=numpy.uint8,
+                                    buffer=self._memory.buf)
+        self.states[:] = SLOT_FREE
+
+
+    ## Return the image described by a descriptor from the device
+    # server, as a view into the ring.  The slot is freed once the
+    # view, and any other view derived from it, is garbage collected.
+    def getImage(self, descriptor):
+        slot, shape, dtype = descriptor
+        image = numpy.ndarray(shape, dtype=dtype, buffer=self._memory.buf,
+                              offset=self.dataOffset + slot * self.slotBytes)
+        # The finalizer keeps a reference to the ring, so the shared
+        # memory stays around until the last image is gone.
+        weakref.finalize(image, self._release, slot)
+        return image
+
+
+    def _release(self, slot):
+        self.states[slot] = SLOT_FREE
+
+
+    ## Remove the shared memory name from the system, so no other
+    # process can attach to it.  The memory itself is released when
+    # all views of images in it are gone.
+    def unlink(self):
+        self._memory.unlink()
+
+
+
+## A Listener that receives images through a SharedImageRing, when the
+# remote device supports it, instead of as arguments of each Pyro
+# call.  The device supports it if it has a receiveClientSharedMemory
+# method, which is called instead of receiveClient with the URI and
+# the name, number of slots, and slot size of the ring, and returns
+# whether it accepted them.  Otherwise, this behaves like Listener.
+#
+# The callback gets the same arguments either way, but images from the
+# ring are views of shared memory that must not be modified.
+class SharedMemoryListener(Listener):
+    def __init__(self, pyroProxy, callback=None, localIp=None,
+                 numSlots=16, slotBytes=0):
+        super().__init__(pyroProxy, callback, localIp)
+        self.numSlots = numSlots
+        self.slotBytes = slotBytes
+        ## SharedImageRing in use, if any.
+        self.ring = None
+
+
+    def connect(self, callback=None, timeout = 5):
+        if self._listening:
+            self.disconnect()
+        if callback:
+            self._callback = callback
+        elif not self._callback:
+            raise Exception('No callback set.')
+        server = depot.getHandlersOfType(depot.SERVER)[0]
+        uri = server.register(self._receive, self._localIp)
+        if shared_memory is not None and self.slotBytes:
+            self.ring = SharedImageRing(self.numSlots, self.slotBytes)
+            try:
+                accepted = self._proxy.receiveClientSharedMemory(
+                    uri, self.ring.name, self.ring.numSlots,
+                    self.ring.slotBytes)
+            except AttributeError:
+                # Remote does not know about shared memory.
+                accepted = False
+            if not accepted:
+                self.ring.unlink()
+                self.ring = None
+        if self.ring is None:
+            self._proxy.receiveClient(uri)
+        self._listening = True
+
+
+    def disconnect(self):
+        if not self._listening:
+            return
+        server = depot.getHandlersOfType(depot.SERVER)[0]
+        server.unregister(self._receive)
+        try:
+            self._proxy.receiveClient(None)
+        except Exception as e:
+            print ("Couldn't disconnect listener from %s: %s" % (self._proxy, e))
+        if self.ring is not None:
+            self.ring.unlink()
+            self.ring = None
+        self._listening = False
+
+
+    ## Replace image descriptors with the images from the ring before
+    # passing them to the callback.
+    def _receive(self, data, *args):
+        if isinstance(data, tuple) and self.ring is not None:
+            data = self.ring.getImage(data)
+        return self._callback(data, *args)